@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""Offline benchmark of the RedditImage rendering path
+
+Renders generated images over a grid of resolutions, title lengths, character sets and
+boot/wrap mode, plus generated flat graphics and animated gifs, times every stage and writes
+the results as json.
+
+Every case runs in a forked process, its peak memory is the growth of the resident set size
+of that process. Pillow allocates pixels in C, so tracemalloc doesn't see them, and ru_maxrss
+of a single process only ever grows.
+
+e.g. './benchmark.py -o bench.json' then './benchmark.py --compare bench.json' after a change.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+import zlib
+from io import BytesIO
+
+import PIL
+from PIL import Image, ImageDraw
+
+import titletoimagebot
+from titletoimagebot import AnimatedRedditImage, RedditImage
+
+RESOLUTIONS = [(320, 240), (800, 600), (1920, 1080), (4000, 3000)]
+TITLE_LENGTHS = {'short': 20, 'medium': 80, 'long': 300}
+CHARSETS = {
+    'ascii': 'the quick brown fox jumps over the lazy dog roses are red violets blue',
+    'latin': 'Straße naïve café Ünïcödé façade jalapeño smörgåsbord crème brûlée',
+    'mixed': 'the quick 東京 タワー 😂 👍 Ελληνικά кириллица — “quoted” ¿qué?',
+}
+GRAPHICS = [(800, 600), (1920, 1080)]
+# (width, height), frames
+ANIMATIONS = [((320, 240), 30), ((480, 360), 100)]
+STAGES = ['init', 'layout', 'add_title', 'encode_auto', 'encode_png', 'encode_jpeg']
+ANIMATION_STAGES = ['init', 'add_title', 'encode_gif']
+
+
+def _make_image(size, seed):
+    """Generate a noisy photo-like image, so encoders can't cheat on flat colors
+
+    :param size: width and height
+    :type size: tuple[int, int]
+    :param seed: random seed for the gradient direction
+    :type seed: int
+    :rtype: PIL.Image.Image
+    """
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size)
+    noise = [Image.effect_noise(size, 40 + 10 * i) for i in range(3)]
+    channels = [Image.blend(gradient, channel, 0.5) for channel in noise]
+    return Image.merge('RGB', channels)
+
+
+def _make_graphic(size, seed):
+    """Generate a flat graphic with few colors, like a screenshot or comic
+
+    :param size: width and height
+    :type size: tuple[int, int]
+    :param seed: random seed for the shapes
+    :type seed: int
+    :rtype: PIL.Image.Image
+    """
+    rng = random.Random(seed)
+    image = Image.new('RGB', size, '#fff')
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        box = (x, y, x + rng.randrange(width // 4), y + rng.randrange(height // 4))
+        draw.rectangle(box, fill=rng.choice(['#000', '#e33', '#3a3', '#36c', '#fc0']))
+    for y in range(0, height, 24):
+        draw.text((10, y), CHARSETS['ascii'], fill='#000')
+    return image
+
+
+def _make_animation(size, frames, seed):
+    """Generate an animated gif of a sliding noise image
+
+    :returns: the encoded gif
+    :rtype: bytes
+    """
+    image = _make_image((size[0] * 2, size[1]), seed)
+    step = max(1, size[0] // frames)
+    frame_images = [image.crop((i * step, 0, i * step + size[0], size[1])).quantize(64)
+                    for i in range(frames)]
+    buffer = BytesIO()
+    frame_images[0].save(buffer, 'GIF', save_all=True, append_images=frame_images[1:],
+                         duration=40, loop=0)
+    return buffer.getvalue()
+
+
+def _make_title(charset, length, boot, seed):
+    """Generate a title, with rhyme delimiters in boot mode
+
+    :rtype: str
+    """
+    rng = random.Random(seed)
+    words = CHARSETS[charset].split()
+    title = ''
+    while len(title) < length:
+        word = rng.choice(words)
+        if boot and rng.random() < 0.2:
+            word += rng.choice(',;')
+        title += word + ' '
+    return title[:length].strip()
+
+
+def _time(function, *args):
+    """Run function, return result and elapsed seconds"""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_case(image, title, boot, repeat):
+    """Render title on image repeat times
+
+    :returns: median seconds per stage, bytes of the last encodes and the format picked by
+        encode_auto
+    :rtype: dict
+    """
+    timings = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        reddit_image, elapsed = _time(RedditImage, image)
+        timings['init'].append(elapsed)
+        layout = reddit_image._split_title if boot else reddit_image._wrap_title
+        lines, elapsed = _time(layout, RedditImage.regex_resolution.sub('', title))
+        timings['layout'].append(elapsed)
+        _, elapsed = _time(reddit_image.add_title, title, boot)
+        timings['add_title'].append(elapsed)
+        (auto_format, auto), elapsed = _time(reddit_image.encode_auto)
+        timings['encode_auto'].append(elapsed)
+        report = reddit_image.encode_report
+        # time png and jpeg without the encodes cached by encode_auto
+        reddit_image._encoded = {}
+        png, elapsed = _time(reddit_image.encode, 'PNG')
+        timings['encode_png'].append(elapsed)
+        jpeg, elapsed = _time(reddit_image.encode, 'JPEG')
+        timings['encode_jpeg'].append(elapsed)
+    seconds = {stage: statistics.median(values) for stage, values in timings.items()}
+    total = sum(seconds.values())
+    return {
+        'seconds': seconds,
+        'total_seconds': total,
+        'images_per_second': 1 / total if total else None,
+        'lines': len(lines),
+        'upscaled': reddit_image.upscaled,
+        'png_bytes': len(png),
+        'jpeg_bytes': len(jpeg),
+        'auto_format': auto_format,
+        'auto_kind': report['kind'],
+        'auto_quality': report['quality'],
+        'auto_bytes': len(auto),
+    }
+
+
+def run_animation_case(data, title, boot, repeat):
+    """Render title on the animated gif data repeat times
+
+    :returns: median seconds per stage and bytes of the last encode
+    :rtype: dict
+    """
+    timings = {stage: [] for stage in ANIMATION_STAGES}
+    for _ in range(repeat):
+        image, elapsed = _time(AnimatedRedditImage,
+                               AnimatedRedditImage.open_animation(data))
+        timings['init'].append(elapsed)
+        _, elapsed = _time(image.add_title, title, boot)
+        timings['add_title'].append(elapsed)
+        gif, elapsed = _time(image.encode, 'GIF')
+        timings['encode_gif'].append(elapsed)
+    seconds = {stage: statistics.median(values) for stage, values in timings.items()}
+    total = sum(seconds.values())
+    return {
+        'seconds': seconds,
+        'total_seconds': total,
+        'images_per_second': 1 / total if total else None,
+        'upscaled': image.upscaled,
+        'gif_bytes': len(gif),
+    }
+
+
+def _rss_kib():
+    """Current resident set size of this process in KiB
+
+    :rtype: int
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def _run_measured(connection, function, args):
+    """Run function(*args) and send its result with the peak RSS growth, in the subprocess"""
+    start = _rss_kib()
+    result = function(*args)
+    result['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+    connection.send(result)
+    connection.close()
+
+
+def _in_subprocess(function, *args):
+    """Run a case in a forked process, so its peak memory is measured on its own
+
+    The forked process starts with the pages of this process, peak_rss_kib is what the case
+    added on top of them.
+
+    :param function: the case, returns a dict
+    :type function: callable
+    :returns: the result of function(*args), with peak_rss_kib added
+    :rtype: dict
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_measured, args=(sender, function, args))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError('Benchmark case died') from None
+    finally:
+        receiver.close()
+        process.join()
+
+
+def run(repeat, resolutions, graphics, animations):
+    """Run the whole grid
+
+    :returns: benchmark results
+    :rtype: dict
+    """
+    cases = []
+    for width, height in resolutions:
+        image = _make_image((width, height), width * height)
+        for length_name, length in TITLE_LENGTHS.items():
+            for charset in CHARSETS:
+                for boot in (True, False):
+                    name = '{}x{}/{}/{}/{}'.format(width, height, length_name, charset,
+                                                   'boot' if boot else 'wrap')
+                    title = _make_title(charset, length, boot, zlib.crc32(name.encode()))
+                    result = _in_subprocess(run_case, image, title, boot, repeat)
+                    result['name'] = name
+                    cases.append(result)
+                    logging.info('%-36s %8.1f ms %6.1f img/s %7.1f MiB  auto %s %s %5.1f%% of '
+                                 'png', name, result['total_seconds'] * 1000,
+                                 result['images_per_second'], result['peak_rss_kib'] / 1024,
+                                 result['auto_kind'], result['auto_format'],
+                                 100 * result['auto_bytes'] / result['png_bytes'])
+    for width, height in graphics:
+        name = 'graphic/{}x{}'.format(width, height)
+        image = _make_graphic((width, height), zlib.crc32(name.encode()))
+        result = _in_subprocess(run_case, image, _make_title('ascii', 80, False, 0), False,
+                                repeat)
+        result['name'] = name
+        cases.append(result)
+        logging.info('%-36s %8.1f ms %6.1f img/s %7.1f MiB  auto %s %s %5.1f%% of png', name,
+                     result['total_seconds'] * 1000, result['images_per_second'],
+                     result['peak_rss_kib'] / 1024, result['auto_kind'], result['auto_format'],
+                     100 * result['auto_bytes'] / result['png_bytes'])
+    for (width, height), frames in animations:
+        name = 'gif/{}x{}x{}'.format(width, height, frames)
+        data = _make_animation((width, height), frames, zlib.crc32(name.encode()))
+        result = _in_subprocess(run_animation_case, data, _make_title('ascii', 80, False, 0),
+                                False, repeat)
+        result['name'] = name
+        cases.append(result)
+        logging.info('%-36s %8.1f ms %6.1f img/s %7.1f MiB', name,
+                     result['total_seconds'] * 1000, result['images_per_second'],
+                     result['peak_rss_kib'] / 1024)
+    return {
+        'version': titletoimagebot.__version__,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'timestamp': time.time(),
+        'repeat': repeat,
+        'cases': cases,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Log per case total time relative to baseline
+
+    Only the stages present in both runs are compared.
+
+    :returns: amount of cases slower than threshold
+    :rtype: int
+    """
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions = 0
+    for case in results['cases']:
+        old = baseline_cases.get(case['name'])
+        if not old:
+            continue
+        stages = [stage for stage in case['seconds'] if old['seconds'].get(stage)]
+        ratio = (sum(case['seconds'][stage] for stage in stages) /
+                 sum(old['seconds'][stage] for stage in stages))
+        slower = ratio > 1 + threshold
+        regressions += slower
+        logging.log(logging.WARNING if slower else logging.INFO, '%-36s %5.2fx %s',
+                    case['name'], ratio, ' '.join(
+                        '{}:{:.2f}x'.format(stage, case['seconds'][stage] / old['seconds'][stage])
+                        for stage in stages))
+    return regressions
+
+
+def main():
+    """Main function
+
+    Usage: ./benchmark.py [-h] [-o OUTPUT] [--compare BASELINE] [--repeat N] [--font FONT]
+                          [--fallback-font FONT] [--photo-format {jpeg,webp}]
+    """
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='write results to this json file')
+    parser.add_argument('--compare', help='json file of an earlier run to compare against')
+    parser.add_argument('--threshold', help='relative slowdown reported as regression',
+                        type=float, default=0.1)
+    parser.add_argument('--repeat', help='renders per case', type=int, default=5)
+    parser.add_argument('--font', help='font file', default=RedditImage.font_file)
+    parser.add_argument('--fallback-font', help='fallback font file, can be repeated',
+                        action='append', default=[])
+    parser.add_argument('--photo-format', help='format of photos picked by encode_auto',
+                        choices=['jpeg', 'webp'], default='jpeg')
+    parser.add_argument('--quick', help='only the two smallest resolutions, the smallest '
+                        'graphic and the smallest animation', action='store_true')
+    args = parser.parse_args()
+    RedditImage.font_file = args.font
+    RedditImage.fallback_fonts = tuple(args.fallback_font)
+    RedditImage.photo_format = args.photo_format.upper()
+    results = run(args.repeat, RESOLUTIONS[:2] if args.quick else RESOLUTIONS,
+                  GRAPHICS[:1] if args.quick else GRAPHICS,
+                  ANIMATIONS[:1] if args.quick else ANIMATIONS)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            logging.warning('%d case(s) slower than baseline', regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+
+"""End to end load test of TitleToImageBot against local stand-ins of reddit, imgur and an
+image host
+
+Starts three fake http services with configurable latency, error rate and rate-limit
+responses, posts new submissions and username mentions at a target rate and runs one or more
+bots against them. Reports sustained throughput, reply latency percentiles and how failures
+were handled as json. No credentials or network access needed.
+
+e.g. './loadtest.py --rate 2 --mention-rate 0.5 --duration 60 --pipeline 4 2 4'
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import imgurpython.client
+import requests
+from PIL import Image
+from prawcore.exceptions import RequestException, ResponseException
+
+from titletoimagebot import RedditImage, TitleToImageBot
+
+BOT_NAME = 'TitleToImageBot'
+# time (in seconds) to wait for a bot to finish its cycle at the end of a run
+BOT_STOP_TIMEOUT = 60
+logger = logging.getLogger('loadtest')
+WORDS = ('roses are red violets are blue the quick brown fox jumps over the lazy dog '
+         'when you see it old but gold me irl til this is fine').split()
+
+
+class Faults:
+    """Latency and failures injected into the fake services
+
+    :param latency: mean response delay in seconds
+    :type latency: float
+    :param error_rate: fraction of requests answered with a server error
+    :type error_rate: float
+    :param ratelimit_rate: fraction of reply/upload requests answered with a rate-limit error
+    :type ratelimit_rate: float
+    :param seed: random seed
+    :type seed: int
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, ratelimit_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ratelimit_rate = ratelimit_rate
+        self.injected = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self, service, ratelimited=False):
+        """Delay the current request, then decide if it fails
+
+        :param service: service name, for the counters
+        :type service: str
+        :param ratelimited: if the request can be answered with a rate-limit error
+        :type ratelimited: bool
+        :returns: 'error', 'ratelimit' or None if the request succeeds
+        :rtype: str, NoneType
+        """
+        with self._lock:
+            delay = self._random.expovariate(1 / self.latency) if self.latency else 0
+            roll = self._random.random()
+        time.sleep(delay)
+        fault = None
+        if roll < self.error_rate:
+            fault = 'error'
+        elif ratelimited and roll < self.error_rate + self.ratelimit_rate:
+            fault = 'ratelimit'
+        if fault:
+            with self._lock:
+                self.injected[service, fault] += 1
+        return fault
+
+
+class FakeServices:
+    """State of the fake reddit, imgur and image host, shared by their request handlers
+
+    :param faults: the injected faults
+    :type faults: Faults
+    :param subreddit: name of the fake subreddit
+    :type subreddit: str
+    :param images: amount of distinct source images
+    :type images: int
+    """
+    def __init__(self, faults, subreddit='loadtest', images=16):
+        self.faults = faults
+        self.subreddit = subreddit
+        self.reddit_url = self.imgur_url = self.image_url = None
+        # fullname -> thing data, newest last
+        self.submissions = {}
+        self.inbox = {}
+        # fullname -> time it was posted
+        self.created = {}
+        # fullname -> times it was replied to
+        self.replies = {}
+        self.requests = Counter()
+        self.uploads = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._images = [_make_image(seed) for seed in range(images)]
+        self._servers = []
+
+    def start(self):
+        """Start the three services on free local ports"""
+        urls = []
+        for handler in (_RedditHandler, _ImgurHandler, _ImageHandler):
+            server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+            server.daemon_threads = True
+            server.services = self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers.append(server)
+            urls.append('http://127.0.0.1:{}'.format(server.server_port))
+        self.reddit_url, self.imgur_url, self.image_url = urls
+
+    def stop(self):
+        """Stop the services"""
+        for server in self._servers:
+            server.shutdown()
+
+    def new_id(self):
+        """Next base 36 thing id, so ids sort like reddit ids"""
+        number = next(self._ids) + 36 ** 4
+        digits = ''
+        while number:
+            number, digit = divmod(number, 36)
+            digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        return digits
+
+    def post_submission(self, rng):
+        """Post a new submission
+
+        :param rng: random source for title and image
+        :type rng: random.Random
+        :returns: the submission fullname
+        :rtype: str
+        """
+        with self._lock:
+            submission_id = self.new_id()
+            fullname = 't3_' + submission_id
+            now = time.time()
+            self.submissions[fullname] = {
+                'id': submission_id, 'name': fullname, 'author': 'poster',
+                'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25))),
+                'url': '{}/i/{}.jpg'.format(self.image_url, rng.randrange(len(self._images))),
+                'subreddit': self.subreddit, 'score': rng.randint(0, 5000),
+                'created_utc': now, 'permalink': '/r/{}/comments/{}/post/'.format(
+                    self.subreddit, submission_id),
+                'is_self': False, 'num_comments': 0,
+            }
+            self.created[fullname] = now
+        return fullname
+
+    def post_mention(self, rng):
+        """Post a username mention in a comment on a random earlier submission
+
+        :param rng: random source for the submission and custom title
+        :type rng: random.Random
+        :returns: the comment fullname, None if there is no submission yet
+        :rtype: str, NoneType
+        """
+        with self._lock:
+            if not self.submissions:
+                return None
+            submission = self.submissions[rng.choice(list(self.submissions)[-500:])]
+            comment_id = self.new_id()
+            fullname = 't1_' + comment_id
+            now = time.time()
+            body = '/u/{} "{}"'.format(BOT_NAME, ' '.join(rng.sample(WORDS, 4)))
+            self.inbox[fullname] = {
+                'id': comment_id, 'name': fullname, 'author': 'mentioner', 'body': body,
+                'subject': 'username mention', 'link_id': submission['name'],
+                'parent_id': submission['name'], 'subreddit': self.subreddit,
+                'context': '{}{}/?context=3'.format(submission['permalink'], comment_id),
+                'was_comment': True, 'new': True, 'created_utc': now,
+            }
+            self.created[fullname] = now
+        return fullname
+
+    def image(self, index):
+        """Encoded source image"""
+        return self._images[index % len(self._images)]
+
+    def record_upload(self):
+        """Record an upload
+
+        :returns: the id of the uploaded image
+        :rtype: str
+        """
+        with self._lock:
+            self.uploads += 1
+        return self.new_id()
+
+    def record_reply(self, fullname):
+        """Record a reply to a submission or comment"""
+        with self._lock:
+            self.replies.setdefault(fullname, []).append(time.time())
+
+    def listing(self, things, params):
+        """Newest first listing page of things, with after/before paging
+
+        :param things: fullname -> data, oldest first
+        :type things: dict[str, dict]
+        :param params: the query parameters
+        :type params: dict[str, str]
+        :returns: the listing data
+        :rtype: dict
+        """
+        with self._lock:
+            names = list(reversed(list(things)))
+            limit = int(params.get('limit', 25))
+            if params.get('before') in things:
+                names = names[:names.index(params['before'])]
+            if params.get('after') in things:
+                names = names[names.index(params['after']) + 1:]
+            page = names[:limit]
+            children = [{'kind': name[:2], 'data': dict(things[name])} for name in page]
+        return {'kind': 'Listing', 'data': {
+            'children': children, 'after': page[-1] if len(names) > limit else None,
+            'before': None}}
+
+    def report(self, started, generated_until, finished):
+        """Summarize the run
+
+        :param started: time the first item was posted
+        :type started: float
+        :param generated_until: time the last item was posted
+        :type generated_until: float
+        :param finished: end of the drain period
+        :type finished: float
+        :rtype: dict
+        """
+        with self._lock:
+            latencies = sorted(times[0] - self.created[name]
+                               for name, times in self.replies.items())
+            in_window = sum(1 for times in self.replies.values() if times[0] <= generated_until)
+            duplicates = sum(len(times) - 1 for times in self.replies.values())
+            offered = Counter(name[:2] for name in self.created)
+            missing = Counter(name[:2] for name in self.created if name not in self.replies)
+        window = generated_until - started
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+        return {
+            'offered': {'submissions': offered['t3'], 'mentions': offered['t1']},
+            'offered_per_second': sum(offered.values()) / window if window else None,
+            'replied': len(latencies),
+            'throughput_per_second': in_window / window if window else None,
+            'missing': {'submissions': missing['t3'], 'mentions': missing['t1']},
+            'duplicate_replies': duplicates,
+            'latency_seconds': {
+                'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+                'max': latencies[-1] if latencies else None,
+                'mean': statistics.mean(latencies) if latencies else None,
+            },
+            'uploads': self.uploads,
+            'injected_faults': {'{}:{}'.format(*key): count
+                                for key, count in sorted(self.faults.injected.items())},
+            'requests': dict(sorted(self.requests.items())),
+            'generation_seconds': window,
+            'drain_seconds': finished - generated_until,
+        }
+
+
+def _make_image(seed, size=(800, 600)):
+    """Generate a noisy jpeg, different for every seed
+
+    :rtype: bytes
+    """
+    rng = random.Random(seed)
+    gradient = Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size)
+    noise = [Image.effect_noise(size, 30 + 10 * i) for i in range(3)]
+    image = Image.merge('RGB', [Image.blend(gradient, channel, 0.5) for channel in noise])
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Common request handling of the fake services"""
+    service = None
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug('%s: ' + format, self.service, *args)
+
+    @property
+    def services(self):
+        """The shared FakeServices"""
+        return self.server.services
+
+    def _params(self):
+        """Query and form parameters, single values only"""
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            params.update({key: values[-1] for key, values in parse_qs(body).items()})
+        return url.path.rstrip('/'), params
+
+    def _send(self, status, payload, content_type='application/json', headers=None):
+        """Send a response, payload is json encoded unless it is bytes"""
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._dispatch('GET')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        path, params = self._params()
+        try:
+            self.handle_request(method, path, params)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def handle_request(self, method, path, params):
+        """Answer a request, implemented per service"""
+        raise NotImplementedError
+
+
+class _RedditHandler(_Handler):
+    """Fake reddit oauth api, just enough for praw and the bot"""
+    service = 'reddit'
+    ratelimit_headers = {'x-ratelimit-remaining': '590', 'x-ratelimit-used': '10',
+                         'x-ratelimit-reset': '300'}
+
+    def _ok(self, payload):
+        self._send(200, payload, headers=self.ratelimit_headers)
+
+    def handle_request(self, method, path, params):
+        services = self.services
+        if path == '/api/v1/access_token':
+            self._send(200, {'access_token': 'token', 'expires_in': 3600, 'scope': '*',
+                             'token_type': 'bearer'})
+            return
+        if path == '/api/v1/me':
+            self._ok({'name': BOT_NAME, 'id': 'bot'})
+            return
+        replying = path == '/api/comment'
+        services.requests['reddit {} {}'.format(
+            method, '/comments' if path.startswith('/comments/') else path)] += 1
+        fault = services.faults.apply('reddit', ratelimited=replying)
+        if fault == 'error':
+            self._send(503, {'message': 'Service Unavailable', 'error': 503})
+        elif replying:
+            if fault == 'ratelimit':
+                self._ok({'json': {'errors': [
+                    ['RATELIMIT', 'you are doing that too much. try again in 5 seconds.',
+                     'ratelimit']]}})
+                return
+            services.record_reply(params['thing_id'])
+            reply_id = services.new_id()
+            self._ok({'json': {'errors': [], 'data': {'things': [{'kind': 't1', 'data': {
+                'id': reply_id, 'name': 't1_' + reply_id, 'author': BOT_NAME,
+                'body': params.get('text', ''), 'parent_id': params['thing_id'],
+                'link_id': params['thing_id'], 'subreddit': services.subreddit,
+            }}]}}})
+        elif path in ('/r/{}/hot'.format(services.subreddit),
+                      '/r/{}/new'.format(services.subreddit)):
+            self._ok(services.listing(services.submissions, params))
+        elif path in ('/message/inbox', '/message/unread'):
+            self._ok(services.listing(services.inbox, params))
+        elif path.startswith('/comments/'):
+            fullname = 't3_' + path.split('/')[2]
+            if fullname not in services.submissions:
+                self._send(404, {'message': 'Not Found', 'error': 404})
+                return
+            self._ok([{'kind': 'Listing', 'data': {'children': [
+                {'kind': 't3', 'data': services.submissions[fullname]}],
+                'after': None, 'before': None}},
+                      {'kind': 'Listing', 'data': {'children': [], 'after': None,
+                                                   'before': None}}])
+        elif path == '/api/info':
+            things = [{'kind': name[:2], 'data': services.inbox.get(name) or
+                       services.submissions.get(name)}
+                      for name in params.get('id', '').split(',')
+                      if name in services.inbox or name in services.submissions]
+            self._ok({'kind': 'Listing', 'data': {'children': things, 'after': None,
+                                                  'before': None}})
+        elif path.startswith('/user/'):
+            self._ok({'kind': 'Listing', 'data': {'children': [], 'after': None,
+                                                  'before': None}})
+        elif path in ('/api/read_message', '/api/compose', '/api/del'):
+            self._ok({'json': {'errors': []}})
+        else:
+            self._send(404, {'message': 'Not Found', 'error': 404})
+
+
+class _ImgurHandler(_Handler):
+    """Fake imgur api v3, credits and base64 uploads"""
+    service = 'imgur'
+
+    def _credit_headers(self):
+        return {'X-RateLimit-UserLimit': '12500', 'X-RateLimit-UserRemaining': '12000',
+                'X-RateLimit-UserReset': str(int(time.time()) + 3600),
+                'X-RateLimit-ClientLimit': '12500', 'X-RateLimit-ClientRemaining': '12000'}
+
+    def handle_request(self, method, path, params):
+        services = self.services
+        if path == '/3/credits':
+            self._send(200, {'data': {'UserLimit': 12500, 'UserRemaining': 12000,
+                                      'UserReset': int(time.time()) + 3600,
+                                      'ClientLimit': 12500, 'ClientRemaining': 12000},
+                             'success': True, 'status': 200}, headers=self._credit_headers())
+            return
+        if path != '/3/upload' or method != 'POST':
+            self._send(404, {'data': {'error': 'Not found'}, 'success': False, 'status': 404})
+            return
+        services.requests['imgur upload'] += 1
+        fault = services.faults.apply('imgur', ratelimited=True)
+        if fault == 'ratelimit':
+            self._send(429, {'data': {'error': 'Too Many Requests'}, 'success': False,
+                             'status': 429}, headers=self._credit_headers())
+            return
+        if fault == 'error':
+            self._send(500, {'data': {'error': 'Internal error'}, 'success': False,
+                             'status': 500}, headers=self._credit_headers())
+            return
+        image = base64.b64decode(params.get('image', ''))
+        image_id = services.record_upload()
+        extension = 'gif' if image[:3] == b'GIF' else 'png'
+        self._send(200, {'data': {'id': image_id, 'size': len(image), 'link': '{}/{}.{}'.format(
+            services.imgur_url, image_id, extension)}, 'success': True, 'status': 200},
+                   headers=self._credit_headers())
+
+
+class _ImageHandler(_Handler):
+    """Fake image host, serves the generated source images"""
+    service = 'images'
+
+    def handle_request(self, method, path, params):
+        services = self.services
+        services.requests['image download'] += 1
+        if services.faults.apply('images') == 'error':
+            self._send(502, b'Bad Gateway', 'text/plain')
+            return
+        name = path.rsplit('/', 1)[-1]
+        if not path.startswith('/i/') or not name.endswith('.jpg'):
+            self._send(404, b'Not Found', 'text/plain')
+            return
+        try:
+            index = int(name[:-len('.jpg')])
+        except ValueError:
+            self._send(404, b'Not Found', 'text/plain')
+            return
+        self._send(200, services.image(index), 'image/jpeg')
+
+
+@contextmanager
+def _fake_apis(services):
+    """Context manager, point praw and imgurpython at the fake services inside
+
+    The bot imports apidata for its credentials, a module with fake ones is installed instead.
+    """
+    original_apidata = sys.modules.get('apidata')
+    original_api_url = imgurpython.client.API_URL
+    apidata = types.ModuleType('apidata')
+    apidata.reddit = {
+        'client_id': 'loadtest', 'client_secret': 'loadtest', 'username': BOT_NAME,
+        'password': 'loadtest', 'user_agent': 'titletoimagebot loadtest',
+        'oauth_url': services.reddit_url, 'reddit_url': services.reddit_url,
+        'short_url': services.reddit_url, 'check_for_updates': False,
+    }
+    apidata.imgur = {'client_id': 'loadtest', 'client_secret': 'loadtest'}
+    sys.modules['apidata'] = apidata
+    imgurpython.client.API_URL = services.imgur_url + '/'
+    try:
+        yield
+    finally:
+        imgurpython.client.API_URL = original_api_url
+        if original_apidata is None:
+            del sys.modules['apidata']
+        else:
+            sys.modules['apidata'] = original_apidata
+
+
+def _generate(services, rate, mention_rate, duration, seed):
+    """Post submissions and mentions at the target rates for duration seconds
+
+    Arrivals are poisson distributed.
+    """
+    rng = random.Random(seed)
+    total = rate + mention_rate
+    if not total:
+        time.sleep(duration)
+        return
+    end = time.monotonic() + duration
+    next_post = time.monotonic()
+    while True:
+        next_post += rng.expovariate(total)
+        if next_post >= end:
+            break
+        time.sleep(max(0, next_post - time.monotonic()))
+        if rng.random() < rate / total:
+            services.post_submission(rng)
+        else:
+            services.post_mention(rng)
+    time.sleep(max(0, end - time.monotonic()))
+
+
+def _run_bot(bot, mode, limit, interval, errors, stop):
+    """Run a bot like main() does until stop is set, count the errors main() would restart on
+
+    :param errors: error counts by exception name, updated in place
+    :type errors: collections.Counter
+    :param stop: set to stop after the current cycle, the bot must be stopped too in stream
+        mode
+    :type stop: threading.Event
+    """
+    while not stop.is_set():
+        try:
+            if mode == 'stream':
+                bot.run_stream(limit, interval, poll_interval=1)
+            else:
+                bot.run(limit)
+        except (requests.exceptions.ReadTimeout,
+                requests.exceptions.ConnectionError,
+                ResponseException,
+                RequestException) as error:
+            errors[type(error).__name__] += 1
+            logging.debug('Bot restarted after %r', error)
+            continue
+        except Exception as error:  # pylint: disable=broad-except
+            errors['crash:' + type(error).__name__] += 1
+            logging.error('Bot crashed, restarting\n%s', traceback.format_exc().rstrip())
+        stop.wait(interval)
+
+
+def run(args):
+    """Run the load test
+
+    :param args: the parsed command line arguments
+    :type args: argparse.Namespace
+    :returns: the report
+    :rtype: dict
+    """
+    faults = Faults(args.latency / 1000, args.error_rate, args.ratelimit_rate, args.seed)
+    services = FakeServices(faults)
+    services.start()
+    cwd = os.getcwd()
+    font_file = RedditImage.font_file
+    stop = threading.Event()
+    bots = []
+    threads = []
+    workdir = None
+    try:
+        with _fake_apis(services):
+            RedditImage.font_file = os.path.abspath(font_file)
+            # the bots keep their database in the working directory
+            workdir = tempfile.mkdtemp(prefix='titletoimagebot-loadtest-')
+            os.chdir(workdir)
+            logger.info('Fake reddit %s, imgur %s, images %s, database in %s',
+                        services.reddit_url, services.imgur_url, services.image_url, workdir)
+            errors = Counter()
+            bots = [TitleToImageBot(services.subreddit, pipeline=args.pipeline,
+                                    render_processes=args.render_processes,
+                                    worker_id='loadtest-{}'.format(i))
+                    for i in range(args.workers)]
+            started = time.time()
+            generator = threading.Thread(target=_generate, daemon=True, args=(
+                services, args.rate, args.mention_rate, args.duration, args.seed))
+            generator.start()
+            for i, bot in enumerate(bots):
+                thread = threading.Thread(
+                    target=_run_bot, name='bot-{}'.format(i), daemon=True,
+                    args=(bot, args.mode, args.limit, args.interval, errors, stop))
+                thread.start()
+                threads.append(thread)
+            generator.join()
+            generated_until = time.time()
+            logger.info('Stopped posting, waiting %ss for the bot to catch up', args.drain)
+            time.sleep(args.drain)
+            report = services.report(started, generated_until, time.time())
+            report.update(
+                bot_errors=dict(errors),
+                config={key: value for key, value in vars(args).items() if key != 'output'},
+            )
+            return report
+    finally:
+        # let the bots finish their cycle while the services are still up
+        stop.set()
+        for bot in bots:
+            bot.stop()
+        for thread in threads:
+            thread.join(BOT_STOP_TIMEOUT)
+            if thread.is_alive():
+                logger.warning('%s did not stop within %ss', thread.name, BOT_STOP_TIMEOUT)
+        services.stop()
+        RedditImage.font_file = font_file
+        os.chdir(cwd)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    """Main function
+
+    Usage: ./loadtest.py [-h] [-o OUTPUT] [--rate N] [--mention-rate N] [--duration SECONDS]
+                         [--drain SECONDS] [--latency MS] [--error-rate F] [--ratelimit-rate F]
+                         [--mode {run,stream}] [--limit N] [--interval SECONDS]
+                         [--workers N] [--pipeline FETCH RENDER UPLOAD] [--render-processes N]
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='write the report to this json file')
+    parser.add_argument('--rate', help='new submissions per second', type=float, default=1)
+    parser.add_argument('--mention-rate', help='new username mentions per second',
+                        type=float, default=0.2)
+    parser.add_argument('--duration', help='time (in seconds) to post new items', type=float,
+                        default=60)
+    parser.add_argument('--drain', help='time (in seconds) to wait for replies after posting '
+                        'stopped', type=float, default=30)
+    parser.add_argument('--latency', help='mean response delay of every fake service in ms',
+                        type=float, default=50)
+    parser.add_argument('--error-rate', help='fraction of requests failing with a server error',
+                        type=float, default=0.0)
+    parser.add_argument('--ratelimit-rate', help='fraction of replies and uploads failing with '
+                        'a rate-limit error', type=float, default=0.0)
+    parser.add_argument('--seed', help='random seed', type=int, default=0)
+    parser.add_argument('--mode', help='bot run mode', choices=['run', 'stream'], default='run')
+    parser.add_argument('--limit', help='bot limit argument', type=int, default=100)
+    parser.add_argument('--interval', help='bot interval argument', type=int, default=5)
+    parser.add_argument('--workers', help='amount of bots sharing the database', type=int,
+                        default=1)
+    parser.add_argument('--pipeline', help='bot --pipeline argument', type=int, nargs=3,
+                        metavar=('FETCH', 'RENDER', 'UPLOAD'))
+    parser.add_argument('--render-processes', help='bot --render-processes argument', type=int)
+    parser.add_argument('-v', '--verbose', help='log the bot at info level', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(threadName)s %(levelname)s %(message)s',
+                        datefmt='%H:%M:%S', level=logging.INFO if args.verbose else logging.WARNING)
+    logger.setLevel(logging.INFO)
+    output = args.output and os.path.abspath(args.output)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
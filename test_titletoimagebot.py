@@ -0,0 +1,831 @@
+"""Tests of titletoimagebot, offline
+
+Run with 'python -m pytest'. The rendering tests need roboto.ttf in the working directory
+(or DejaVu Sans installed), they are skipped otherwise.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import shared_memory
+
+import imgurpython.client
+import pytest
+from PIL import Image, ImageFont
+
+import benchmark
+import loadtest
+import titletoimagebot
+from titletoimagebot import AnimatedRedditImage, RedditImage
+
+FONT_FILES = ['roboto.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf']
+# a fallback chain, the primary font has no glyphs for FALLBACK_CHARACTERS
+CHAIN_PRIMARY_FILES = ['roboto.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf']
+CHAIN_FALLBACK_FILE = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+FALLBACK_CHARACTERS = '☰☱☲☳'
+
+WORDS = ('the quick brown fox jumps over the lazy dog roses are red violets blue i am a '
+         'title with some longer words like extraordinarily incomprehensible and '
+         'WIDE CAPITAL LETTERS mmmmmmmmmm iiiiiiiiiiii Straße naïve café 1945 (colorized) '
+         '"quoted" -- ... !!! AVAWAVA Ty.Te').split()
+
+TITLES = [
+    '',
+    'a',
+    'Roses are red, violets are blue, this title is long enough to wrap twice or more',
+    'Roses are red; violets are blue. Sugar is sweet, and so are you',
+    'supercalifragilisticexpialidocioussupercalifragilisticexpialidocious word',
+    '   leading and  double   spaces   ',
+    'Boot,,,,;;;; delimiters, everywhere;',
+    'WWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWWW',
+    'Me irl [1080x1920]',
+]
+
+
+@pytest.fixture
+def font(monkeypatch):
+    """Use the first available font file, without fallback fonts"""
+    for font_file in FONT_FILES:
+        if os.path.exists(font_file):
+            monkeypatch.setattr(RedditImage, 'font_file', font_file)
+            monkeypatch.setattr(RedditImage, 'fallback_fonts', ())
+            return font_file
+    pytest.skip('no font file')
+    return None
+
+
+def _title_corpus(count=150, seed=0):
+    """The fixed titles plus random titles with rhyme delimiters"""
+    rng = random.Random(seed)
+    titles = list(TITLES)
+    for _ in range(count):
+        words = []
+        for _ in range(rng.randrange(1, 40)):
+            word = rng.choice(WORDS)
+            if rng.random() < 0.15:
+                word += rng.choice(',;.')
+            words.append(word)
+        titles.append(' '.join(words))
+    return titles
+
+
+def _text_width(font, text):
+    """Width of the rendered text, the right of its bounding box"""
+    return font.getbbox(text)[2]
+
+
+def _reference_wrap(font, width, title):
+    """Line breaking before FontMetrics, measures every candidate line with getbbox"""
+    lines = ['']
+    line_words = []
+    words = title.split()
+    for word in words:
+        line_words.append(word)
+        lines[-1] = ' '.join(line_words)
+        if _text_width(font, lines[-1]) + RedditImage.margin > width:
+            lines[-1] = lines[-1][:-len(word)].strip()
+            lines.append(word)
+            line_words = [word]
+    # remove empty lines
+    return [line for line in lines if line]
+
+
+def _reference_split(font, width, title):
+    """Boot mode line breaking before FontMetrics"""
+    lines = ['']
+    all_delimiters = [',', ';', '.']
+    delimiter = None
+    for character in title:
+        # don't draw ' ' on a new line
+        if character == ' ' and not lines[-1]:
+            continue
+        # add character to current line
+        lines[-1] += character
+        # find delimiter
+        if not delimiter:
+            if character in all_delimiters:
+                delimiter = character
+        # end of line
+        if character == delimiter:
+            lines.append('')
+    # if a line is too long, wrap title instead
+    for line in lines:
+        if _text_width(font, line) + RedditImage.margin > width:
+            return _reference_wrap(font, width, title)
+    # remove empty lines (if delimiter is last character)
+    return [line for line in lines if line]
+
+
+@pytest.mark.parametrize('size', [(500, 500), (640, 480), (1000, 700), (1920, 1080)])
+def test_line_breaks_match_reference(font, size):
+    image = RedditImage(Image.new('RGB', size))
+    width = image._width
+    reference_font = ImageFont.truetype(font, width // RedditImage.font_scale_factor)
+    for title in _title_corpus(seed=width):
+        title = RedditImage.regex_resolution.sub('', title)
+        assert image._wrap_title(title) == _reference_wrap(reference_font, width, title), title
+        assert image._split_title(title) == _reference_split(reference_font, width, title), \
+            title
+
+
+def test_font_metrics_width_matches_getbbox(font):
+    metrics = titletoimagebot._font_metrics(font, 40)
+    reference_font = ImageFont.truetype(font, 40)
+    for title in _title_corpus(count=50):
+        for line in (title, title[:20], title[:1]):
+            width = _text_width(reference_font, line)
+            assert metrics.fits(line, width)
+            assert not line or not metrics.fits(line, width - 1)
+
+
+@pytest.fixture
+def font_chain(monkeypatch):
+    """Use a primary font with one fallback font"""
+    primary = next((name for name in CHAIN_PRIMARY_FILES if os.path.exists(name)), None)
+    if not primary or not os.path.exists(CHAIN_FALLBACK_FILE):
+        pytest.skip('no font files')
+    monkeypatch.setattr(RedditImage, 'font_file', primary)
+    monkeypatch.setattr(RedditImage, 'fallback_fonts', (CHAIN_FALLBACK_FILE,))
+    return primary, CHAIN_FALLBACK_FILE
+
+
+@pytest.mark.parametrize('font_file', [name for name in FONT_FILES + sorted(
+    glob.glob('/usr/share/fonts/truetype/dejavu/*.ttf')) if os.path.exists(name)])
+def test_read_cmap_matches_fonttools(font_file):
+    ttlib = pytest.importorskip('fontTools.ttLib')
+    codepoints = set()
+    for first, last in titletoimagebot._read_cmap(font_file):
+        codepoints.update(range(first, last + 1))
+    reference = {codepoint for codepoint, glyph in ttlib.TTFont(font_file).getBestCmap().items()
+                 if glyph != '.notdef'}
+    assert codepoints == reference
+
+
+def test_font_coverage_runs(font_chain):
+    coverage = titletoimagebot.FontCoverage(font_chain)
+    text = 'ab{} cd{}'.format(FALLBACK_CHARACTERS, FALLBACK_CHARACTERS[0])
+    assert coverage.runs(text) == [(0, 'ab'), (1, FALLBACK_CHARACTERS), (0, ' cd'),
+                                   (1, FALLBACK_CHARACTERS[0])]
+    # characters no font has a glyph for are drawn with the primary font
+    assert coverage.runs('\U000F0000') == [(0, '\U000F0000')]
+    assert coverage.runs('') == []
+
+
+def test_font_chain_measures_with_fallback_font(font_chain):
+    metrics = titletoimagebot._font_metrics(font_chain[0], 40, font_chain[1:])
+    fallback = ImageFont.truetype(font_chain[1], 40)
+    assert metrics.width(FALLBACK_CHARACTERS) == pytest.approx(
+        fallback.getlength(FALLBACK_CHARACTERS))
+    assert metrics.size(FALLBACK_CHARACTERS) == fallback.getbbox(FALLBACK_CHARACTERS)[2:]
+
+
+class _ExactSize:
+    """getbbox of the exact (slow) chain measurement, for _reference_wrap"""
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def getbbox(self, text):
+        return (0, 0) + tuple(self.metrics.size(text))
+
+
+def test_wrap_mixed_script_titles(font_chain):
+    image = RedditImage(Image.new('RGB', (640, 480)))
+    reference_font = _ExactSize(image._metrics)
+    rng = random.Random(0)
+    words = WORDS + [FALLBACK_CHARACTERS, 'mixed' + FALLBACK_CHARACTERS[:2] + 'word']
+    for _ in range(50):
+        title = ' '.join(rng.choice(words) for _ in range(rng.randrange(1, 30)))
+        lines = image._wrap_title(title)
+        assert ' '.join(lines).split() == title.split()
+        assert lines == _reference_wrap(reference_font, image._width, title), title
+
+
+@pytest.mark.parametrize('mode, info, expected', [
+    ('P', {}, 'RGB'),
+    ('P', {'transparency': 0}, 'RGBA'),
+    ('1', {}, 'L'),
+])
+def test_open_large_palette_and_bilevel_images(mode, info, expected):
+    buffer = BytesIO()
+    Image.new(mode, (9000, 6000)).save(buffer, 'PNG', **info)
+    image = RedditImage.open_image(buffer.getvalue())
+    assert image.mode == expected
+    assert image.size == RedditImage.budget_size(9000, 6000)
+
+
+@pytest.mark.parametrize('size', [(400, 20000), (300, 9000), (300, 3000)])
+def test_tall_narrow_images_stay_within_budget(font, size):
+    buffer = BytesIO()
+    Image.new('RGB', size).save(buffer, 'JPEG')
+    decoded = RedditImage.open_image(buffer.getvalue())
+    image = RedditImage(decoded)
+    assert image._image.size == RedditImage.target_size(*size)
+    assert max(image._image.size) <= RedditImage.max_dimension
+    # scaled once, either while decoding or by RedditImage
+    assert decoded.size == size or image._image is decoded
+
+
+def test_bloom_filter():
+    bloom = titletoimagebot.BloomFilter(1000)
+    for i in range(1000):
+        bloom.add('item{}'.format(i))
+    assert all('item{}'.format(i) in bloom for i in range(1000))
+    false_positives = sum('other{}'.format(i) in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_prune_keeps_retries(tmp_path):
+    database = titletoimagebot.Database(str(tmp_path / 'database.db'))
+    for submission_id in ('done', 'retry', 'exhausted', 'new'):
+        database.submission_insert(submission_id, 'author', 'title', 'url')
+    database.submission_set_retry('retry')
+    for _ in range(8):
+        database.submission_set_retry('exhausted')
+    database.message_insert('old message', 'author', 'subject', 'body')
+    with database.transaction():
+        database._sql.execute("UPDATE submissions SET timestamp=datetime('now', '-2 days') "
+                              "WHERE id != 'new'")
+        database._sql.execute("UPDATE messages SET timestamp=datetime('now', '-2 days')")
+    database.message_insert('new message', 'author', 'subject', 'body')
+    assert database.prune(24 * 60 * 60) == (2, 1)
+    assert sorted(database.submission_select_many(['done', 'retry', 'exhausted', 'new'])) == \
+        ['new', 'retry']
+    assert database.message_exists('new message') and not database.message_exists('old message')
+
+
+@pytest.mark.parametrize('retention, age, processed', [
+    (None, 10 * 24 * 60 * 60, True),
+    (7 * 24 * 60 * 60, 10 * 24 * 60 * 60, False),
+    (7 * 24 * 60 * 60, 24 * 60 * 60, True),
+])
+def test_retention_skips_old_submissions(tmp_path, retention, age, processed):
+    bot = object.__new__(titletoimagebot.TitleToImageBot)
+    bot._db = titletoimagebot.Database(str(tmp_path / 'database.db'))
+    bot._retention = retention
+    bot._worker_id = 'worker'
+    bot._lease_duration = 300
+    bot._leases = {}
+    bot._leases_lock = threading.Lock()
+    submission = types.SimpleNamespace(
+        id='id', author=types.SimpleNamespace(name='author'), title='title',
+        url='https://i.example.com/image.png', score=1000, created_utc=time.time() - age,
+        subreddit=types.SimpleNamespace(display_name='pics'))
+    assert bot._prepare_submission(titletoimagebot._Job(submission)) == processed
+    assert bool(bot._db.submission_select('id')) == processed
+
+
+@pytest.mark.parametrize('make, byte_budget, image_format, kind', [
+    (benchmark._make_image, 5 * 1000 * 1000, 'JPEG', 'photo'),
+    # too large at photo_quality
+    (benchmark._make_image, 250 * 1000, 'JPEG', 'photo'),
+    (benchmark._make_graphic, 5 * 1000 * 1000, 'PNG', 'graphic'),
+    # too large as png, fits with 256 colors
+    (benchmark._make_graphic, 50 * 1000, 'PNG', 'graphic'),
+])
+def test_encode_auto(font, monkeypatch, make, byte_budget, image_format, kind):
+    monkeypatch.setattr(RedditImage, 'byte_budget', byte_budget)
+    image = RedditImage(make((800, 600), 0))
+    image.add_title('Roses are red, violets are blue', False)
+    encoded_format, data = image.encode_auto()
+    assert (encoded_format, image.encode_report['kind']) == (image_format, kind)
+    assert len(data) <= byte_budget
+    with Image.open(BytesIO(data)) as result:
+        assert result.format == encoded_format
+        assert result.size == image._image.size
+
+
+def _open_database(filename, start):
+    """Open the database once start is set, in a worker process"""
+    start.wait()
+    titletoimagebot.Database(filename)
+
+
+def test_workers_migrate_database_once(tmp_path):
+    context = multiprocessing.get_context('fork')
+    for attempt in range(5):
+        filename = str(tmp_path / 'database{}.db'.format(attempt))
+        start = context.Event()
+        processes = [context.Process(target=_open_database, args=(filename, start))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        start.set()
+        for process in processes:
+            process.join()
+        assert [process.exitcode for process in processes] == [0] * 4
+        database = titletoimagebot.Database(filename)
+        database._sql.execute('PRAGMA user_version')
+        assert database._sql.fetchone()[0] == len(database._migrations)
+
+
+def test_reclaimed_unfinished_submissions_are_retried(tmp_path):
+    database = titletoimagebot.Database(str(tmp_path / 'database.db'))
+    for submission_id in ('unfinished', 'replied', 'other'):
+        database.submission_insert(submission_id, 'author', 'title', 'url')
+    database.submission_set_imgur_url('replied', 'https://i.imgur.com/replied.jpg')
+    # expired leases of a crashed worker
+    for item_id in ('submission:unfinished', 'submission:replied', 'maintenance:job'):
+        database.lease_acquire(item_id, 'crashed', -1)
+    database.lease_acquire('submission:other', 'alive', 300)
+    reclaimed = database.lease_reclaim()
+    # maintenance leases expire on schedule, they are deleted quietly
+    assert sorted(reclaimed) == [('submission:replied', 'crashed', False),
+                                 ('submission:unfinished', 'crashed', True)]
+    assert [row['id'] for row in database.submission_select_retry(10)] == ['unfinished']
+    assert database.lease_acquire('maintenance:job', 'alive', 300)
+
+
+@pytest.mark.parametrize('mode', ['RGBA', 'L'])
+def test_render_worker_raises_render_errors(monkeypatch, tmp_path, mode):
+    # the pixels of these modes are mapped from shared memory, not copied
+    monkeypatch.setattr(RedditImage, 'font_file', str(tmp_path / 'missing.ttf'))
+    pixels = Image.new(mode, (100, 80)).tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=len(pixels))
+    try:
+        shm.buf[:len(pixels)] = pixels
+        with pytest.raises(OSError):
+            titletoimagebot._render_worker(shm.name, len(pixels), mode, (100, 80), 'title',
+                                           False, '#fff', '#000')
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_process_renderer_replaces_dead_workers(font):
+    renderer = titletoimagebot.ProcessRenderer(1, os.path.abspath(font))
+    try:
+        image = Image.new('RGB', (600, 400))
+        assert renderer.render(image, 'title', False).encode_auto()[1]
+        for process in list(renderer._executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        with pytest.raises(BrokenProcessPool):
+            renderer.render(image, 'title', False)
+        assert renderer.render(image, 'title', False).encode_auto()[1]
+    finally:
+        renderer.shutdown()
+
+
+def test_render_cache_hit_skips_decode(monkeypatch):
+    buffer = BytesIO()
+    Image.new('RGB', (100, 80)).save(buffer, 'PNG')
+    # only the download stage is used, the bot needs no api clients
+    bot = object.__new__(titletoimagebot.TitleToImageBot)
+    bot._render_cache = titletoimagebot.RenderCache()
+    monkeypatch.setattr(bot, '_fetch', lambda url: buffer.getvalue())
+
+    def new_job():
+        job = titletoimagebot._Job(None)
+        job.title = 'title'
+        job.url = 'https://i.example.com/image.png'
+        return job
+
+    job = new_job()
+    assert bot._download_image(job)
+    assert job.cached is None and job.img is not None and job.dhash is not None
+    bot._render_cache.put(job.cache_key, data=b'rendered')
+
+    def decode(data):
+        raise AssertionError('decoded a cached render')
+
+    monkeypatch.setattr(bot, '_decode', decode)
+    job = new_job()
+    assert bot._download_image(job)
+    assert job.cached['data'] == b'rendered' and job.img is None
+
+
+class _ImageHostHandler(BaseHTTPRequestHandler):
+    """An image host with an html page, a missing file and a host sending a byte a second"""
+    def do_GET(self):
+        buffer = BytesIO()
+        Image.new('RGB', (100, 80)).save(buffer, 'PNG')
+        if self.path in ('/page.jpg', '/missing.jpg', '/slow.jpg'):
+            self.server.requested.append(self.path)
+        if self.path == '/page':
+            body, content_type = b'<html></html>', 'text/html'
+        elif self.path == '/page.jpg':
+            body, content_type = buffer.getvalue(), 'image/png'
+        elif self.path == '/slow':
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.end_headers()
+            for byte in buffer.getvalue():
+                self.wfile.write(bytes([byte]))
+                self.wfile.flush()
+                time.sleep(1)
+            return
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_host():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHostHandler)
+    server.daemon_threads = True
+    server.requested = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_deadline(image_host):
+    fetcher = titletoimagebot.ImageFetcher(timeout=(5, 5), deadline=2)
+    start = time.monotonic()
+    with pytest.raises(titletoimagebot.ImageFetchError, match='longer than'):
+        fetcher.fetch('http://127.0.0.1:{}/slow'.format(image_host.server_port))
+    assert time.monotonic() - start < 4
+
+
+@pytest.mark.parametrize('path, loaded', [('page', True), ('missing', False), ('slow', False)])
+def test_download_retries_jpg_only_if_not_an_image(image_host, path, loaded):
+    bot = object.__new__(titletoimagebot.TitleToImageBot)
+    bot._render_cache = titletoimagebot.RenderCache()
+    bot._fetcher = titletoimagebot.ImageFetcher(deadline=2)
+    job = titletoimagebot._Job(None)
+    job.title = 'title'
+    job.url = 'http://127.0.0.1:{}/{}'.format(image_host.server_port, path)
+    assert bot._download_image(job) == loaded
+    assert image_host.requested == (['/page.jpg'] if path == 'page' else [])
+
+
+class _Clock:
+    """Fake monotonic clock, sleeping advances it"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(titletoimagebot.time, 'monotonic', clock)
+    monkeypatch.setattr(titletoimagebot.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_token_bucket_refill(clock):
+    bucket = titletoimagebot.TokenBucket(10, 10)
+    assert bucket.try_acquire(10) == 0
+    assert bucket.try_acquire(1) == pytest.approx(1)
+    clock.now += 0.5
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    assert bucket.acquire(1) == pytest.approx(0.5)
+    clock.now += 100
+    # refills up to capacity only
+    assert bucket.try_acquire(10) == 0
+    assert bucket.wait_time(1) > 0
+
+
+def test_token_bucket_drain(clock):
+    bucket = titletoimagebot.TokenBucket(10, 10)
+    bucket.drain(30)
+    assert bucket.drained_for() == pytest.approx(30)
+    assert bucket.wait_time(1) == pytest.approx(30)
+    # a sync doesn't shorten the drain
+    bucket.sync(100, 1000)
+    assert bucket.drained_for() == pytest.approx(30)
+    clock.now += 30
+    assert bucket.drained_for() == 0
+    # refills from the end of the drain, at the synced rate of 0.1 per second
+    assert bucket.wait_time(1) == pytest.approx(10)
+    clock.now += 10
+    assert bucket.try_acquire(1) == 0
+
+
+def test_token_bucket_sync(clock):
+    bucket = titletoimagebot.TokenBucket(100, 100)
+    # 5 left, spread over the 50 seconds until the reset
+    bucket.sync(5, 50)
+    assert bucket.wait_time(10) == pytest.approx(50)
+    assert bucket.try_acquire(5) == 0
+    assert bucket.wait_time(1) == pytest.approx(10)
+    # full again after the reset, at the default rate
+    clock.now += 50
+    assert bucket.try_acquire(100) == 0
+    assert bucket.wait_time(1) == pytest.approx(1)
+
+
+def test_scheduler_runs_by_priority():
+    scheduler = titletoimagebot.Scheduler(None, None)
+    order = []
+    scheduler.submit(scheduler.PRIORITY_HOT, order.append, 'hot')
+    scheduler.submit(scheduler.PRIORITY_RETRY, order.append, 'retry')
+    scheduler.submit(scheduler.PRIORITY_HOT, order.append, 'hot 2')
+    scheduler.submit(scheduler.PRIORITY_MENTION, lambda: scheduler.submit(
+        scheduler.PRIORITY_MENTION, order.append, 'queued by mention'))
+    scheduler.run_pending()
+    assert order == ['queued by mention', 'retry', 'hot', 'hot 2']
+
+
+@pytest.mark.parametrize('remaining, delay', [(100, 60), (5, 3000)])
+def test_scheduler_imgur_rate_limited(clock, monkeypatch, remaining, delay):
+    monkeypatch.setattr(titletoimagebot.time, 'time', lambda: 1000.0)
+    imgur = types.SimpleNamespace(credits={'UserRemaining': remaining, 'UserReset': 4000})
+    scheduler = titletoimagebot.Scheduler(None, imgur)
+    scheduler.imgur_rate_limited()
+    assert scheduler.imgur_delay() == pytest.approx(delay)
+    # replies are throttled separately
+    assert scheduler.reply_delay() == 0
+    scheduler.replies_rate_limited(120)
+    assert scheduler.reply_delay() == pytest.approx(120)
+
+
+def test_retry_backoff(tmp_path, monkeypatch):
+    monkeypatch.setattr(titletoimagebot.time, 'time', lambda: 1000.0)
+    database = titletoimagebot.Database(str(tmp_path / 'database.db'))
+    database.submission_insert('id', 'author', 'title', 'url')
+    delays = []
+    for _ in range(10):
+        database.submission_set_retry('id')
+        delays.append(database.submission_select('id')['retry_after'] - 1000)
+    assert delays == [60, 120, 240, 480, 960, 1920, 3840, 7680, 15360, 6 * 60 * 60]
+    # rate limits delay the retry further
+    database.submission_clear_retry('id')
+    database.submission_set_retry('id', min_delay=3000)
+    assert database.submission_select('id')['retry_after'] - 1000 == 3000
+    database.submission_set_retry('id', min_delay=30)
+    assert database.submission_select('id')['retry_after'] - 1000 == 120
+
+
+def test_low_imgur_credits_dont_block():
+    imgur = types.SimpleNamespace(credits={'UserRemaining': 5, 'UserReset': time.time() + 3000})
+    scheduler = titletoimagebot.Scheduler(None, imgur)
+    start = time.monotonic()
+    assert scheduler.acquire_imgur() == pytest.approx(3000, abs=5)
+    assert time.monotonic() - start < 1
+    assert scheduler.imgur.wait_time(10) == pytest.approx(3000, abs=5)
+    # enough credits are taken without waiting
+    imgur.credits['UserRemaining'] = 100
+    scheduler = titletoimagebot.Scheduler(None, imgur)
+    assert scheduler.acquire_imgur() == 0
+    assert scheduler.imgur.wait_time(100) > 0
+
+
+class _Submission:
+    """Submission replies are recorded"""
+    def __init__(self, submission_id):
+        self.id = submission_id
+        self.shortlink = 'https://redd.it/' + submission_id
+        self.replies = []
+
+    def reply(self, body):
+        self.replies.append(body)
+
+
+class _Imgur:
+    """Imgur uploads are counted"""
+    def __init__(self):
+        self.credits = {}
+        self.uploads = 0
+
+    def upload_from_bytes(self, contents, config, anon=True):
+        self.uploads += 1
+        return {'link': 'https://i.imgur.com/{}.png'.format(self.uploads)}
+
+
+def test_rate_limited_upload_is_retried_from_cache(font, tmp_path, monkeypatch):
+    buffer = BytesIO()
+    Image.new('RGB', (600, 400), '#48c').save(buffer, 'PNG')
+    bot = object.__new__(titletoimagebot.TitleToImageBot)
+    bot._db = titletoimagebot.Database(str(tmp_path / 'database.db'))
+    bot._render_cache = titletoimagebot.RenderCache()
+    bot._reposts = titletoimagebot.RepostIndex()
+    bot._renderer = None
+    bot._imgur = _Imgur()
+    bot._scheduler = titletoimagebot.Scheduler(
+        types.SimpleNamespace(auth=types.SimpleNamespace(limits={})), bot._imgur)
+    bot._template = '{image_url}{upscaled}{submission_id}'
+    monkeypatch.setattr(bot, '_fetch', lambda url: buffer.getvalue())
+    submission = _Submission('id')
+    bot._db.submission_insert('id', 'author', 'title', 'url')
+
+    def attempt():
+        job = titletoimagebot._Job(submission)
+        job.author, job.title, job.url = 'author', 'title', 'https://i.example.com/image.png'
+        return (bot._download_image(job) and bot._render_image(job) and
+                bot._upload_image(job))
+
+    bot._scheduler.imgur.drain(60)
+    assert not attempt()
+    assert bot._db.submission_select('id')['retry']
+    # the retry uploads the cached render
+    bot._scheduler.imgur = titletoimagebot.TokenBucket(100, 100)
+    assert attempt()
+    assert bot._imgur.uploads == 1 and len(submission.replies) == 1
+    row = bot._db.submission_select('id')
+    assert row['imgur_url'] and not row['retry'] and row['dhash'] is not None
+    # a reply of a cached link keeps the stored hash
+    bot._reply_imgur_url(row['imgur_url'], submission, None)
+    assert bot._db.submission_select('id')['dhash'] == row['dhash']
+
+
+def test_failed_retries_run_out_of_attempts(tmp_path, monkeypatch):
+    bot = object.__new__(titletoimagebot.TitleToImageBot)
+    bot._db = titletoimagebot.Database(str(tmp_path / 'database.db'))
+    bot._reddit = types.SimpleNamespace(submission=lambda id: _Submission(id),
+                                        comment=lambda id: types.SimpleNamespace(
+                                            id=id, body='u/titletoimagebot'))
+    attempts = []
+    # e.g. the download fails, the row is left as it is
+    monkeypatch.setattr(bot, '_process_submission', lambda *args, **kwargs: attempts.append(
+        args))
+    bot._db.submission_insert('id', 'author', 'title', 'url')
+    bot._db.submission_set_retry('id', types.SimpleNamespace(id='comment'))
+    now = [time.time()]
+    monkeypatch.setattr(titletoimagebot.time, 'time', lambda: now[0])
+    while True:
+        # every backoff is over after a day
+        now[0] += 24 * 60 * 60
+        rows = bot._db.submission_select_retry(10)
+        if not rows:
+            break
+        bot._retry_claimed(rows[0])
+        assert len(attempts) < 10
+    assert len(attempts) == 7
+    row = bot._db.submission_select('id')
+    assert row['retry_count'] == 8 and row['retry_source'] == 'comment'
+
+
+class _PipelineBot:
+    """Stage methods that log and take a random time, submission 'fail' raises while preparing"""
+    def __init__(self):
+        self.rng = random.Random(0)
+        self.lock = threading.Lock()
+        self.released = []
+
+    def _stage(self, job, name):
+        with self.lock:
+            delay = self.rng.random() / 100
+        time.sleep(delay)
+        job.log(logging.INFO, '%s %s', name, job.submission)
+        return job.submission % 5 != 0 or name != 'render'
+
+    def _prepare_submission(self, job):
+        if job.submission == 'fail':
+            raise RuntimeError('prepare failed')
+        job.lease = 'submission:{}'.format(job.submission)
+        job.log(logging.INFO, 'prepare %s', job.submission)
+        return job.submission % 7 != 0
+
+    def _download_image(self, job):
+        return self._stage(job, 'download')
+
+    def _render_image(self, job):
+        return self._stage(job, 'render')
+
+    def _upload_image(self, job):
+        return self._stage(job, 'upload')
+
+    def _release_job(self, job):
+        with self.lock:
+            self.released.append(job.lease)
+
+
+def _sequential_log(submission):
+    """Log lines of the sequential path, see _PipelineBot"""
+    lines = ['prepare {}'.format(submission)]
+    if submission % 7:
+        lines += ['download {}'.format(submission), 'render {}'.format(submission)]
+        if submission % 5:
+            lines.append('upload {}'.format(submission))
+    return lines
+
+
+def test_pipeline_logs_in_input_order(caplog):
+    bot = _PipelineBot()
+    caplog.set_level(logging.INFO)
+    titletoimagebot.Pipeline(bot, 3, 2, 3, queue_size=2).run(range(40))
+    assert [record.getMessage() for record in caplog.records] == [
+        line for submission in range(40) for line in _sequential_log(submission)]
+    assert sorted(bot.released) == sorted('submission:{}'.format(i) for i in range(40))
+
+
+def test_pipeline_stops_when_prepare_raises(caplog):
+    bot = _PipelineBot()
+    caplog.set_level(logging.INFO)
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        titletoimagebot.Pipeline(bot, 3, 2, 3, queue_size=2).run([1, 2, 3, 'fail', 4])
+    # the jobs in front of the failure are finished, the stage threads are stopped
+    assert [record.getMessage() for record in caplog.records] == [
+        line for submission in (1, 2, 3) for line in _sequential_log(submission)]
+    # the failed job has no lease yet
+    assert sorted(bot.released, key=str) == [None, 'submission:1', 'submission:2',
+                                             'submission:3']
+    assert threading.active_count() == threads
+
+
+def test_batch_resumes_after_interruption(font, tmp_path, monkeypatch):
+    source, output = tmp_path / 'source', tmp_path / 'output'
+    source.mkdir()
+    names = ['a.png', 'a.jpg', 'b_c.png', 'd.bmp', 'e.png', 'f.jpg']
+    for i, name in enumerate(names):
+        Image.new('RGB', (200 + i, 150), '#48c').save(str(source / name))
+    monkeypatch.setattr(RedditImage, 'font_file', os.path.abspath(font))
+    wait = titletoimagebot.wait
+    calls = []
+
+    def interrupted_wait(*args, **kwargs):
+        calls.append(None)
+        if len(calls) > 2:
+            raise KeyboardInterrupt
+        return wait(*args, **kwargs)
+
+    monkeypatch.setattr(titletoimagebot, 'wait', interrupted_wait)
+    with pytest.raises(KeyboardInterrupt):
+        titletoimagebot.batch(str(source), str(output), workers=1)
+    first = sorted(os.listdir(str(output)))
+    assert 'results.jsonl' in first and len(first) < len(names) + 1
+    monkeypatch.setattr(titletoimagebot, 'wait', wait)
+    rendered, failed = titletoimagebot.batch(str(source), str(output), workers=1)
+    assert failed == 0 and rendered == len(names) + 1 - len(first)
+    assert sorted(os.listdir(str(output))) == sorted(
+        ['results.jsonl'] + [name + '.png' for name in names])
+    with open(str(output / 'results.jsonl')) as results_file:
+        results = [json.loads(line) for line in results_file]
+    # every task is rendered once, the outputs of the interrupted run are kept
+    ids = [result['id'] for result in results]
+    assert len(ids) == len(set(ids)) and set(ids) <= set(names)
+    assert len(ids) >= rendered
+    for result in results:
+        assert result['output'] == str(output / (result['id'] + '.png'))
+
+
+def _titled_animation(frames=12):
+    """A titled animation of 120x80 frames lasting 40 ms each"""
+    data = benchmark._make_animation((120, 80), frames, 0)
+    image = AnimatedRedditImage(AnimatedRedditImage.open_animation(data))
+    image.add_title('Roses are red, violets are blue', False)
+    return image
+
+
+def test_animation_keeps_frames(font):
+    with Image.open(BytesIO(_titled_animation().encode('GIF'))) as result:
+        assert result.n_frames == 12
+        durations = []
+        for index in range(result.n_frames):
+            result.seek(index)
+            durations.append(result.info['duration'])
+    assert durations == [40] * 12
+
+
+@pytest.mark.parametrize('limit, value', [
+    ('max_frames', 11),
+    ('max_duration', 11 * 40),
+    ('max_total_pixels', 11 * 120 * 80),
+])
+def test_animation_limits(font, monkeypatch, limit, value):
+    monkeypatch.setattr(AnimatedRedditImage, limit, value)
+    with pytest.raises(ValueError):
+        _titled_animation().encode('GIF')
+
+
+@pytest.mark.parametrize('mode, pipeline', [('run', None), ('stream', None),
+                                            ('run', [2, 2, 2])])
+def test_workers_reply_once(font, monkeypatch, mode, pipeline):
+    monkeypatch.setattr(RedditImage, 'font_file', os.path.abspath(font))
+    patched = os.getcwd(), sys.modules.get('apidata'), imgurpython.client.API_URL
+    workdirs = os.path.join(tempfile.gettempdir(), 'titletoimagebot-loadtest-*')
+    existing = set(glob.glob(workdirs))
+    args = argparse.Namespace(
+        rate=2, mention_rate=1, duration=6, drain=10, latency=10, error_rate=0,
+        ratelimit_rate=0, seed=0, mode=mode, limit=100, interval=1, workers=3,
+        pipeline=pipeline, render_processes=None, output=None, verbose=False)
+    report = loadtest.run(args)
+    assert report['offered']['mentions'] > 0
+    assert report['missing'] == {'submissions': 0, 'mentions': 0}
+    assert report['duplicate_replies'] == 0
+    # the load test restores what it patched, removes its database and stops its bots
+    assert (os.getcwd(), sys.modules.get('apidata'), imgurpython.client.API_URL) == patched
+    assert set(glob.glob(workdirs)) == existing
+    assert not [thread for thread in threading.enumerate()
+                if thread.name.startswith('bot-') or thread.name == 'heartbeat']
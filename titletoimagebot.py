@@ -6,26 +6,552 @@ __version__ = '0.7.1'
 __author__ = 'gerenook'
 
 import argparse
+import base64
+import bisect
+import csv
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import multiprocessing
+import os
+import queue
 import re
+import socket
 import sqlite3
+import struct
 import sys
+import threading
 import time
+import traceback
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 from logging.handlers import TimedRotatingFileHandler
-from math import ceil
-from os import remove
+from math import ceil, log
+from multiprocessing import shared_memory
 
 import praw
 import requests
+import urllib3
 from imgurpython import ImgurClient
 from imgurpython.helpers.error import (ImgurClientError,
                                        ImgurClientRateLimitError)
-from PIL import Image, ImageDraw, ImageFont
-from prawcore.exceptions import RequestException, ResponseException
+from PIL import GifImagePlugin, Image, ImageChops, ImageDraw, ImageFont
+from prawcore.exceptions import Forbidden, NotFound, RequestException, ResponseException
 
-import apidata
+# praw 7 renamed APIException to RedditAPIException, praw 8 removed the old name
+RedditAPIException = getattr(praw.exceptions, 'RedditAPIException', None) or \
+    praw.exceptions.APIException
+
+
+class Metrics:
+    """Per-stage latency histograms and counters of the bot
+
+    Exported in the Prometheus text format, see :meth:`render`. Besides the totals, the
+    stats of the current cycle are kept for :meth:`cycle_summary`. Thread safe.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._cycle_seconds = {}
+        self._cycle_counters = {}
+        self._cycle_start = time.monotonic()
+
+    @contextmanager
+    def time(self, stage):
+        """Context manager, observe the duration of the block for stage
+
+        The outcome is 'error' if the block raises, else 'ok'.
+
+        :param stage: the stage name (e.g. 'download')
+        :type stage: str
+        """
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.observe(stage, time.perf_counter() - start, outcome)
+
+    def observe(self, stage, seconds, outcome='ok'):
+        """Add a duration to the histogram of stage
+
+        :param stage: the stage name
+        :type stage: str
+        :param seconds: the duration
+        :type seconds: float
+        :param outcome: 'ok' or 'error'
+        :type outcome: str
+        """
+        with self._lock:
+            histogram = self._histograms.get((stage, outcome))
+            if histogram is None:
+                # bucket counts, +Inf count, sum
+                histogram = self._histograms[stage, outcome] = [0] * (len(self.buckets) + 1) + [0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            self._cycle_seconds[stage] = self._cycle_seconds.get(stage, 0) + seconds
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter
+
+        :param name: the counter name (e.g. 'skipped')
+        :type name: str
+        :param amount: the increment
+        :type amount: int
+        :param labels: label values (e.g. reason='score')
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._cycle_counters[key] = self._cycle_counters.get(key, 0) + amount
+
+    def render(self):
+        """Export all metrics
+
+        :returns: metrics in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = ['# TYPE titletoimagebot_stage_seconds histogram']
+        with self._lock:
+            for (stage, outcome), histogram in sorted(self._histograms.items()):
+                labels = 'stage="{}",outcome="{}"'.format(stage, outcome)
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append('titletoimagebot_stage_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, bound, count))
+                lines.append('titletoimagebot_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                    labels, histogram[-2]))
+                lines.append('titletoimagebot_stage_seconds_sum{{{}}} {}'.format(
+                    labels, histogram[-1]))
+                lines.append('titletoimagebot_stage_seconds_count{{{}}} {}'.format(
+                    labels, histogram[-2]))
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                lines.append('# TYPE titletoimagebot_{}_total counter'.format(name))
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter != name:
+                        continue
+                    label_text = ','.join('{}="{}"'.format(key, value)
+                                          for key, value in labels)
+                    lines.append('titletoimagebot_{}_total{} {}'.format(
+                        name, '{' + label_text + '}' if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write :meth:`render` output to path, replacing the file atomically
+
+        :param path: the metrics file (e.g. for the node exporter textfile collector)
+        :type path: str
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temp_path, path)
+
+    def serve(self, port):
+        """Serve :meth:`render` output over http in a daemon thread
+
+        :param port: the tcp port
+        :type port: int
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """GET any path returns the metrics"""
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Send the metrics"""
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Don't log requests"""
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    def start_cycle(self):
+        """Start timing a cycle, so the time between cycles is not part of its summary"""
+        with self._lock:
+            self._cycle_start = time.monotonic()
+
+    def cycle_summary(self):
+        """Summarize the current cycle, its stats are reset
+
+        :returns: e.g. 'took 12.3s | download 4.1s, upload 6.0s | processed 3, skipped[...]'
+        :rtype: str
+        """
+        with self._lock:
+            seconds, self._cycle_seconds = self._cycle_seconds, {}
+            counters, self._cycle_counters = self._cycle_counters, {}
+            start = self._cycle_start
+        stages = ', '.join('{} {:.2f}s'.format(stage, value)
+                           for stage, value in sorted(seconds.items(), key=lambda x: -x[1]))
+        counts = ', '.join('{}{} {}'.format(name, '[{}]'.format(','.join(
+            '{}={}'.format(key, value) for key, value in labels)) if labels else '', value)
+                           for (name, labels), value in sorted(counters.items()))
+        return 'took {:.1f}s | {} | {}'.format(time.monotonic() - start, stages or '-',
+                                                counts or '-')
+
+
+metrics = Metrics()
+
+
+class FontMetrics:
+    """Font with cached glyph advances and kerning, used for line breaking
+
+    Widths are summed per glyph instead of measuring whole strings. Advance widths can differ
+    from the bounding box width ``getbbox`` returns by the side bearings of the outer glyphs,
+    so widths within ``tolerance`` of the limit are measured exactly.
+
+    :param font: the font
+    :type font: PIL.ImageFont.FreeTypeFont
+    """
+    def __init__(self, font):
+        self.font = font
+        self.tolerance = font.size
+        self._advances = {}
+        self._kerning = {}
+
+    def advance(self, character):
+        """Advance width of a single character"""
+        try:
+            return self._advances[character]
+        except KeyError:
+            advance = self._advances[character] = self.font.getlength(character)
+            return advance
+
+    def kerning(self, left, right):
+        """Kerning adjustment between two characters"""
+        try:
+            return self._kerning[left, right]
+        except KeyError:
+            kerning = self._kerning[left, right] = (self.font.getlength(left + right) -
+                                                    self.advance(left) - self.advance(right))
+            return kerning
+
+    def width(self, text, previous=None):
+        """Advance width of text
+
+        :param text: the text to measure
+        :type text: str
+        :param previous: the character in front of text, adds the kerning between the two
+        :type previous: str, NoneType
+        :returns: advance width
+        :rtype: float
+        """
+        width = 0
+        for character in text:
+            width += self.advance(character)
+            if previous is not None:
+                width += self.kerning(previous, character)
+            previous = character
+        return width
+
+    def fits(self, text, max_width, width=None):
+        """Check if the rendered text is at most max_width wide
+
+        :param text: the text to check, or a function building it if width is set. The
+            function is only called if the text has to be measured exactly and the text must
+            not end with whitespace.
+        :type text: str, callable
+        :param max_width: the maximum width
+        :type max_width: int
+        :param width: precomputed advance width of text, computed if None
+        :type width: float, NoneType
+        :rtype: bool
+        """
+        if width is None:
+            width = self.width(text)
+        # trailing whitespace has an advance but no bounding box
+        if callable(text) or not text[-1:].isspace():
+            if width > max_width + self.tolerance:
+                return False
+            if width <= max_width - self.tolerance:
+                return True
+        if callable(text):
+            text = text()
+        return self.size(text)[0] <= max_width
+
+    def size(self, text):
+        """Exact size of the rendered text, the right and bottom of its bounding box
+
+        :rtype: tuple[int, int]
+        """
+        return self.font.getbbox(text)[2:]
+
+    def draw(self, draw, xy, text, fill):
+        """Draw text with its top left corner at xy
+
+        :param draw: the drawing context
+        :type draw: PIL.ImageDraw.ImageDraw
+        """
+        draw.text(xy, text, fill, self.font)
+
+
+def _read_cmap(font_file):
+    """Read the codepoints a font has glyphs for from its cmap table
+
+    Supports the unicode cmap formats 4 (BMP) and 12 (full range), of the first font of a
+    collection.
+
+    :param font_file: the font filename
+    :type font_file: str
+    :returns: sorted, non-overlapping (first, last) codepoint ranges
+    :rtype: list[tuple[int, int]]
+    :raises ValueError: if the font has no supported unicode cmap
+    """
+    with open(font_file, 'rb') as file:
+        data = file.read()
+    offset = 0
+    if data[:4] == b'ttcf':
+        offset, = struct.unpack_from('>I', data, 12)
+    num_tables, = struct.unpack_from('>H', data, offset + 4)
+    for i in range(num_tables):
+        tag, _, cmap, _ = struct.unpack_from('>4sIII', data, offset + 12 + 16 * i)
+        if tag == b'cmap':
+            break
+    else:
+        raise ValueError('{} has no cmap table'.format(font_file))
+    # unicode subtable offsets by format
+    subtables = {}
+    num_subtables, = struct.unpack_from('>H', data, cmap + 2)
+    for i in range(num_subtables):
+        platform_id, encoding_id, subtable = struct.unpack_from('>HHI', data, cmap + 4 + 8 * i)
+        if (platform_id, encoding_id) in ((0, 3), (0, 4), (0, 6), (3, 1), (3, 10)):
+            table_format, = struct.unpack_from('>H', data, cmap + subtable)
+            subtables.setdefault(table_format, cmap + subtable)
+    ranges = []
+    if 12 in subtables:
+        table = subtables[12]
+        num_groups, = struct.unpack_from('>I', data, table + 12)
+        for i in range(num_groups):
+            first, last, glyph = struct.unpack_from('>III', data, table + 16 + 12 * i)
+            # glyph 0 is the missing glyph
+            if not glyph:
+                first += 1
+            if first <= last:
+                ranges.append((first, last))
+    elif 4 in subtables:
+        table = subtables[4]
+        segments = struct.unpack_from('>H', data, table + 6)[0] // 2
+        ends = struct.unpack_from('>{}H'.format(segments), data, table + 14)
+        starts = struct.unpack_from('>{}H'.format(segments), data, table + 16 + 2 * segments)
+        deltas = struct.unpack_from('>{}h'.format(segments), data, table + 16 + 4 * segments)
+        range_offsets_at = table + 16 + 6 * segments
+        range_offsets = struct.unpack_from('>{}H'.format(segments), data, range_offsets_at)
+        for i, (first, last) in enumerate(zip(starts, ends)):
+            if first == 0xFFFF:
+                continue
+            if not range_offsets[i]:
+                # glyph = codepoint + idDelta, the one codepoint mapping to glyph 0 is missing
+                missing = -deltas[i] & 0xFFFF
+                if first <= missing <= last:
+                    ranges.extend(r for r in ((first, missing - 1), (missing + 1, last))
+                                  if r[0] <= r[1])
+                else:
+                    ranges.append((first, last))
+                continue
+            # glyph ids are looked up in glyphIdArray plus idDelta, 0 means missing
+            for codepoint in range(first, last + 1):
+                at = range_offsets_at + 2 * i + range_offsets[i] + 2 * (codepoint - first)
+                glyph = struct.unpack_from('>H', data, at)[0]
+                if glyph and (glyph + deltas[i]) & 0xFFFF:
+                    ranges.append((codepoint, codepoint))
+    else:
+        raise ValueError('{} has no unicode cmap of format 4 or 12'.format(font_file))
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class FontCoverage:
+    """Codepoint -> font index of a font fallback chain
+
+    Built once from the cmap tables, stored as a compact range table. Every codepoint maps to
+    the first font of the chain that has a glyph for it, or to the first font if none has.
+
+    :param font_files: the font filenames, primary font first
+    :type font_files: tuple[str]
+    """
+    def __init__(self, font_files):
+        coverage = [_read_cmap(font_file) for font_file in font_files]
+        # elementary intervals between all range boundaries, resolved by chain order
+        bounds = sorted({bound for ranges in coverage
+                         for first, last in ranges for bound in (first, last + 1)})
+        positions = [0] * len(coverage)
+        self._starts = array('I')
+        self._ends = array('I')
+        self._fonts = array('B')
+        for first, end in zip(bounds, bounds[1:]):
+            font = None
+            for index, ranges in enumerate(coverage):
+                while positions[index] < len(ranges) and ranges[positions[index]][1] < first:
+                    positions[index] += 1
+                if positions[index] < len(ranges) and ranges[positions[index]][0] <= first:
+                    font = index
+                    break
+            if font is None:
+                continue
+            if self._fonts and self._fonts[-1] == font and self._ends[-1] == first - 1:
+                self._ends[-1] = end - 1
+            else:
+                self._starts.append(first)
+                self._ends.append(end - 1)
+                self._fonts.append(font)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._starts)
+
+    def font_index(self, character):
+        """Index of the font to draw character with
+
+        :param character: a single character
+        :type character: str
+        :rtype: int
+        """
+        try:
+            return self._cache[character]
+        except KeyError:
+            codepoint = ord(character)
+            i = bisect.bisect_right(self._starts, codepoint) - 1
+            index = self._fonts[i] if i >= 0 and codepoint <= self._ends[i] else 0
+            self._cache[character] = index
+            return index
+
+    def runs(self, text):
+        """Split text into runs of characters drawn with the same font
+
+        :param text: the text to split
+        :type text: str
+        :returns: (font index, text) tuples
+        :rtype: list[tuple[int, str]]
+        """
+        runs = []
+        current = None
+        start = 0
+        for i, character in enumerate(text):
+            index = self.font_index(character)
+            if index != current:
+                if current is not None:
+                    runs.append((current, text[start:i]))
+                current = index
+                start = i
+        if current is not None:
+            runs.append((current, text[start:]))
+        return runs
+
+
+class FontChainMetrics(FontMetrics):
+    """FontMetrics of a font fallback chain, every character is measured with its own font
+
+    There is no kerning between characters of different fonts. Text is drawn in runs per
+    font, on the baseline of the primary font.
+
+    :param fonts: the fonts, primary font first
+    :type fonts: list[PIL.ImageFont.FreeTypeFont]
+    :param coverage: the coverage index of the fonts
+    :type coverage: FontCoverage
+    """
+    def __init__(self, fonts, coverage):
+        super().__init__(fonts[0])
+        self.fonts = [FontMetrics(font) for font in fonts]
+        self.coverage = coverage
+
+    def advance(self, character):
+        try:
+            return self._advances[character]
+        except KeyError:
+            advance = self._advances[character] = \
+                self.fonts[self.coverage.font_index(character)].advance(character)
+            return advance
+
+    def kerning(self, left, right):
+        try:
+            return self._kerning[left, right]
+        except KeyError:
+            index = self.coverage.font_index(left)
+            if index != self.coverage.font_index(right):
+                kerning = 0
+            else:
+                kerning = self.fonts[index].kerning(left, right)
+            self._kerning[left, right] = kerning
+            return kerning
+
+    def size(self, text):
+        runs = self.coverage.runs(text)
+        if len(runs) < 2:
+            return self.fonts[runs[0][0] if runs else 0].size(text)
+        width = sum(self.fonts[index].font.getlength(run) for index, run in runs[:-1])
+        index, run = runs[-1]
+        last_width, _ = self.fonts[index].size(run)
+        height = max(self.fonts[index].size(run)[1] for index, run in runs)
+        return int(width) + last_width, height
+
+    def draw(self, draw, xy, text, fill):
+        runs = self.coverage.runs(text)
+        if len(runs) == 1 and not runs[0][0]:
+            super().draw(draw, xy, text, fill)
+            return
+        x, y = xy
+        baseline = y + self.font.getmetrics()[0]
+        for index, run in runs:
+            font = self.fonts[index].font
+            draw.text((x, baseline), run, fill, font, anchor='ls')
+            x += font.getlength(run)
+
+
+@lru_cache(maxsize=8)
+def _font_coverage(font_files):
+    """Build the coverage index of a font chain, shared by all font sizes
+
+    :param font_files: the font filenames, primary font first
+    :type font_files: tuple[str]
+    :rtype: FontCoverage
+    """
+    return FontCoverage(font_files)
+
+
+@lru_cache(maxsize=64)
+def _font_metrics(font_file, size, fallback_fonts=()):
+    """Load font and its metrics cache, shared by all images with the same font size
+
+    :param font_file: the font filename
+    :type font_file: str
+    :param size: the font size
+    :type size: int
+    :param fallback_fonts: fonts for the characters font_file has no glyph for, in order
+    :type fallback_fonts: tuple[str]
+    :rtype: FontMetrics
+    """
+    if not fallback_fonts:
+        return FontMetrics(ImageFont.truetype(font_file, size))
+    font_files = (font_file,) + tuple(fallback_fonts)
+    return FontChainMetrics([ImageFont.truetype(name, size) for name in font_files],
+                            _font_coverage(font_files))
 
 
 class RedditImage:
@@ -36,31 +562,147 @@ class RedditImage:
     """
     margin = 10
     min_size = 500
-    # TODO find a font for all unicode chars & emojis
-    # font_file = 'seguiemj.ttf'
+    # output budget, larger images are downscaled before the title is added
+    max_dimension = 4096
+    max_pixels = 12 * 1000 * 1000
+    # images that would still decode to more pixels are rejected
+    max_decode_pixels = 64 * 1000 * 1000
     font_file = 'roboto.ttf'
+    # fonts for characters roboto has no glyph for (e.g. CJK, emoji), in order of preference.
+    # Outline fonts only, bitmap color emoji fonts can't be scaled to the title size.
+    fallback_fonts = ()
     font_scale_factor = 16
+    # output encoder, see encode_auto. Imgur recompresses larger uploads.
+    byte_budget = 5 * 1000 * 1000
+    # 'JPEG' or 'WEBP'
+    photo_format = 'JPEG'
+    photo_quality = 90
+    # lower qualities put visible ringing around the title text
+    photo_min_quality = 80
+    max_encode_passes = 3
+    # images with at most this many colors in the classifier sample are graphics
+    graphic_max_colors = 256
+    # images where this share of the classifier samples equals its right neighbour are graphics
+    graphic_min_flat = 0.5
+    animated = False
+    encode_report = None
     regex_resolution = re.compile(r'\s?\[[0-9]+\s?[xX*×]\s?[0-9]+\]')
 
     def __init__(self, image):
         self._image = image
         self.upscaled = False
+        self.downscaled = False
         width, height = image.size
+        target = self.target_size(width, height)
         # upscale small images
-        if image.size < (self.min_size, self.min_size):
-            if width < height:
-                factor = self.min_size / width
-            else:
-                factor = self.min_size / height
-            self._image = self._image.resize((ceil(width * factor),
-                                              ceil(height * factor)),
-                                             Image.LANCZOS)
+        if target[0] > width:
+            with metrics.time('upscale'):
+                self._image = self._image.resize(target, Image.LANCZOS)
             self.upscaled = True
+        # downscale huge images, usually done by open_image already
+        elif target != (width, height):
+            self._image = self._downscale(self._image)
+            self.downscaled = True
         self._width, self._height = self._image.size
-        self._font_title = ImageFont.truetype(
-            self.font_file,
-            self._width // self.font_scale_factor
-        )
+        self._metrics = _font_metrics(self.font_file, self._width // self.font_scale_factor,
+                                      tuple(self.fallback_fonts))
+        self._header_height = 0
+        self._encoded = {}
+
+    @classmethod
+    def budget_size(cls, width, height):
+        """Size of an image scaled down to fit max_dimension and max_pixels
+
+        :param width: the image width
+        :type width: int
+        :param height: the image height
+        :type height: int
+        :returns: width and height, unchanged if the image fits
+        :rtype: tuple[int, int]
+        """
+        scale = min(1, cls.max_dimension / max(width, height),
+                    (cls.max_pixels / (width * height)) ** 0.5)
+        if scale >= 1:
+            return width, height
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    @classmethod
+    def target_size(cls, width, height):
+        """Size an image is rendered at
+
+        Small images are scaled up so their shorter side is min_size, then every image is
+        clamped to max_dimension and max_pixels. Smaller than the image only if the image
+        exceeds the budget, the size is budget_size then.
+
+        :param width: the image width
+        :type width: int
+        :param height: the image height
+        :type height: int
+        :returns: width and height, unchanged if the image fits and needs no upscaling
+        :rtype: tuple[int, int]
+        """
+        budget = min(cls.max_dimension / max(width, height),
+                     (cls.max_pixels / (width * height)) ** 0.5)
+        scale = min(1, budget)
+        if (width, height) < (cls.min_size, cls.min_size):
+            factor = cls.min_size / min(width, height)
+            if factor < budget:
+                return ceil(width * factor), ceil(height * factor)
+            scale = budget
+        if scale < 1:
+            return cls.budget_size(width, height)
+        return max(width, int(width * scale)), max(height, int(height * scale))
+
+    @classmethod
+    def _downscale(cls, image):
+        """Scale image down to the budget size, with cheap integer reduce() first
+
+        :param image: the decoded image
+        :type image: PIL.Image.Image
+        :rtype: PIL.Image.Image
+        """
+        target = cls.budget_size(*image.size)
+        if target == image.size:
+            return image
+        with metrics.time('downscale'):
+            # reduce() doesn't support bilevel and palette images
+            if image.mode == '1':
+                image = image.convert('L')
+            elif image.mode == 'P':
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            factor = min(image.width // target[0], image.height // target[1])
+            if factor >= 2:
+                image = image.reduce(factor)
+            if image.size != target:
+                image = image.resize(target, Image.LANCZOS)
+        return image
+
+    @classmethod
+    def open_image(cls, data):
+        """Open and decode an image file within the pixel budget
+
+        JPEGs are decoded in draft mode at the smallest DCT scale that is still larger than the
+        budget size, other formats are decoded in full and scaled down afterwards.
+
+        :param data: the image file contents
+        :type data: bytes
+        :returns: the decoded image, at most max_dimension and max_pixels large
+        :rtype: PIL.Image.Image
+        :raises PIL.Image.DecompressionBombError: if the image would decode to more than
+            max_decode_pixels
+        :raises OSError: if the file is not a valid image
+        """
+        image = Image.open(BytesIO(data))
+        target = cls.budget_size(*image.size)
+        if target != image.size and image.format == 'JPEG':
+            image.draft('RGB', target)
+        width, height = image.size
+        if width * height > cls.max_decode_pixels:
+            raise Image.DecompressionBombError(
+                'Image size ({} pixels) exceeds limit of {} pixels'.format(
+                    width * height, cls.max_decode_pixels))
+        image.load()
+        return cls._downscale(image)
 
     def _split_title(self, title):
         """Split title on [',', ';', '.'] into multiple lines
@@ -87,8 +729,9 @@ class RedditImage:
             if character == delimiter:
                 lines.append('')
         # if a line is too long, wrap title instead
+        max_width = self._width - RedditImage.margin
         for line in lines:
-            if self._font_title.getsize(line)[0] + RedditImage.margin > self._width:
+            if line and not self._metrics.fits(line, max_width):
                 return self._wrap_title(title)
         # remove empty lines (if delimiter is last character)
         return [line for line in lines if line]
@@ -96,23 +739,40 @@ class RedditImage:
     def _wrap_title(self, title):
         """Wrap title
 
+        Greedy line breaking, the width of each candidate line is the width of the current
+        line plus the width of the next word.
+
         :param title: the title to wrap
         :type title: str
         :returns: wrapped title
         :rtype: list
         """
-        lines = ['']
+        metrics = self._metrics
+        max_width = self._width - RedditImage.margin
+        space_width = metrics.advance(' ')
+        lines = []
         line_words = []
-        words = title.split()
-        for word in words:
-            line_words.append(word)
-            lines[-1] = ' '.join(line_words)
-            if self._font_title.getsize(lines[-1])[0] + RedditImage.margin > self._width:
-                lines[-1] = lines[-1][:-len(word)].strip()
-                lines.append(word)
+        line_width = 0
+        for word in title.split():
+            if line_words:
+                last = line_words[-1][-1]
+                width = (line_width + metrics.kerning(last, ' ') + space_width +
+                         metrics.width(word, ' '))
+                line = lambda: ' '.join(line_words + [word])  # noqa: E731
+            else:
+                width = metrics.width(word)
+                line = word
+            if metrics.fits(line, max_width, width):
+                line_words.append(word)
+                line_width = width
+            else:
+                if line_words:
+                    lines.append(' '.join(line_words))
                 line_words = [word]
-        # remove empty lines
-        return [line for line in lines if line]
+                line_width = metrics.width(word)
+        if line_words:
+            lines.append(' '.join(line_words))
+        return lines
 
     def add_title(self, title, boot, bg_color='#fff', text_color='#000'):
         """Add title to new whitespace on image
@@ -122,23 +782,167 @@ class RedditImage:
         :param boot: if True, split title on [',', ';', '.'], else wrap text
         :type boot: bool
         """
-        # remove resolution appended to title (e.g. '<title> [1000 x 1000]')
-        title = RedditImage.regex_resolution.sub('', title)
-        line_height = self._font_title.getsize(title)[1] + RedditImage.margin
-        lines = self._split_title(title) if boot else self._wrap_title(title)
-        whitespace_height = (line_height * len(lines)) + RedditImage.margin
-        new = Image.new('RGB', (self._width, self._height + whitespace_height), bg_color)
-        new.paste(self._image, (0, whitespace_height))
-        draw = ImageDraw.Draw(new)
-        for i, line in enumerate(lines):
-            draw.text((RedditImage.margin, i * line_height + RedditImage.margin),
-                      line, text_color, self._font_title)
+        header = self._render_header(title, boot, bg_color, text_color)
+        with metrics.time('draw'):
+            new = Image.new('RGB', (self._width, self._height + header.height), bg_color)
+            new.paste(header)
+            new.paste(self._image, (0, header.height))
         self._width, self._height = new.size
         self._image = new
+        self._header_height = header.height
+        self._encoded = {}
+        self.encode_report = None
+
+    def _render_header(self, title, boot, bg_color, text_color):
+        """Render the title on a strip as wide as the image
+
+        :param title: the title to add
+        :type title: str
+        :param boot: if True, split title on [',', ';', '.'], else wrap text
+        :type boot: bool
+        :returns: the strip, added above the image
+        :rtype: PIL.Image.Image
+        """
+        # remove resolution appended to title (e.g. '<title> [1000 x 1000]')
+        title = RedditImage.regex_resolution.sub('', title)
+        with metrics.time('layout'):
+            line_height = self._metrics.size(title)[1] + RedditImage.margin
+            lines = self._split_title(title) if boot else self._wrap_title(title)
+        with metrics.time('draw'):
+            whitespace_height = (line_height * len(lines)) + RedditImage.margin
+            header = Image.new('RGB', (self._width, whitespace_height), bg_color)
+            draw = ImageDraw.Draw(header)
+            for i, line in enumerate(lines):
+                self._metrics.draw(draw, (RedditImage.margin, i * line_height + RedditImage.margin),
+                                   line, text_color)
+        return header
+
+    def encode(self, image_format='PNG'):
+        """Encode self._image in memory, every format is encoded only once
+
+        :param image_format: the PIL format name (e.g. 'PNG', 'JPEG')
+        :type image_format: str
+        :returns: the encoded image
+        :rtype: bytes
+        """
+        if image_format not in self._encoded:
+            self._encoded[image_format] = self._save(self._image, image_format)
+        return self._encoded[image_format]
+
+    @staticmethod
+    def _save(image, image_format, **params):
+        """Encode image in memory with format specific params (e.g. quality)
+
+        :rtype: bytes
+        """
+        buffer = BytesIO()
+        with metrics.time('encode'):
+            image.save(buffer, image_format, **params)
+        return buffer.getvalue()
+
+    def classify(self):
+        """Classify the image below the title, on a 64x64 nearest neighbour sample
+
+        Graphics (screenshots, comics, memes) have few colors or large flat areas and stay
+        lossless, photos are encoded lossy.
+
+        :returns: 'graphic' or 'photo'
+        :rtype: str
+        """
+        box = (0, self._header_height, self._width, self._height)
+        sample = self._image.resize((64, 64), Image.NEAREST, box=box).convert('RGB')
+        if sample.getcolors(self.graphic_max_colors) is not None:
+            return 'graphic'
+        # samples whose right neighbour has exactly the same color
+        difference = ImageChops.difference(sample.crop((1, 0, 64, 64)),
+                                           sample.crop((0, 0, 63, 64)))
+        flat = difference.point(lambda value: value and 255).convert('L').histogram()[0]
+        return 'graphic' if flat >= self.graphic_min_flat * 63 * 64 else 'photo'
+
+    def _estimate_png_size(self):
+        """Estimate the png size from 4 full width bands of 8 rows
+
+        Png filters and compresses row by row, so full resolution bands compress like the
+        whole image.
+
+        :rtype: int
+        """
+        rows = 8
+        tops = range(0, self._height - rows + 1, max(rows, self._height // 4))[:4]
+        sample = Image.new('RGB', (self._width, rows * len(tops)))
+        for i, top in enumerate(tops):
+            sample.paste(self._image.crop((0, top, self._width, top + rows)), (0, i * rows))
+        return len(self._save(sample, 'PNG')) * self._height // max(1, sample.height)
+
+    def _encode_lossy(self, image_format):
+        """Encode at the highest quality that fits byte_budget
+
+        Tries photo_quality, then photo_min_quality, then bisects in between until
+        max_encode_passes. If photo_min_quality is still too large, that is returned.
+
+        :returns: the encoded image, its quality and the amount of encode passes
+        :rtype: tuple[bytes, int, int]
+        """
+        image = self._image if self._image.mode == 'RGB' else self._image.convert('RGB')
+        high = self.photo_quality
+        data = self._save(image, image_format, quality=high)
+        if len(data) <= self.byte_budget:
+            return data, high, 1
+        low = self.photo_min_quality
+        best = self._save(image, image_format, quality=low)
+        passes = 2
+        while len(best) <= self.byte_budget and passes < self.max_encode_passes and \
+                high - low > 1:
+            quality = (low + high) // 2
+            data = self._save(image, image_format, quality=quality)
+            passes += 1
+            if len(data) <= self.byte_budget:
+                best, low = data, quality
+            else:
+                high = quality
+        return best, low, passes
+
+    def encode_auto(self):
+        """Encode in the format that suits the content, within byte_budget
+
+        Graphics are encoded as png, as a 256 color png if that is too large. Photos and
+        graphics that don't fit are encoded as photo_format, see _encode_lossy. The choice
+        and its cost are stored in encode_report.
+
+        :returns: the PIL format name and the encoded image
+        :rtype: tuple[str, bytes]
+        """
+        if self.encode_report:
+            image_format = self.encode_report['format']
+            return image_format, self._encoded[image_format]
+        start = time.perf_counter()
+        kind = self.classify()
+        report = {'kind': kind, 'quality': None, 'passes': 0}
+        data = None
+        if kind == 'graphic':
+            png = data = self.encode('PNG')
+            report.update(format='PNG', passes=1)
+            if len(data) > self.byte_budget:
+                data = self._save(self._image.quantize(256, Image.FASTOCTREE), 'PNG')
+                report['passes'] += 1
+            png_bytes = len(png)
+        else:
+            png_bytes = self._estimate_png_size()
+        if data is None or len(data) > self.byte_budget:
+            data, quality, passes = self._encode_lossy(self.photo_format)
+            report.update(format=self.photo_format, quality=quality,
+                          passes=report['passes'] + passes)
+        self._encoded[report['format']] = data
+        report.update(bytes=len(data), png_bytes=png_bytes,
+                      seconds=time.perf_counter() - start)
+        self.encode_report = report
+        return report['format'], data
 
     def upload(self, imgur, config):
         """Upload self._image to imgur
 
+        The image is encoded by encode_auto, jpg is only encoded if that upload fails.
+
         :param imgur: the imgur api client
         :type imgur: imgurpython.client.ImgurClient
         :param config: imgur image config
@@ -146,119 +950,1681 @@ class RedditImage:
         :returns: imgur url if upload successful, else None
         :rtype: str, NoneType
         """
-        path_png = 'temp.png'
-        path_jpg = 'temp.jpg'
-        self._image.save(path_png)
-        self._image.save(path_jpg)
+        image_format, data = self.encode_auto()
         try:
-            response = imgur.upload_from_path(path_png, config, anon=False)
+            response = upload_image_bytes(imgur, data, config)
         except ImgurClientError as error:
-            logging.warning('png upload failed, trying jpg | %s', error)
+            if image_format == 'JPEG':
+                logging.error('jpg upload failed, returning | %s', error)
+                return None
+            logging.warning('%s upload failed, trying jpg | %s', image_format.lower(), error)
             try:
-                response = imgur.upload_from_path(path_jpg, config, anon=False)
+                response = upload_image_bytes(imgur, self.encode('JPEG'), config)
             except ImgurClientError as error:
                 logging.error('jpg upload failed, returning | %s', error)
                 return None
-        finally:
-            remove(path_png)
-            remove(path_jpg)
         return response['link']
 
 
+class EncodedImage(RedditImage):
+    """Already rendered and encoded image (e.g. from the render cache)
+
+    Only decoded if another format is needed for upload.
+
+    :param data: the encoded image, usually from encode_auto
+    :type data: bytes
+    :param upscaled: if the source image was upscaled before rendering
+    :type upscaled: bool
+    :param encode_report: encode_report of the rendered image, if it was just encoded
+    :type encode_report: dict, NoneType
+    """
+    # pylint: disable=super-init-not-called
+    def __init__(self, data, upscaled=False, encode_report=None):
+        self._image = None
+        # only the header is read
+        self._format = Image.open(BytesIO(data)).format
+        self._encoded = {self._format: data}
+        self.upscaled = upscaled
+        self.encode_report = encode_report
+
+    def encode(self, image_format='PNG'):
+        if self._image is None and image_format not in self._encoded:
+            self._image = Image.open(BytesIO(self._encoded[self._format])).convert('RGB')
+        return super().encode(image_format)
+
+    def encode_auto(self):
+        return self._format, self._encoded[self._format]
+
+
+class AnimatedRedditImage(RedditImage):
+    """Animated gif with title, one frame at a time
+
+    The title strip is rendered once and pasted on every frame. Frames are decoded, scaled,
+    titled and appended to the gif as they are read, so memory use is that of a single frame
+    (plus the encoded output), not of the whole animation.
+
+    :param image: the opened, not yet loaded animated gif, see :meth:`open_animation`
+    :type image: PIL.GifImagePlugin.GifImageFile
+    :raises ValueError: on encode, if the animation exceeds max_frames, max_duration or
+        max_total_pixels
+    """
+    animated = True
+    # output budget per frame
+    max_dimension = 1024
+    max_pixels = 1000 * 1000
+    # limits of the whole animation, duration in milliseconds
+    max_frames = 500
+    max_duration = 60 * 1000
+    max_total_pixels = 200 * 1000 * 1000
+    # gif readers treat shorter frame durations as 100 ms
+    min_frame_duration = 20
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, image):
+        self._source = image
+        self._image = None
+        self._header = None
+        self._bg_color = '#fff'
+        self.upscaled = False
+        self.downscaled = False
+        width, height = image.size
+        # same scaling as RedditImage, applied to every frame
+        self._frame_size = self.target_size(width, height)
+        self.upscaled = self._frame_size[0] > width
+        self.downscaled = self._frame_size[0] < width
+        self._width, self._height = self._frame_size
+        self._metrics = _font_metrics(self.font_file, self._width // self.font_scale_factor,
+                                      tuple(self.fallback_fonts))
+        self._encoded = {}
+
+    @classmethod
+    def open_animation(cls, data):
+        """Open an animated gif without decoding it
+
+        :param data: the image file contents
+        :type data: bytes
+        :returns: the opened gif, None if data is no animated gif
+        :rtype: PIL.GifImagePlugin.GifImageFile, NoneType
+        :raises PIL.Image.DecompressionBombError: if a frame would decode to more than
+            max_decode_pixels
+        :raises OSError: if the file is not a valid image
+        """
+        image = Image.open(BytesIO(data))
+        if image.format != 'GIF' or not image.is_animated:
+            return None
+        width, height = image.size
+        if width * height > cls.max_decode_pixels:
+            raise Image.DecompressionBombError(
+                'Image size ({} pixels) exceeds limit of {} pixels'.format(
+                    width * height, cls.max_decode_pixels))
+        return image
+
+    def add_title(self, title, boot, bg_color='#fff', text_color='#000'):
+        self._header = self._render_header(title, boot, bg_color, text_color)
+        self._bg_color = bg_color
+        self._height = self._frame_size[1] + self._header.height
+        self._encoded = {}
+
+    def _frames(self):
+        """Decode, scale and title the frames one by one
+
+        :returns: generator of the titled frames and their durations in milliseconds
+        :rtype: generator[tuple[PIL.Image.Image, int]]
+        :raises ValueError: if the animation exceeds the limits
+        """
+        frame_pixels = self._frame_size[0] * self._frame_size[1]
+        duration = 0
+        for index in itertools.count():
+            try:
+                self._source.seek(index)
+            except EOFError:
+                return
+            if index >= self.max_frames:
+                raise ValueError('Animation has more than {} frames'.format(self.max_frames))
+            if (index + 1) * frame_pixels > self.max_total_pixels:
+                raise ValueError('Animation has more than {} pixels'.format(
+                    self.max_total_pixels))
+            frame_duration = max(self._source.info.get('duration') or 100,
+                                 self.min_frame_duration)
+            duration += frame_duration
+            if duration > self.max_duration:
+                raise ValueError('Animation is longer than {} ms'.format(self.max_duration))
+            titled = Image.new('RGB', (self._width, self._height), self._bg_color)
+            titled.paste(self._header)
+            frame = self._source
+            if frame.size != self._frame_size:
+                frame = frame.resize(self._frame_size, Image.LANCZOS)
+            if frame.mode in ('RGBA', 'LA', 'PA') or 'transparency' in frame.info:
+                frame = frame.convert('RGBA')
+                titled.paste(frame, (0, self._header.height), frame)
+            else:
+                titled.paste(frame.convert('RGB'), (0, self._header.height))
+            yield titled, frame_duration
+
+    def encode(self, image_format='GIF'):
+        """Encode the titled animation, gif is the only supported format
+
+        :param image_format: ignored, the animation is always encoded as gif
+        :type image_format: str
+        :returns: the encoded gif
+        :rtype: bytes
+        :raises ValueError: if the animation exceeds the limits
+        """
+        if 'GIF' not in self._encoded:
+            buffer = BytesIO()
+            with metrics.time('encode'):
+                for i, (frame, duration) in enumerate(self._frames()):
+                    frame = frame.quantize(256, Image.FASTOCTREE)
+                    if not i:
+                        header, _ = GifImagePlugin.getheader(
+                            frame, info={'loop': self._source.info.get('loop', 0),
+                                         'duration': duration})
+                        buffer.write(b''.join(header))
+                    # every frame after the first has its own palette
+                    buffer.write(b''.join(GifImagePlugin.getdata(
+                        frame, duration=duration, disposal=1, include_color_table=bool(i))))
+                buffer.write(b';')
+            self._encoded['GIF'] = buffer.getvalue()
+        return self._encoded['GIF']
+
+    def encode_auto(self):
+        return 'GIF', self.encode('GIF')
+
+    def upload(self, imgur, config):
+        """Upload the titled animation to imgur
+
+        :param imgur: the imgur api client
+        :type imgur: imgurpython.client.ImgurClient
+        :param config: imgur image config
+        :type config: dict
+        :returns: imgur url if upload successful, else None
+        :rtype: str, NoneType
+        """
+        try:
+            response = upload_image_bytes(imgur, self.encode('GIF'), config)
+        except ImgurClientError as error:
+            logging.error('gif upload failed, returning | %s', error)
+            return None
+        return response['link']
+
+
+def _render_worker_init(font_file, fallback_fonts=(), photo_format='JPEG'):
+    """Warm up a render process, load the font files before the first render
+
+    :param font_file: the font filename
+    :type font_file: str
+    :param fallback_fonts: see RedditImage.fallback_fonts
+    :type fallback_fonts: tuple[str]
+    :param photo_format: see RedditImage.photo_format
+    :type photo_format: str
+    """
+    RedditImage.font_file = font_file
+    RedditImage.fallback_fonts = fallback_fonts
+    RedditImage.photo_format = photo_format
+    _font_metrics(font_file, RedditImage.min_size // RedditImage.font_scale_factor,
+                  fallback_fonts)
+
+
+def _render_worker(shm_name, length, mode, size, title, boot, bg_color, text_color):
+    """Render an image whose raw pixels are in shared memory, runs in a render process
+
+    :returns: the image encoded by encode_auto, if it was upscaled and the encode report
+    :rtype: tuple[bytes, bool, dict]
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # the segment can be larger than requested (page size)
+    pixels = shm.buf[:length]
+    try:
+        image = RedditImage(Image.frombuffer(mode, size, pixels, 'raw', mode, 0, 1))
+        image.add_title(title, boot, bg_color, text_color)
+        return image.encode_auto()[1], image.upscaled, image.encode_report
+    except Exception as error:
+        # the frames of the traceback reference the image, which references the buffer
+        traceback.clear_frames(error.__traceback__)
+        raise
+    finally:
+        # release the buffer before closing the shared memory, else close() raises
+        image = None
+        pixels.release()
+        shm.close()
+
+
+class ProcessRenderer:
+    """Render images in a pool of processes, so rendering is not limited by the GIL
+
+    Pixels are handed to the workers through shared memory instead of pickling images. The
+    workers return the result encoded by :meth:`RedditImage.encode_auto`. They are started by
+    a fork server, forking the bot while its other threads hold locks could deadlock them. If
+    a worker dies, the pool is replaced, see :meth:`render`.
+
+    :param workers: amount of render processes, None for one per cpu
+    :type workers: int, NoneType
+    :param font_file: font to preload in every worker
+    :type font_file: str
+    :param fallback_fonts: see RedditImage.fallback_fonts
+    :type fallback_fonts: tuple[str]
+    """
+    # modes RedditImage can paste without converting through a palette
+    modes = ('RGB', 'RGBA', 'L')
+
+    def __init__(self, workers=None, font_file=RedditImage.font_file, fallback_fonts=()):
+        self._workers = workers
+        self._initargs = (font_file, tuple(fallback_fonts), RedditImage.photo_format)
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        """Start a new pool of render processes
+
+        :rtype: concurrent.futures.ProcessPoolExecutor
+        """
+        return ProcessPoolExecutor(self._workers, multiprocessing.get_context('forkserver'),
+                                   initializer=_render_worker_init, initargs=self._initargs)
+
+    def render(self, img, title, boot, bg_color='#fff', text_color='#000'):
+        """Add title to img in a worker process
+
+        :param img: the decoded image
+        :type img: PIL.Image.Image
+        :param title: the title to add
+        :type title: str
+        :param boot: if True, split title on [',', ';', '.'], else wrap text
+        :type boot: bool
+        :returns: the rendered image
+        :rtype: EncodedImage
+        :raises BrokenProcessPool: if a render process died (e.g. killed for running out of
+            memory), later renders run in a new pool
+        """
+        if img.mode not in self.modes:
+            img = img.convert('RGB')
+        pixels = img.tobytes()
+        length = len(pixels)
+        shm = shared_memory.SharedMemory(create=True, size=max(length, 1))
+        executor = self._executor
+        try:
+            shm.buf[:length] = pixels
+            del pixels
+            data, upscaled, encode_report = executor.submit(
+                _render_worker, shm.name, length, img.mode, img.size, title, boot, bg_color,
+                text_color
+            ).result()
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            raise
+        finally:
+            shm.close()
+            shm.unlink()
+        return EncodedImage(data, upscaled, encode_report)
+
+    def _replace_executor(self, broken):
+        """Replace the broken pool, unless another thread already did
+
+        :param broken: the pool a render failed in
+        :type broken: concurrent.futures.ProcessPoolExecutor
+        """
+        with self._lock:
+            if self._executor is not broken:
+                return
+            logging.error('Render process died, starting new render processes')
+            self._executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        self._executor.shutdown()
+
+
+class RenderCache:
+    """Bounded cache of rendered images and their imgur links
+
+    Keys are digests of everything that affects the rendered image, see :meth:`key`. The
+    imgur links of the last max_entries renders are kept, the encoded images themselves
+    are evicted least recently used first once they add up to more than max_bytes.
+
+    :param max_entries: maximum amount of cached renders
+    :type max_entries: int
+    :param max_bytes: maximum total size of cached encoded images
+    :type max_bytes: int
+    """
+    def __init__(self, max_entries=4096, max_bytes=64 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image_digest, title, boot, bg_color='#fff', text_color='#000',
+            font_file=RedditImage.font_file, fallback_fonts=()):
+        """Build the cache key of a render
+
+        :param image_digest: hex digest of the source image file
+        :type image_digest: str
+        :param title: the title to add
+        :type title: str
+        :param boot: if the title is split instead of wrapped
+        :type boot: bool
+        :returns: the cache key
+        :rtype: str
+        """
+        title = unicodedata.normalize('NFC', RedditImage.regex_resolution.sub('', title)).strip()
+        parts = [image_digest, title, str(bool(boot)), bg_color.lower(), text_color.lower(),
+                 font_file, ','.join(fallback_fonts), __version__]
+        return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """Look up a render
+
+        :param key: the cache key
+        :type key: str
+        :returns: dict with 'link', 'data', 'upscaled' and 'dhash' (link, data or dhash may
+            be None), None on cache miss
+        :rtype: dict, NoneType
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                metrics.inc('render_cache', result='miss')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc('render_cache', result='hit')
+            return dict(entry)
+
+    def put(self, key, link=None, data=None, upscaled=False, dhash=None):
+        """Add or update a render, None values keep what is already cached
+
+        :param key: the cache key
+        :type key: str
+        :param link: the imgur link
+        :type link: str, NoneType
+        :param data: the encoded image
+        :type data: bytes, NoneType
+        :param upscaled: if the source image was upscaled before rendering
+        :type upscaled: bool
+        :param dhash: difference hash of the source image, a cache hit skips hashing it
+        :type dhash: int, NoneType
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None) or {'link': None, 'data': None,
+                                                     'upscaled': upscaled, 'dhash': None}
+            if link is not None:
+                entry['link'] = link
+            if dhash is not None:
+                entry['dhash'] = dhash
+            if data is not None:
+                self._bytes += len(data) - len(entry['data'] or b'')
+                entry['data'] = data
+            self._entries[key] = entry
+            while len(self._entries) > self._max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted['data'] or b'')
+            for cached in self._entries.values():
+                if self._bytes <= self._max_bytes:
+                    break
+                if cached['data'] is not None:
+                    self._bytes -= len(cached['data'])
+                    cached['data'] = None
+            # entries without link or data are useless
+            if entry['link'] is None and entry['data'] is None:
+                del self._entries[key]
+
+
+def upload_image_bytes(imgur, contents, config):
+    """Upload an encoded image to imgur without writing it to disk
+
+    Same request as ImgurClient.upload_from_path. Uploaders with an upload_from_bytes method
+    (e.g. a local stand-in for imgur) are called directly.
+
+    :param imgur: the imgur api client
+    :type imgur: imgurpython.client.ImgurClient
+    :param contents: the encoded image
+    :type contents: bytes
+    :param config: imgur image config
+    :type config: dict
+    :returns: imgur api response data
+    :rtype: dict
+    """
+    upload = getattr(imgur, 'upload_from_bytes', None)
+    with metrics.time('upload'):
+        if upload:
+            return upload(contents, config, anon=False)
+        data = {
+            'image': base64.b64encode(contents),
+            'type': 'base64',
+        }
+        data.update({meta: config[meta]
+                     for meta in set(imgur.allowed_image_fields).intersection(config.keys())})
+        return imgur.make_request('POST', 'upload', data, False)
+
+
+class RepostIndex:
+    """Index of uploaded renders by perceptual image hash and title, to find reposts
+
+    Images are compared by 64 bit difference hash (dHash). Lookups use multi-index hashing:
+    the hash is split into max_distance + 1 chunks with one table each, two hashes within
+    max_distance bits of each other are equal in at least one chunk. Only the few entries
+    sharing a chunk are compared in full.
+
+    :param max_distance: maximum amount of differing hash bits of a repost
+    :type max_distance: int
+    """
+    def __init__(self, max_distance=4):
+        self._max_distance = max_distance
+        chunks = max_distance + 1
+        bounds = [64 * i // chunks for i in range(chunks + 1)]
+        self._chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._chunks]
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def dhash(image):
+        """Difference hash, one bit per horizontal gradient sign of a 9x8 grayscale thumbnail
+
+        :param image: the image
+        :type image: PIL.Image.Image
+        :rtype: int
+        """
+        pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+        value = 0
+        for row in range(8):
+            for column in range(8):
+                left = pixels[row * 9 + column]
+                value = (value << 1) | (left > pixels[row * 9 + column + 1])
+        return value
+
+    @staticmethod
+    def title_key(title, boot):
+        """Normalize title, so minor differences in case and spacing still match
+
+        :param title: the rendered title
+        :type title: str
+        :param boot: the render mode, renders of the other mode don't match
+        :type boot: bool
+        :rtype: str
+        """
+        title = RedditImage.regex_resolution.sub('', title)
+        title = ' '.join(unicodedata.normalize('NFKC', title).casefold().split())
+        return '{:d}:{}'.format(bool(boot), title)
+
+    def add(self, dhash, title_key, imgur_url):
+        """Add an uploaded render
+
+        :param dhash: difference hash of the source image
+        :type dhash: int
+        :param title_key: the key from :meth:`title_key`
+        :type title_key: str
+        :param imgur_url: the imgur link of the render
+        :type imgur_url: str
+        """
+        entry = (dhash, title_key, imgur_url)
+        with self._lock:
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                table.setdefault((dhash >> shift) & mask, []).append(entry)
+            self._size += 1
+
+    def find(self, dhash, title_key):
+        """Find the closest render of a similar image with the same title
+
+        :param dhash: difference hash of the source image
+        :type dhash: int
+        :param title_key: the key from :meth:`title_key`
+        :type title_key: str
+        :returns: imgur link, None if there is no match
+        :rtype: str, NoneType
+        """
+        best = None
+        best_distance = self._max_distance + 1
+        with self._lock:
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                for other, other_key, imgur_url in table.get((dhash >> shift) & mask, ()):
+                    if other_key != title_key:
+                        continue
+                    distance = bin(dhash ^ other).count('1')
+                    if distance < best_distance:
+                        best, best_distance = imgur_url, distance
+        return best
+
+
+class ImageFetchError(Exception):
+    """Raised if a url cannot be downloaded or does not point to a usable image"""
+
+
+class NotAnImageError(ImageFetchError):
+    """Raised if a url points to something else than an image, like an html page"""
+
+
+class ImageFetcher:
+    """Image downloader
+
+    Uses a pooled keep-alive session with timeouts. Headers and the first bytes of the body are
+    checked before the rest is downloaded, so html pages and oversized files are rejected early.
+
+    :param timeout: connect and read timeout in seconds, of each socket operation
+    :type timeout: tuple[float, float]
+    :param deadline: maximum duration of a whole download in seconds
+    :type deadline: float
+    :param max_bytes: maximum image file size
+    :type max_bytes: int
+    :param pool_size: amount of connections kept alive per host
+    :type pool_size: int
+    """
+    chunk_size = 16 * 1024
+    # magic numbers of the formats we can render
+    signatures = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM')
+    content_types = ('image/', 'application/octet-stream', 'binary/octet-stream')
+
+    def __init__(self, timeout=(5, 15), deadline=60, max_bytes=20 * 1024 * 1024, pool_size=10):
+        self._timeout = timeout
+        self._deadline = deadline
+        self._max_bytes = max_bytes
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = 'titletoimagebot/{}'.format(__version__)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def _check_signature(self, head):
+        """Raise ImageFetchError if head is not the start of a known image format"""
+        if head.startswith(self.signatures):
+            return
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return
+        raise NotAnImageError('Unknown file signature {!r}'.format(head[:12]))
+
+    def _iter_body(self, response):
+        """Yield the body of a streamed response in chunks, as they arrive
+
+        iter_content blocks until a whole chunk arrived, a slow host could delay the deadline
+        check for as long as it takes to send chunk_size bytes.
+        """
+        read1 = getattr(response.raw, 'read1', None)
+        if read1 is None:
+            # urllib3 < 2
+            yield from response.iter_content(self.chunk_size)
+            return
+        while True:
+            chunk = read1(self.chunk_size, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+
+    def fetch(self, url):
+        """Download an image
+
+        :param url: the image url
+        :type url: str
+        :returns: the image file contents
+        :rtype: bytes
+        :raises NotAnImageError: if the url is not an image
+        :raises ImageFetchError: if the download failed
+        """
+        deadline = time.monotonic() + self._deadline
+        try:
+            with self._session.get(url, timeout=self._timeout, stream=True) as response:
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').lower()
+                if content_type and not content_type.startswith(self.content_types):
+                    raise NotAnImageError('Unexpected content type {}'.format(content_type))
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit() and int(length) > self._max_bytes:
+                    raise ImageFetchError('Image too large ({} bytes)'.format(length))
+                data = bytearray()
+                checked = False
+                for chunk in self._iter_body(response):
+                    if time.monotonic() > deadline:
+                        raise ImageFetchError('Download took longer than {}s'.format(
+                            self._deadline))
+                    data += chunk
+                    if len(data) > self._max_bytes:
+                        raise ImageFetchError('Image larger than {} bytes'.format(
+                            self._max_bytes))
+                    if not checked and len(data) >= 12:
+                        self._check_signature(bytes(data[:12]))
+                        checked = True
+                if not checked:
+                    self._check_signature(bytes(data))
+                return bytes(data)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as error:
+            raise ImageFetchError(error) from error
+
+
+class BloomFilter:
+    """Set of strings with false positives but no false negatives, in a fixed size bit array
+
+    :param capacity: expected amount of items, the false positive rate rises above it
+    :type capacity: int
+    :param error_rate: false positive rate at capacity
+    :type error_rate: float
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self._size = ceil(-self.capacity * log(error_rate) / log(2) ** 2)
+        self._hashes = max(1, round(self._size / self.capacity * log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _positions(self, item):
+        """Bit positions of item, by double hashing one digest"""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self._size for i in range(self._hashes)]
+
+    def add(self, item):
+        """Add an item
+
+        :type item: str
+        """
+        positions = self._positions(item)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
 class Database:
     """Database class
 
+    Creates and migrates its own schema and uses WAL journaling. Every mutator runs in a
+    transaction, group several of them with :meth:`transaction` to commit them at once.
+    Safe to share between threads, every query holds the connection lock. Several processes
+    may share the file, transactions take the write lock up front and wait for each other.
+    They must run on the same host, the WAL index is shared memory, so a database on a
+    network filesystem can't be shared between hosts.
+
+    The ids of all submissions and messages are kept in bloom filters, lookups of ids that
+    are not in a filter skip the query. Ids inserted by other processes are not in the
+    filters, the inserts ignore existing ids and report if they inserted.
+
     :param db_filename: database filename
     :type db_filename: str
     """
+    # schema version n is reached by running _migrations[n - 1]
+    _migrations = [
+        '''
+        CREATE TABLE IF NOT EXISTS submissions (
+            id TEXT PRIMARY KEY,
+            author TEXT,
+            title TEXT,
+            url TEXT,
+            imgur_url TEXT,
+            retry INTEGER DEFAULT 0,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            author TEXT,
+            subject TEXT,
+            body TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS submissions_retry ON submissions (id) WHERE retry=1;
+        CREATE INDEX IF NOT EXISTS submissions_timestamp ON submissions (timestamp);
+        CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        ''',
+        '''
+        ALTER TABLE submissions ADD COLUMN retry_count INTEGER DEFAULT 0;
+        ALTER TABLE submissions ADD COLUMN retry_after REAL;
+        ALTER TABLE submissions ADD COLUMN retry_source TEXT;
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS feedback (
+            id TEXT PRIMARY KEY,
+            author TEXT,
+            subject TEXT,
+            body TEXT
+        );
+        ''',
+        '''
+        ALTER TABLE submissions ADD COLUMN dhash INTEGER;
+        ALTER TABLE submissions ADD COLUMN title_key TEXT;
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS leases_expires ON leases (expires);
+        ''',
+    ]
+    _submission_columns = ('id', 'author', 'title', 'url', 'imgur_url', 'retry', 'timestamp',
+                           'retry_count', 'retry_after', 'retry_source', 'dhash', 'title_key')
+    # retry backoff in seconds, doubled on every failed attempt
+    retry_backoff = 60
+    retry_backoff_max = 6 * 60 * 60
+    # stay below SQLITE_MAX_VARIABLE_NUMBER of old sqlite versions
+    _max_variables = 500
+
     def __init__(self, db_filename):
-        self._sql_conn = sqlite3.connect(db_filename)
+        self._sql_conn = sqlite3.connect(db_filename, timeout=30, check_same_thread=False,
+                                         isolation_level=None)
         self._sql = self._sql_conn.cursor()
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._sql.execute('PRAGMA journal_mode=WAL')
+        self._sql.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+        self._seen = {}
+        self._load_seen()
+
+    def _migrate(self):
+        """Create or upgrade the schema
+
+        The version is read under the write lock and every migration commits on its own, so
+        processes starting at the same time run each migration once.
+        """
+        while True:
+            with self.transaction():
+                self._sql.execute('PRAGMA user_version')
+                version = self._sql.fetchone()[0]
+                if version >= len(self._migrations):
+                    return
+                logging.info('Migrating database to version %d', version + 1)
+                for statement in self._migrations[version].split(';'):
+                    if statement.strip():
+                        self._sql.execute(statement)
+                # PRAGMA doesn't support parameters
+                self._sql.execute('PRAGMA user_version={:d}'.format(version + 1))
+
+    def _load_seen(self):
+        """(Re)build the seen-id filters from the submissions and messages tables"""
+        seen = {}
+        with self._lock:
+            for table in ('submissions', 'messages'):
+                self._sql.execute('SELECT COUNT(*) FROM {}'.format(table))
+                # room to grow until the next rebuild
+                seen[table] = BloomFilter(max(100000, 2 * self._sql.fetchone()[0]))
+                for row in self._sql.execute('SELECT id FROM {}'.format(table)):
+                    seen[table].add(row[0])
+            self._seen = seen
+
+    def _maybe_seen(self, table, ids):
+        """Filter ids to those that may be in table, see BloomFilter
+
+        :rtype: list[str]
+        """
+        seen = self._seen[table]
+        return [item_id for item_id in ids if item_id in seen]
+
+    @contextmanager
+    def transaction(self):
+        """Context manager, commit all statements inside at once or roll them back on error
+
+        Transactions can be nested, only the outermost one commits.
+        """
+        with self._lock:
+            if not self._depth:
+                # a deferred transaction can't wait for the write lock of another process
+                self._sql.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self._sql.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if not self._depth:
+                self._sql.execute('COMMIT')
+
+    def _select_in(self, query, ids):
+        """Run query with {} replaced by placeholders for ids, in chunks
+
+        :returns: all result rows
+        :rtype: list[tuple]
+        """
+        ids = list(ids)
+        rows = []
+        with self._lock:
+            for i in range(0, len(ids), self._max_variables):
+                chunk = ids[i:i + self._max_variables]
+                self._sql.execute(query.format(','.join('?' * len(chunk))), chunk)
+                rows.extend(self._sql.fetchall())
+        return rows
+
+    def message_exists(self, message_id):
+        """Check if message exists in messages table
+
+        :param message_id: the message id to check
+        :type message_id: str
+        :returns: True if message was found, else False
+        :rtype: bool
+        """
+        if message_id not in self._seen['messages']:
+            return False
+        with self._lock:
+            self._sql.execute('SELECT EXISTS(SELECT 1 FROM messages WHERE id=? LIMIT 1)',
+                              (message_id,))
+            if self._sql.fetchone()[0]:
+                return True
+            return False
+
+    def message_exists_many(self, message_ids):
+        """Check which messages exist in messages table, in a single query
+
+        :param message_ids: the message ids to check
+        :type message_ids: iterable[str]
+        :returns: the ids that were found
+        :rtype: set[str]
+        """
+        rows = self._select_in('SELECT id FROM messages WHERE id IN ({})',
+                               self._maybe_seen('messages', message_ids))
+        return {row[0] for row in rows}
+
+    def message_insert(self, message_id, author, subject, body):
+        """Insert message into messages table
+
+        :returns: True if inserted, False if the message was inserted before (e.g. by another
+            worker)
+        :rtype: bool
+        """
+        with self.transaction():
+            self._sql.execute('INSERT OR IGNORE INTO messages (id, author, subject, body) '
+                              'VALUES (?, ?, ?, ?)', (message_id, author, subject, body))
+            self._seen['messages'].add(message_id)
+            return self._sql.rowcount > 0
+
+    def message_insert_many(self, messages):
+        """Insert several messages into messages table, in one transaction
+
+        :param messages: (id, author, subject, body) tuples
+        :type messages: iterable[tuple[str, str, str, str]]
+        :returns: ids of the inserted messages, without those inserted before (e.g. by another
+            worker)
+        :rtype: set[str]
+        """
+        inserted = set()
+        with self.transaction():
+            for message in messages:
+                self._sql.execute('INSERT OR IGNORE INTO messages (id, author, subject, body) '
+                                  'VALUES (?, ?, ?, ?)', message)
+                self._seen['messages'].add(message[0])
+                if self._sql.rowcount > 0:
+                    inserted.add(message[0])
+        return inserted
+
+    def _submission_dict(self, row):
+        """Convert a submissions row to a dict"""
+        return dict(zip(self._submission_columns, row))
+
+    def submission_select(self, submission_id):
+        """Select all attributes of submission
+
+        :param submission_id: the submission id
+        :type submission_id: str
+        :returns: query result, None if id not found
+        :rtype: dict, NoneType
+        """
+        if submission_id not in self._seen['submissions']:
+            return None
+        with self._lock:
+            self._sql.execute('SELECT {} FROM submissions WHERE id=?'.format(
+                ', '.join(self._submission_columns)), (submission_id,))
+            result = self._sql.fetchone()
+        if not result:
+            return None
+        return self._submission_dict(result)
+
+    def submission_select_many(self, submission_ids):
+        """Select all attributes of several submissions, in a single query
+
+        :param submission_ids: the submission ids
+        :type submission_ids: iterable[str]
+        :returns: query results by submission id, ids that were not found are missing
+        :rtype: dict[str, dict]
+        """
+        rows = self._select_in('SELECT {} FROM submissions WHERE id IN ({{}})'.format(
+            ', '.join(self._submission_columns)), self._maybe_seen('submissions', submission_ids))
+        return {row[0]: self._submission_dict(row) for row in rows}
+
+    def submission_insert(self, submission_id, author, title, url):
+        """Insert submission into submissions table
+
+        :returns: True if inserted, False if the submission was inserted before (e.g. by another
+            worker)
+        :rtype: bool
+        """
+        with self.transaction():
+            self._sql.execute('INSERT OR IGNORE INTO submissions (id, author, title, url) '
+                              'VALUES (?, ?, ?, ?)', (submission_id, author, title, url))
+            self._seen['submissions'].add(submission_id)
+            return self._sql.rowcount > 0
+
+    def submission_set_retry(self, submission_id, message=None, min_delay=0):
+        """Set retry flag for given submission
+
+        The next attempt is scheduled with exponential backoff. The message id is kept as
+        retry source, so the retry replies to the same comment. The message stays in the
+        messages table, so the inbox doesn't process the mention again before its retry.
+
+        :param submission_id: the submission id to set retry
+        :type submission_id: str
+        :param message: the comment that mentioned the bot, None for top level replies
+        :type message: praw.models.Comment, NoneType
+        :param min_delay: minimum time (in seconds) until the retry, e.g. a rate limit
+        :type min_delay: float
+        """
+        with self.transaction():
+            self._sql.execute('SELECT retry_count FROM submissions WHERE id=?', (submission_id,))
+            result = self._sql.fetchone()
+            retry_count = (result[0] or 0) if result else 0
+            backoff = max(min(self.retry_backoff * 2 ** retry_count, self.retry_backoff_max),
+                          min_delay)
+            self._sql.execute('UPDATE submissions SET retry=1, retry_count=?, retry_after=?, '
+                              'retry_source=? WHERE id=?',
+                              (retry_count + 1, time.time() + backoff,
+                               message.id if message else None, submission_id))
+
+    def submission_clear_retry(self, submission_id):
+        """Clear retry flag for given submission_id
+
+        :param submission_id: the submission id to clear retry
+        :type submission_id: str
+        """
+        with self.transaction():
+            self._sql.execute('UPDATE submissions SET retry=0, retry_count=0, retry_after=NULL, '
+                              'retry_source=NULL WHERE id=?', (submission_id,))
+
+    def submission_select_retry(self, limit, max_attempts=8):
+        """Select submissions whose next retry is due, oldest first
+
+        :param limit: maximum amount of submissions
+        :type limit: int
+        :param max_attempts: submissions that failed this often are not retried anymore
+        :type max_attempts: int
+        :returns: query results
+        :rtype: list[dict]
+        """
+        with self._lock:
+            self._sql.execute('SELECT {} FROM submissions WHERE retry=1 AND retry_count<? AND '
+                              '(retry_after IS NULL OR retry_after<=?) '
+                              'ORDER BY retry_after LIMIT ?'.format(
+                                  ', '.join(self._submission_columns)),
+                              (max_attempts, time.time(), limit))
+            rows = self._sql.fetchall()
+            # rows inserted by other workers are missing from the seen-id filter, add them so
+            # submission_select finds them during the retry
+            for row in rows:
+                self._seen['submissions'].add(row[0])
+        return [self._submission_dict(row) for row in rows]
+
+    def submission_set_imgur_url(self, submission_id, imgur_url, dhash=None, title_key=None):
+        """Set imgur url for given submission
+
+        :param submission_id: the submission id to set imgur url
+        :type submission_id: str
+        :param imgur_url: the imgur url to update
+        :type imgur_url: str
+        :param dhash: difference hash of the source image, see RepostIndex. None keeps the
+            stored hash.
+        :type dhash: int, NoneType
+        :param title_key: boot mode and normalized title of the render, see RepostIndex. None
+            keeps the stored key.
+        :type title_key: str, NoneType
+        """
+        if dhash is not None and dhash >= 1 << 63:
+            # sqlite integers are signed 64 bit
+            dhash -= 1 << 64
+        with self.transaction():
+            self._sql.execute('UPDATE submissions SET imgur_url=?, dhash=COALESCE(?, dhash), '
+                              'title_key=COALESCE(?, title_key) WHERE id=?',
+                              (imgur_url, dhash, title_key, submission_id))
+
+    def submission_select_dhashes(self):
+        """Select the image hashes of all uploaded renders
+
+        :returns: dhash (unsigned), title_key and imgur_url of every submission with all three
+        :rtype: generator[tuple[int, str, str]]
+        """
+        with self._lock:
+            self._sql.execute('SELECT dhash, title_key, imgur_url FROM submissions '
+                              'WHERE dhash IS NOT NULL AND imgur_url IS NOT NULL')
+            rows = self._sql.fetchall()
+        for dhash, title_key, imgur_url in rows:
+            yield dhash % (1 << 64), title_key, imgur_url
+
+    def feedback_insert(self, message_id, author, subject, body):
+        """Queue a feedback message for forwarding"""
+        with self.transaction():
+            self._sql.execute('INSERT OR IGNORE INTO feedback (id, author, subject, body) '
+                              'VALUES (?, ?, ?, ?)', (message_id, author, subject, body))
+
+    def feedback_select(self):
+        """Select all queued feedback messages
+
+        :returns: dicts with id, author, subject and body
+        :rtype: list[dict]
+        """
+        with self._lock:
+            self._sql.execute('SELECT id, author, subject, body FROM feedback ORDER BY rowid')
+            rows = self._sql.fetchall()
+        return [dict(zip(('id', 'author', 'subject', 'body'), row)) for row in rows]
+
+    def feedback_delete(self, message_ids):
+        """Remove forwarded feedback messages from the queue
+
+        :param message_ids: the message ids
+        :type message_ids: iterable[str]
+        """
+        with self.transaction():
+            self._sql.executemany('DELETE FROM feedback WHERE id=?',
+                                  ((message_id,) for message_id in message_ids))
+
+    def prune(self, max_age, max_attempts=8):
+        """Delete submissions and messages older than max_age
+
+        Submissions waiting for a retry are kept, unless they ran out of attempts.
+
+        :param max_age: age in seconds
+        :type max_age: int
+        :param max_attempts: see submission_select_retry
+        :type max_attempts: int
+        :returns: amount of deleted submissions and messages
+        :rtype: tuple[int, int]
+        """
+        cutoff = '-{:d} seconds'.format(int(max_age))
+        with self.transaction():
+            self._sql.execute("DELETE FROM submissions WHERE timestamp < datetime('now', ?) "
+                              'AND (NOT retry OR retry_count >= ?)', (cutoff, max_attempts))
+            submissions = self._sql.rowcount
+            self._sql.execute("DELETE FROM messages WHERE timestamp < datetime('now', ?)",
+                              (cutoff,))
+            messages = self._sql.rowcount
+        return submissions, messages
+
+    def compact(self, min_free=0.25):
+        """Rebuild the seen-id filters, shrink the file if min_free of its pages are unused
+
+        :param min_free: fraction of free pages that triggers a VACUUM
+        :type min_free: float
+        :returns: True if the file was vacuumed
+        :rtype: bool
+        """
+        self._load_seen()
+        with self._lock:
+            self._sql.execute('PRAGMA freelist_count')
+            free = self._sql.fetchone()[0]
+            self._sql.execute('PRAGMA page_count')
+            pages = self._sql.fetchone()[0]
+            vacuum = pages and free / pages >= min_free
+            if vacuum:
+                self._sql.execute('VACUUM')
+            self._sql.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return bool(vacuum)
+
+    def lease_acquire(self, item_id, owner, duration):
+        """Claim an item for owner, unless another owner holds an unexpired lease on it
+
+        Leases of crashed workers expire and are taken over. The owner of a lease may acquire
+        it again, that extends it.
+
+        :param item_id: the item to claim, e.g. 'submission:<id>'
+        :type item_id: str
+        :param owner: unique name of the worker
+        :type owner: str
+        :param duration: lease duration in seconds
+        :type duration: float
+        :returns: True if owner holds the lease now, else False
+        :rtype: bool
+        """
+        now = time.time()
+        with self.transaction():
+            self._sql.execute(
+                'INSERT INTO leases (id, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (id) DO UPDATE SET owner=excluded.owner, expires=excluded.expires '
+                'WHERE leases.owner=excluded.owner OR leases.expires<?',
+                (item_id, owner, now + duration, now))
+            return self._sql.rowcount > 0
+
+    def lease_renew(self, item_ids, owner, duration):
+        """Extend the leases owner still holds (heartbeat)
+
+        :param item_ids: the leased items
+        :type item_ids: iterable[str]
+        :param owner: unique name of the worker
+        :type owner: str
+        :param duration: lease duration in seconds, from now
+        :type duration: float
+        :returns: amount of renewed leases, lower than expected if some were lost
+        :rtype: int
+        """
+        item_ids = list(item_ids)
+        expires = time.time() + duration
+        renewed = 0
+        with self.transaction():
+            for i in range(0, len(item_ids), self._max_variables):
+                chunk = item_ids[i:i + self._max_variables]
+                self._sql.execute('UPDATE leases SET expires=? WHERE owner=? AND id IN ({})'.format(
+                    ','.join('?' * len(chunk))), [expires, owner] + chunk)
+                renewed += self._sql.rowcount
+        return renewed
+
+    def lease_release(self, item_id, owner):
+        """Give up a lease, if owner still holds it
+
+        :param item_id: the leased item
+        :type item_id: str
+        :param owner: unique name of the worker
+        :type owner: str
+        """
+        with self.transaction():
+            self._sql.execute('DELETE FROM leases WHERE id=? AND owner=?', (item_id, owner))
+
+    def lease_reclaim(self):
+        """Delete expired leases, e.g. of crashed workers
+
+        Submissions of expired leases that have no imgur url yet were not finished, they get
+        the retry flag so _queue_retries processes them again. Maintenance leases always
+        expire, they block a job until its next run (see _run_maintenance). They are deleted
+        but not returned. Messages have no leases, their insert claims them.
+
+        :returns: the deleted submission leases as (id, owner, retry) tuples, retry is True if
+            the submission was flagged for retry
+        :rtype: list[tuple[str, str, bool]]
+        """
+        now = time.time()
+        reclaimed = []
+        with self.transaction():
+            self._sql.execute('SELECT id, owner FROM leases WHERE expires<?', (now,))
+            expired = self._sql.fetchall()
+            self._sql.execute('DELETE FROM leases WHERE expires<?', (now,))
+            for item_id, owner in expired:
+                if item_id.startswith('maintenance:'):
+                    continue
+                retry = False
+                if item_id.startswith('submission:'):
+                    self._sql.execute('UPDATE submissions SET retry=1, retry_after=NULL '
+                                      'WHERE id=? AND imgur_url IS NULL AND retry=0',
+                                      (item_id[len('submission:'):],))
+                    retry = self._sql.rowcount > 0
+                reclaimed.append((item_id, owner, retry))
+        return reclaimed
+
+    def state_get(self, key, default=None):
+        """Get a value from the state table
+
+        :param key: the state key
+        :type key: str
+        :param default: returned if key is not set
+        :returns: the stored value
+        :rtype: str
+        """
+        with self._lock:
+            self._sql.execute('SELECT value FROM state WHERE key=?', (key,))
+            result = self._sql.fetchone()
+        return result[0] if result else default
+
+    def state_set(self, key, value):
+        """Set a value in the state table
+
+        :param key: the state key
+        :type key: str
+        :param value: the value to store
+        :type value: str
+        """
+        with self.transaction():
+            self._sql.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                              (key, value))
+
+
+class _Job:
+    """A submission on its way from download to reply
+
+    Log records are emitted right away unless the job is buffered, in which case they are
+    kept until :meth:`flush` so concurrent jobs don't interleave their log lines.
+
+    :param submission: the reddit submission object
+    :type submission: praw.models.Submission
+    :param source_comment: the comment that mentioned the bot
+    :type source_comment: praw.models.Comment, NoneType
+    :param custom_title: if not None, use as title instead of submission title
+    :type custom_title: str, NoneType
+    :param seq: position in the pipeline input, None for unbuffered jobs
+    :type seq: int, NoneType
+    :param known: database rows of the submissions in the same listing, from
+        Database.submission_select_many. None to look up the submission on its own.
+    :type known: dict[str, dict], NoneType
+    :param retry: if True, the job is the retry of a failed submission
+    :type retry: bool
+    """
+    def __init__(self, submission, source_comment=None, custom_title=None, seq=None,
+                 known=None, retry=False):
+        self.submission = submission
+        self.source_comment = source_comment
+        self.custom_title = custom_title
+        self.seq = seq
+        self.known = known
+        self.retry = retry
+        self.author = None
+        self.title = None
+        self.url = None
+        self.boot = False
+        self.img = None
+        self.image = None
+        self.cache_key = None
+        self.cached = None
+        self.dhash = None
+        self.lease = None
+        self._records = None if seq is None else []
+
+    def log(self, level, msg, *args):
+        """Log a message for this job, same signature as logging.log"""
+        if self._records is None:
+            logging.log(level, msg, *args)
+        else:
+            self._records.append((level, msg, args))
+
+    def flush(self):
+        """Emit buffered log records"""
+        for level, msg, args in self._records or ():
+            logging.log(level, msg, *args)
+        self._records = []
+
+
+class Pipeline:
+    """Staged download -> render -> upload pipeline
+
+    Each stage runs in its own pool of threads, connected by bounded queues, so network waits
+    of one submission overlap with rendering of another. Database checks run in the calling
+    thread in input order, exactly like the sequential path.
+
+    :param bot: the bot providing the stage methods
+    :type bot: TitleToImageBot
+    :param fetch_workers: amount of download threads
+    :type fetch_workers: int
+    :param render_workers: amount of render threads
+    :type render_workers: int
+    :param upload_workers: amount of upload/reply threads
+    :type upload_workers: int
+    :param queue_size: maximum amount of jobs waiting between two stages
+    :type queue_size: int
+    """
+    def __init__(self, bot, fetch_workers=4, render_workers=2, upload_workers=4, queue_size=8):
+        self._bot = bot
+        self._workers = (fetch_workers, render_workers, upload_workers)
+        self._queue_size = queue_size
+        self._done = {}
+        self._next_seq = 0
+        self._done_lock = threading.Lock()
+
+    def _finish(self, job):
+        """Mark job as done, flush logs of all finished jobs in input order"""
+        self._bot._release_job(job)
+        with self._done_lock:
+            self._done[job.seq] = job
+            while self._next_seq in self._done:
+                self._done.pop(self._next_seq).flush()
+                self._next_seq += 1
+
+    def _work(self, stage, in_queue, out_queue):
+        """Worker loop, run stage on every job until the None sentinel arrives"""
+        while True:
+            job = in_queue.get()
+            if job is None:
+                return
+            try:
+                passed = stage(job)
+            except Exception:
+                job.log(logging.ERROR, 'Unhandled exception in %s, skipping submission\n%s',
+                        stage.__name__, traceback.format_exc().rstrip())
+                passed = False
+            if passed and out_queue is not None:
+                out_queue.put(job)
+            else:
+                job.img = job.image = None
+                self._finish(job)
+
+    def run(self, submissions, known=None):
+        """Process submissions, return when every submission is done
+
+        :param submissions: the submissions to process
+        :type submissions: iterable[praw.models.Submission]
+        :param known: database rows of the submissions, see _Job
+        :type known: dict[str, dict], NoneType
+        """
+        self._done = {}
+        self._next_seq = 0
+        queues = [queue.Queue(self._queue_size) for _ in range(3)] + [None]
+        stages = [self._bot._download_image, self._bot._render_image, self._bot._upload_image]
+        pools = []
+        for i, (stage, workers) in enumerate(zip(stages, self._workers)):
+            pool = [threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]),
+                                     name='{}-{}'.format(stage.__name__.strip('_'), n),
+                                     daemon=True)
+                    for n in range(workers)]
+            for thread in pool:
+                thread.start()
+            pools.append(pool)
+        try:
+            for seq, submission in enumerate(submissions):
+                job = _Job(submission, seq=seq, known=known)
+                try:
+                    passed = self._bot._prepare_submission(job)
+                except Exception:
+                    self._finish(job)
+                    raise
+                if passed:
+                    queues[0].put(job)
+                else:
+                    self._finish(job)
+        finally:
+            # shut down stage by stage, so every queued job still reaches the end
+            for pool, stage_queue in zip(pools, queues):
+                for _ in pool:
+                    stage_queue.put(None)
+                for thread in pool:
+                    thread.join()
+
+
+class TokenBucket:
+    """Token bucket rate limiter
+
+    Refills at capacity / period tokens per second. :meth:`sync` adjusts the bucket to the
+    quota an api reports, so the remaining quota is spread evenly until it resets.
+    :meth:`drain` empties the bucket until a deadline that later syncs can't shorten.
+
+    :param capacity: maximum amount of tokens (burst size)
+    :type capacity: float
+    :param period: time (in seconds) to refill an empty bucket
+    :type period: float
+    """
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self._default_rate = capacity / period
+        self._rate = self._default_rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._reset_at = None
+        self._drained_until = None
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Add the tokens accumulated since the last update, call with lock held"""
+        now = time.monotonic()
+        if self._drained_until is not None:
+            if now < self._drained_until:
+                self._tokens = 0
+                self._updated = now
+                return
+            # refill from the end of the drain
+            self._updated = max(self._updated, self._drained_until)
+            self._drained_until = None
+        if self._reset_at is not None and now >= self._reset_at:
+            self._reset_at = None
+            self._rate = self._default_rate
+            self._tokens = self.capacity
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def sync(self, remaining, reset_in):
+        """Adjust to the quota reported by an api
+
+        :param remaining: amount of requests/credits left until the quota resets
+        :type remaining: float
+        :param reset_in: time (in seconds) until the quota resets
+        :type reset_in: float
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, remaining)
+            reset_in = max(reset_in, 1)
+            self._rate = remaining / reset_in
+            self._reset_at = time.monotonic() + reset_in
+
+    def drain(self, seconds):
+        """Take all tokens and stop refilling for the given time (e.g. after a 429)
+
+        :param seconds: time (in seconds) without tokens
+        :type seconds: float
+        """
+        with self._lock:
+            self._refill()
+            self._drained_until = max(self._drained_until or 0, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def drained_for(self):
+        """Time (in seconds) until the current drain ends, 0 if the bucket isn't drained
+
+        :rtype: float
+        """
+        with self._lock:
+            if self._drained_until is None:
+                return 0
+            return max(0, self._drained_until - time.monotonic())
+
+    def _wait_time(self, tokens):
+        """Time (in seconds) until tokens are available, 0 if they are, call after _refill"""
+        if self._tokens >= tokens:
+            return 0
+        delay = (tokens - self._tokens) / self._rate if self._rate > 0 else float('inf')
+        if self._reset_at is not None:
+            delay = min(delay, self._reset_at - time.monotonic())
+        if self._drained_until is not None:
+            delay = self._drained_until - time.monotonic()
+        return max(delay, 0.01)
+
+    def wait_time(self, tokens=1):
+        """Time (in seconds) until tokens are available, 0 if they are
+
+        :param tokens: amount of tokens, at most capacity
+        :type tokens: float
+        :rtype: float
+        """
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            return self._wait_time(tokens)
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if enough are available, without waiting
+
+        :param tokens: amount of tokens to take, at most capacity
+        :type tokens: float
+        :returns: 0 if the tokens were taken, else the time (in seconds) until they are
+            available
+        :rtype: float
+        """
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            delay = self._wait_time(tokens)
+            if not delay:
+                self._tokens -= tokens
+            return delay
+
+    def acquire(self, tokens=1):
+        """Take tokens, wait until enough are available
+
+        :param tokens: amount of tokens to take, at most capacity
+        :type tokens: float
+        :returns: time (in seconds) spent waiting
+        :rtype: float
+        """
+        waited = 0
+        while True:
+            delay = self.try_acquire(tokens)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+
+class Scheduler:
+    """Priority work queue with reddit and imgur quota tracking
+
+    Work runs lowest priority value first, in submission order for equal priorities. Before
+    an api call, workers take tokens from the :attr:`reddit` or :attr:`imgur` bucket. The
+    buckets are synced with the rate-limit headers the clients keep. Replies have their own
+    throttle, see :meth:`replies_rate_limited`.
+
+    :param reddit: the reddit instance
+    :type reddit: praw.Reddit
+    :param imgur: the imgur api client
+    :type imgur: imgurpython.client.ImgurClient
+    """
+    PRIORITY_MENTION = 0
+    PRIORITY_RETRY = 1
+    PRIORITY_HOT = 2
+    # reddit allows 600 requests per 10 minutes
+    reddit_capacity = 60
+    reddit_period = 60
+    reddit_window = 10 * 60
+    # imgur allows 12500 credits per day, an upload costs 10
+    imgur_capacity = 500
+    imgur_period = 24 * 60 * 60 * 500 / 12500
+    imgur_upload_cost = 10
+    # pause after a rate-limit error while credits are left
+    imgur_backoff = 60
+    # longer waits for credits are retried later, see acquire_imgur
+    imgur_max_wait = 5
+
+    def __init__(self, reddit, imgur):
+        self._reddit = reddit
+        self._imgur = imgur
+        self.reddit = TokenBucket(self.reddit_capacity, self.reddit_period)
+        self.imgur = TokenBucket(self.imgur_capacity, self.imgur_period)
+        self._replies_until = 0
+        self._queue = []
+        self._counter = itertools.count()
+
+    def submit(self, priority, function, *args, **kwargs):
+        """Queue function(*args, **kwargs)
+
+        :param priority: one of the PRIORITY_* constants
+        :type priority: int
+        :param function: the work to run
+        :type function: callable
+        """
+        heapq.heappush(self._queue, (priority, next(self._counter), function, args, kwargs))
+
+    def run_pending(self):
+        """Run all queued work in priority order, including work queued meanwhile"""
+        while self._queue:
+            _, _, function, args, kwargs = heapq.heappop(self._queue)
+            function(*args, **kwargs)
+
+    def acquire_reddit(self, calls=1):
+        """Wait for reddit quota for the given amount of api calls"""
+        remaining, reset_in = self._reddit_quota()
+        if remaining is not None:
+            self.reddit.sync(remaining, reset_in)
+        waited = self.reddit.acquire(calls)
+        if waited:
+            logging.debug('Waited %.1fs for reddit quota', waited)
+
+    def acquire_imgur(self, credits=imgur_upload_cost):
+        """Wait for imgur quota for the given amount of credits, at most imgur_max_wait
+
+        Credits run low long before the daily quota resets, waiting for them would block
+        the worker and the mentions queued behind it.
 
-    def message_exists(self, message_id):
-        """Check if message exists in messages table
+        :returns: 0 if the credits were taken, else the time (in seconds) until they are
+            available, nothing is taken then
+        :rtype: float
+        """
+        remaining, reset_in = self._imgur_quota()
+        if remaining is not None:
+            self.imgur.sync(remaining, reset_in)
+        delay = self.imgur.wait_time(credits)
+        if delay > self.imgur_max_wait:
+            return delay
+        waited = self.imgur.acquire(credits)
+        if waited:
+            logging.debug('Waited %.1fs for imgur quota', waited)
+        return 0
 
-        :param message_id: the message id to check
-        :type message_id: str
-        :returns: True if message was found, else False
-        :rtype: bool
+    def _reddit_quota(self):
+        """Remaining requests and seconds until reset, from the last reddit response
+
+        praw >= 7.8 only reports the used and remaining requests. The reset is then
+        estimated assuming the used requests were spread evenly over the window so far.
+
+        :rtype: tuple[float, float], tuple[NoneType, NoneType]
         """
-        self._sql.execute('SELECT EXISTS(SELECT 1 FROM messages WHERE id=? LIMIT 1)', (message_id,))
-        if self._sql.fetchone()[0]:
-            return True
-        return False
+        limits = getattr(self._reddit.auth, 'limits', None) or {}
+        remaining = limits.get('remaining')
+        if remaining is None:
+            return None, None
+        reset_timestamp = limits.get('reset_timestamp')
+        if reset_timestamp:
+            return remaining, reset_timestamp - time.time()
+        used = limits.get('used') or 0
+        if remaining + used <= 0:
+            return None, None
+        return remaining, self.reddit_window * remaining / (remaining + used)
 
-    def message_insert(self, message_id, author, subject, body):
-        """Insert message into messages table"""
-        self._sql.execute('INSERT INTO messages (id, author, subject, body) VALUES (?, ?, ?, ?)',
-                          (message_id, author, subject, body))
-        self._sql_conn.commit()
+    def replies_rate_limited(self, seconds):
+        """Stop replies for the given time, call after a RATELIMIT error
 
-    def submission_select(self, submission_id):
-        """Select all attributes of submission
+        Reddit throttles posting per account, other api calls are not affected.
 
-        :param submission_id: the submission id
-        :type submission_id: str
-        :returns: query result, None if id not found
-        :rtype: dict, NoneType
+        :param seconds: time (in seconds) without replies
+        :type seconds: float
         """
-        self._sql.execute('SELECT * FROM submissions WHERE id=?', (submission_id,))
-        result = self._sql.fetchone()
-        if not result:
-            return None
-        return {
-            'id': result[0],
-            'author': result[1],
-            'title': result[2],
-            'url': result[3],
-            'imgur_url': result[4],
-            'retry': result[5],
-            'timestamp': result[6]
-        }
+        self._replies_until = max(self._replies_until, time.monotonic() + seconds)
 
-    def submission_insert(self, submission_id, author, title, url):
-        """Insert submission into submissions table"""
-        self._sql.execute('INSERT INTO submissions (id, author, title, url) VALUES (?, ?, ?, ?)',
-                          (submission_id, author, title, url))
-        self._sql_conn.commit()
+    def reply_delay(self):
+        """Time (in seconds) until replies are allowed again, 0 if they are
 
-    def submission_set_retry(self, submission_id, delete_message=False, message=None):
-        """Set retry flag for given submission, delete message from db if desired
+        :rtype: float
+        """
+        return max(0, self._replies_until - time.monotonic())
 
-        :param submission_id: the submission id to set retry
-        :type submission_id: str
-        :param delete_message: if True, delete message from messages table
-        :type delete_message: bool
-        :param message: the message to delete
-        :type message: praw.models.Comment, NoneType
+    def imgur_rate_limited(self):
+        """Stop imgur uploads, call after a rate-limit error
+
+        Uploads stop until the quota resets if the credits are used up, else for
+        imgur_backoff (e.g. the per ip upload limit).
         """
-        self._sql.execute('UPDATE submissions SET retry=1 WHERE id=?', (submission_id,))
-        if delete_message:
-            if not message:
-                raise TypeError('If delete_message is True, message must be set')
-            self._sql.execute('DELETE FROM messages WHERE id=?', (message.id,))
-        self._sql_conn.commit()
+        remaining, reset_in = self._imgur_quota()
+        if remaining is not None and remaining >= self.imgur_upload_cost:
+            self.imgur.drain(self.imgur_backoff)
+        else:
+            self.imgur.drain(reset_in or 60 * 60)
 
-    def submission_clear_retry(self, submission_id):
-        """Clear retry flag for given submission_id
+    def imgur_delay(self):
+        """Time (in seconds) until uploads are allowed again, 0 if they are
 
-        :param submission_id: the submission id to clear retry
-        :type submission_id: str
+        Uploads stop after rate-limit errors, see :meth:`imgur_rate_limited`.
+
+        :rtype: float
         """
-        self._sql.execute('UPDATE submissions SET retry=0 WHERE id=?', (submission_id,))
-        self._sql_conn.commit()
+        return self.imgur.drained_for()
 
-    def submission_set_imgur_url(self, submission_id, imgur_url):
-        """Set imgur url for given submission
+    def _imgur_quota(self):
+        """Remaining user credits and seconds until reset, from the last imgur response
 
-        :param submission_id: the submission id to set imgur url
-        :type submission_id: str
-        :param imgur_url: the imgur url to update
-        :type imgur_url: str
+        :rtype: tuple[float, float], tuple[NoneType, NoneType]
         """
-        self._sql.execute('UPDATE submissions SET imgur_url=? WHERE id=?',
-                          (imgur_url, submission_id))
-        self._sql_conn.commit()
+        credits = getattr(self._imgur, 'credits', None) or {}
+        try:
+            remaining = float(credits['UserRemaining'])
+            reset_in = float(credits['UserReset']) - time.time()
+        except (KeyError, TypeError, ValueError):
+            return None, None
+        return remaining, reset_in
 
 
 class TitleToImageBot:
@@ -266,12 +2632,84 @@ class TitleToImageBot:
 
     :param subreddit: the subreddit(s) to process, can be concatenated with +
     :type subreddit: str
+    :param pipeline: worker counts (fetch, render, upload) to process submissions with a
+        concurrent :class:`Pipeline`, None to process them one by one (default None)
+    :type pipeline: tuple[int, int, int], NoneType
+    :param metrics_file: if set, write the metrics to this file after every cycle
+    :type metrics_file: str, NoneType
+    :param render_processes: if set, render in a :class:`ProcessRenderer` with this many
+        processes (0 for one per cpu), else render in the calling thread
+    :type render_processes: int, NoneType
+    :param cleanup_interval: time (in seconds) between bad comment removals
+    :type cleanup_interval: int
+    :param feedback_interval: time (in seconds) between feedback forwards
+    :type feedback_interval: int
+    :param worker_id: unique name of this worker among all workers sharing the database,
+        default is hostname:pid
+    :type worker_id: str, NoneType
+    :param lease_duration: time (in seconds) until the claims of a crashed worker expire
+    :type lease_duration: int
+    :param retention: if set, delete submissions and messages older than this (in seconds),
+        and treat older listing items as already processed
+    :type retention: int, NoneType
     """
-    def __init__(self, subreddit):
+    # own comments older than this (in seconds) are not checked for bad scores anymore
+    _cleanup_max_age = 24 * 60 * 60
+    regex_custom_title = re.compile(r'.*u/titletoimagebot\s*["“”](.+)["“”].*', re.IGNORECASE)
+    # short comments that are only marked as read, e.g. 'good bot!'
+    regex_bot_vote = re.compile(r'(?=.{,11}\Z).*(?:good|bad) bot', re.DOTALL)
+    # inbox.mark_read sends this many ids per request
+    _mark_read_batch = 25
+    # time (in seconds) between database prunes, if a retention is set
+    _prune_interval = 6 * 60 * 60
+    # time (in seconds) until a mention of a submission claimed by another worker is retried
+    _claimed_mention_delay = 10
+
+    def __init__(self, subreddit, pipeline=None, metrics_file=None, render_processes=None,
+                 cleanup_interval=600, feedback_interval=300, worker_id=None,
+                 lease_duration=300, retention=None):
+        # imported here, so the rendering classes can be used without api credentials
+        import apidata  # pylint: disable=import-outside-toplevel
         self._db = Database('database.db')
+        self._pipeline = Pipeline(self, *pipeline) if pipeline else None
+        self._fetcher = ImageFetcher(pool_size=max(10, pipeline[0]) if pipeline else 10)
+        self._render_cache = RenderCache()
+        if RedditImage.fallback_fonts:
+            # read the cmaps now, a bad font file fails at startup instead of on a title
+            _font_coverage((RedditImage.font_file,) + tuple(RedditImage.fallback_fonts))
+        self._reposts = RepostIndex()
+        for row in self._db.submission_select_dhashes():
+            self._reposts.add(*row)
+        self._metrics_file = metrics_file
+        self._user = None
+        self._worker_id = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._lease_duration = lease_duration
+        self._retention = retention
+        # leased item id -> nesting depth
+        self._leases = {}
+        self._leases_lock = threading.Lock()
+        self._stopped = threading.Event()
+        # (due time, comment, custom title) of mentions waiting for a claimed submission
+        self._deferred_mentions = []
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='heartbeat',
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+        # [interval, next run, function]
+        self._maintenance = [
+            [cleanup_interval, 0, self._remove_bad_comments],
+            [feedback_interval, 0, self._forward_feedback],
+            [lease_duration, 0, self._reclaim_leases],
+        ]
+        if retention:
+            self._maintenance.append([self._prune_interval, 0, self._prune_database])
+        self._renderer = None
+        if render_processes is not None:
+            self._renderer = ProcessRenderer(render_processes or None, RedditImage.font_file,
+                                             RedditImage.fallback_fonts)
         self._reddit = praw.Reddit(**apidata.reddit)
         self._subreddit = self._reddit.subreddit(subreddit)
         self._imgur = ImgurClient(**apidata.imgur)
+        self._scheduler = Scheduler(self._reddit, self._imgur)
         self._template = (
             '[Image with added title]({image_url})\n\n'
             '{upscaled}---\n\n'
@@ -281,40 +2719,83 @@ class TitleToImageBot:
             '[source](https://github.com/gerenook/titletoimagebot)'
         )
 
-    def _reply_imgur_url(self, url, submission, source_comment, upscaled=False):
+    def _reply_imgur_url(self, url, submission, source_comment, upscaled=False, job=None):
         """doc todo
 
+        Stores url in the database together with the retry flag in one transaction.
+
         :param url: -
         :type url: str
         :param submission: -
         :type submission: -
         :param source_comment: -
         :type source_comment: -
+        :param job: if set, log through the job instead of the root logger
+        :type job: _Job, NoneType
         :returns: True on success, False on failure
         :rtype: bool
         """
-        logging.debug('Creating reply')
+        log = job.log if job else logging.log
+        repost_key = self._repost_key(job) if job and job.dhash is not None else (None, None)
+        log(logging.DEBUG, 'Creating reply')
         reply = self._template.format(
             image_url=url,
             upscaled=' (image was upscaled)\n\n' if upscaled else '',
             submission_id=submission.id
         )
+        delay = self._scheduler.reply_delay()
+        if delay:
+            log(logging.INFO, 'Replies are rate limited for %.0fs, setting retry flag in database',
+                delay)
+            metrics.inc('retries', reason='reddit')
+            with self._db.transaction():
+                self._db.submission_set_imgur_url(submission.id, url, *repost_key)
+                self._db.submission_set_retry(submission.id, source_comment, delay)
+            return False
+        self._scheduler.acquire_reddit()
         try:
-            if source_comment:
-                source_comment.reply(reply)
-            else:
-                submission.reply(reply)
-        except praw.exceptions.APIException as error:
-            logging.error('Reddit api error, setting retry flag in database | %s', error)
-            self._db.submission_set_retry(submission.id, bool(source_comment), source_comment)
+            with metrics.time('reply'):
+                if source_comment:
+                    source_comment.reply(reply)
+                else:
+                    submission.reply(reply)
+        except RedditAPIException as error:
+            log(logging.ERROR, 'Reddit api error, setting retry flag in database | %s', error)
+            metrics.inc('retries', reason='reddit')
+            # praw >= 7 collects all errors of the response in items
+            for item in getattr(error, 'items', None) or [error]:
+                if item.error_type == 'RATELIMIT':
+                    self._scheduler.replies_rate_limited(self._ratelimit_seconds(item.message))
+            with self._db.transaction():
+                self._db.submission_set_imgur_url(submission.id, url, *repost_key)
+                self._db.submission_set_retry(submission.id, source_comment,
+                                              self._scheduler.reply_delay())
             return False
         except Exception as error:
-            logging.error('Cannot reply, skipping submission | %s', error)
+            log(logging.ERROR, 'Cannot reply, skipping submission | %s', error)
+            self._db.submission_set_imgur_url(submission.id, url, *repost_key)
             return False
-        self._db.submission_clear_retry(submission.id)
+        with self._db.transaction():
+            self._db.submission_set_imgur_url(submission.id, url, *repost_key)
+            self._db.submission_clear_retry(submission.id)
         return True
 
-    def _process_submission(self, submission, source_comment=None, custom_title=None):
+    @staticmethod
+    def _ratelimit_seconds(message):
+        """Wait time of a RATELIMIT error, e.g. 'Take a break for 5 minutes before trying again'
+
+        :param message: the error message
+        :type message: str
+        :returns: the wait time (in seconds), 60 if the message has none
+        :rtype: int
+        """
+        match = re.search(r'(\d+) (second|minute)', message or '')
+        if not match:
+            return 60
+        return int(match.group(1)) * (60 if match.group(2) == 'minute' else 1)
+
+    def _process_submission(self, submission, source_comment=None, custom_title=None,
+                            known=None, retry=False):
         """Generate new image with added title and author, upload to imgur, reply to submission
 
         :param submission: the reddit submission object
@@ -324,179 +2805,1002 @@ class TitleToImageBot:
         :type source_comment: praw.models.Comment, NoneType
         :param custom_title: if not None, use as title instead of submission title
         :type custom_title: str
+        :param known: database rows of the submissions in the same listing, see _Job
+        :type known: dict[str, dict], NoneType
+        :param retry: if True, this is the retry of a failed submission, see _queue_retries
+        :type retry: bool
+        """
+        job = _Job(submission, source_comment, custom_title, known=known, retry=retry)
+        try:
+            if not self._prepare_submission(job):
+                return
+            if not self._download_image(job):
+                return
+            if not self._render_image(job):
+                return
+            self._upload_image(job)
+        finally:
+            self._release_job(job)
+
+    def _acquire(self, item_id):
+        """Claim an item for this worker, see Database.lease_acquire
+
+        Claims are reentrant, every successful call needs a matching :meth:`_release`.
+
+        :param item_id: the item to claim, e.g. 'submission:<id>'
+        :type item_id: str
+        :returns: True if claimed, False if another worker holds it
+        :rtype: bool
+        """
+        with self._leases_lock:
+            if item_id in self._leases:
+                self._leases[item_id] += 1
+                return True
+            if not self._db.lease_acquire(item_id, self._worker_id, self._lease_duration):
+                return False
+            self._leases[item_id] = 1
+            return True
+
+    def _release(self, item_id):
+        """Release a claim made with :meth:`_acquire`
+
+        :param item_id: the claimed item
+        :type item_id: str
+        """
+        with self._leases_lock:
+            self._leases[item_id] -= 1
+            if not self._leases[item_id]:
+                del self._leases[item_id]
+                self._db.lease_release(item_id, self._worker_id)
+
+    def _release_job(self, job):
+        """Release the claim of a job, if any
+
+        :param job: the submission job
+        :type job: _Job
         """
-        # TODO really need to clean this method up
+        if job.lease:
+            self._release(job.lease)
+            job.lease = None
+
+    def _heartbeat(self):
+        """Renew the claims of this worker until it is stopped"""
+        while not self._stopped.wait(self._lease_duration / 3):
+            with self._leases_lock:
+                leases = list(self._leases)
+            if not leases:
+                continue
+            try:
+                renewed = self._db.lease_renew(leases, self._worker_id, self._lease_duration)
+            except sqlite3.Error as error:
+                logging.error('Cannot renew leases | %s', error)
+                continue
+            if renewed < len(leases):
+                logging.warning('Lost %d of %d leases, they expired before renewal',
+                                len(leases) - renewed, len(leases))
+
+    def _reclaim_leases(self):
+        """Remove expired claims, e.g. of crashed workers, and retry their unfinished work"""
+        for item_id, owner, retry in self._db.lease_reclaim():
+            logging.warning('Reclaimed expired lease %s of worker %s%s', item_id, owner,
+                            ', unfinished submission queued for retry' if retry else '')
+            metrics.inc('leases_reclaimed')
+            if retry:
+                metrics.inc('retries', reason='reclaimed')
+
+    def _prune_database(self):
+        """Delete submissions and messages older than the retention period, shrink the file"""
+        with metrics.time('db'):
+            submissions, messages = self._db.prune(self._retention)
+            vacuumed = self._db.compact()
+        logging.info('Pruned %d submission(s) and %d message(s)%s', submissions, messages,
+                     ', vacuumed database' if vacuumed else '')
+        metrics.inc('pruned', submissions, table='submissions')
+        metrics.inc('pruned', messages, table='messages')
+
+    def _prepare_submission(self, job):
+        """Apply subreddit rules and database checks to a submission
+
+        :param job: the submission job
+        :type job: _Job
+        :returns: True if the submission should be downloaded and rendered, else False
+        :rtype: bool
+        """
+        submission = job.submission
+        source_comment = job.source_comment
         # return if author account is deleted
         if not submission.author:
-            return
+            metrics.inc('skipped', reason='deleted')
+            return False
         sub = submission.subreddit.display_name
         # in r/fakehistoryporn, only process upvoted submissions
         score_threshold = 500
         if sub == 'fakehistoryporn' and not source_comment:
             if submission.score < score_threshold:
-                logging.debug('Score below %d in subreddit %s, skipping submission',
-                              score_threshold, sub)
-                return
-        # check db if submission was already processed
-        author = submission.author.name
-        title = submission.title
-        url = submission.url
-        result = self._db.submission_select(submission.id)
-        if result:
-            if result['retry'] or source_comment:
-                if result['imgur_url']:
-                    # logging.info('Submission id:%s found in database with imgur url set, ' +
-                    #              'trying to create reply', submission.id)
-                    # self._reply_imgur_url(result['imgur_url'], submission, source_comment)
-                    # return
-                    logging.info('Submission id:%s found in database with imgur url set',
-                                 submission.id)
-                    # db check disabled to allow custom titles
-                else:
-                    logging.info('Submission id:%s found in database without imgur url set, ',
-                                 submission.id)
-            else:
-                # skip submission
-                logging.debug('Submission id:%s found in database, returning', result['id'])
-                return
+                job.log(logging.DEBUG, 'Score below %d in subreddit %s, skipping submission',
+                        score_threshold, sub)
+                metrics.inc('skipped', reason='score')
+                return False
+        # rows older than the retention period are pruned, older submissions count as seen
+        if self._retention and not source_comment and \
+                submission.created_utc < time.time() - self._retention:
+            job.log(logging.DEBUG, 'Submission id:%s is older than the retention period, '
+                    'skipping', submission.id)
+            metrics.inc('skipped', reason='old')
+            return False
+        # check db if submission was already processed, before claiming it
+        if job.known is None:
+            with metrics.time('db'):
+                result = self._db.submission_select(submission.id)
         else:
-            logging.info('Found new submission subreddit:%s id:%s title:%s',
-                         sub, submission.id, title)
-            logging.debug('Adding submission to database')
-            self._db.submission_insert(submission.id, author, title, url)
+            result = job.known.get(submission.id)
+        if result and not self._process_known(job, result):
+            return False
+        # another worker may be processing the same submission
+        if not self._acquire('submission:' + submission.id):
+            if source_comment and not job.retry:
+                # the mention is marked as read already, it would be lost
+                job.log(logging.INFO, 'Submission id:%s is claimed by another worker, retrying '
+                        'mention in %ds', submission.id, self._claimed_mention_delay)
+                self._deferred_mentions.append((time.monotonic() + self._claimed_mention_delay,
+                                                source_comment, job.custom_title))
+                metrics.inc('mentions_deferred')
+                return False
+            job.log(logging.DEBUG, 'Submission id:%s is claimed by another worker, skipping',
+                    submission.id)
+            metrics.inc('skipped', reason='claimed')
+            return False
+        job.lease = 'submission:' + submission.id
+        job.author = submission.author.name
+        job.title = submission.title
+        job.url = submission.url
+        if not result:
+            job.log(logging.INFO, 'Found new submission subreddit:%s id:%s title:%s',
+                    sub, submission.id, job.title)
+            job.log(logging.DEBUG, 'Adding submission to database')
+            with metrics.time('db'):
+                inserted = self._db.submission_insert(submission.id, job.author, job.title,
+                                                      job.url)
+            if not inserted:
+                # inserted by another worker, after the select or while the id was missing
+                # from the seen-id filter
+                job.log(logging.DEBUG, 'Submission id:%s was added by another worker',
+                        submission.id)
+                with metrics.time('db'):
+                    result = self._db.submission_select(submission.id)
+                if result and not self._process_known(job, result):
+                    return False
         # in r/boottoobig, only process submission with a rhyme in the title
-        boot = sub == 'boottoobig'
-        if boot and not source_comment:
+        job.boot = sub == 'boottoobig'
+        if job.boot and not source_comment:
             triggers = [',', ';', 'roses']
-            if not any(t in title.lower() for t in triggers):
-                logging.info('Title is probably not part of rhyme, skipping submission')
-                return
-        if url.endswith('.gif') or url.endswith('.gifv'):
-            logging.info('Image is animated gif, skipping submission')
-            return
-        logging.debug('Trying to download image from %s', url)
-        try:
-            response = requests.get(url)
-            img = Image.open(BytesIO(response.content))
-        except OSError as error:
-            logging.warning('Converting to image failed, trying with <url>.jpg | %s', error)
-            try:
-                response = requests.get(url + '.jpg')
-                img = Image.open(BytesIO(response.content))
-            except OSError as error:
-                logging.error('Converting to image failed, skipping submission | %s', error)
-                return
-        image = RedditImage(img)
-        logging.debug('Adding title')
-        if custom_title:
-            image.add_title(custom_title, boot)
+            if not any(t in job.title.lower() for t in triggers):
+                job.log(logging.INFO, 'Title is probably not part of rhyme, skipping submission')
+                metrics.inc('skipped', reason='rhyme')
+                return False
+        # imgur serves the gif of a gifv page at the same name
+        if job.url.endswith('.gifv'):
+            job.url = job.url[:-1]
+        return True
+
+    @staticmethod
+    def _process_known(job, result):
+        """Decide if a submission found in the database is processed again
+
+        Mentions are, e.g. for custom titles. Failed submissions are only processed by their
+        retry, after its backoff, see _queue_retries.
+
+        :param job: the submission job
+        :type job: _Job
+        :param result: the database row of the submission
+        :type result: dict
+        :returns: True to process the submission again
+        :rtype: bool
+        """
+        if job.source_comment or job.retry:
+            if result['imgur_url']:
+                job.log(logging.INFO, 'Submission id:%s found in database with imgur url set',
+                        result['id'])
+                # db check disabled to allow custom titles
+            else:
+                job.log(logging.INFO, 'Submission id:%s found in database without imgur url set',
+                        result['id'])
+            return True
+        if result['retry']:
+            job.log(logging.DEBUG, 'Submission id:%s is waiting for its retry, returning',
+                    result['id'])
+            metrics.inc('skipped', reason='retry')
         else:
-            image.add_title(title, boot)
-        logging.debug('Trying to upload new image')
-        imgur_config = {
-            'album': None,
-            'name': submission.id,
-            'title': '"{}" by /u/{}'.format(title, author),
-            'description': submission.shortlink
-        }
+            job.log(logging.DEBUG, 'Submission id:%s found in database, returning', result['id'])
+            metrics.inc('skipped', reason='processed')
+        return False
+
+    def _fetch(self, url):
+        """Download url with the image fetcher
+
+        :rtype: bytes
+        """
+        with metrics.time('download'):
+            return self._fetcher.fetch(url)
+
+    @staticmethod
+    def _decode(data):
+        """Open and fully decode an image file, scaled down to the pixel budget
+
+        Animated gifs are only opened, their frames are decoded while rendering.
+
+        :rtype: PIL.Image.Image
+        """
+        with metrics.time('decode'):
+            return AnimatedRedditImage.open_animation(data) or RedditImage.open_image(data)
+
+    def _download_image(self, job):
+        """Download the submission image, decode it unless its render is cached
+
+        :param job: the submission job
+        :type job: _Job
+        :returns: True if the image was downloaded, else False
+        :rtype: bool
+        """
+        url = job.url
+        job.log(logging.DEBUG, 'Trying to download image from %s', url)
         try:
-            imgur_url = image.upload(self._imgur, imgur_config)
-        except ImgurClientRateLimitError as rate_error:
-            logging.error('Imgur ratelimit error, setting retry flag in database | %s', rate_error)
-            self._db.submission_set_retry(submission.id, bool(source_comment), source_comment)
-            return
-        if not imgur_url:
-            logging.error('Cannot upload new image, skipping submission')
-            return
-        self._db.submission_set_imgur_url(submission.id, imgur_url)
-        if not self._reply_imgur_url(imgur_url, submission, source_comment, upscaled=image.upscaled):
+            try:
+                self._load_image(job, url)
+            except NotAnImageError as error:
+                # links to image pages, like imgur.com/<id>, have the image at <url>.jpg
+                job.log(logging.WARNING, 'Url is not an image, trying with <url>.jpg | %s',
+                        error)
+                self._load_image(job, url + '.jpg')
+        except (ImageFetchError, OSError, ValueError, Image.DecompressionBombError) as error:
+            job.log(logging.ERROR, 'Converting to image failed, skipping submission | %s',
+                    error)
+            metrics.inc('skipped', reason='download')
+            return False
+        return True
+
+    def _load_image(self, job, url):
+        """Download url and look up its render in the cache, decode the image on a miss
+
+        The cache key only depends on the file contents and the title, so a cache hit skips
+        decoding and hashing the image, the hash is cached with the render.
+
+        :param job: the submission job, cache_key and cached or img and dhash are set
+        :type job: _Job
+        :param url: the image url
+        :type url: str
+        :raises ImageFetchError: if the download failed
+        :raises OSError: if the file is not a valid image
+        """
+        data = self._fetch(url)
+        job.cache_key = RenderCache.key(hashlib.sha256(data).hexdigest(),
+                                        job.custom_title or job.title, job.boot,
+                                        fallback_fonts=RedditImage.fallback_fonts)
+        job.cached = self._render_cache.get(job.cache_key)
+        if job.cached:
+            job.dhash = job.cached['dhash']
             return
-        logging.info('Successfully processed submission')
+        job.img = self._decode(data)
+        job.dhash = RepostIndex.dhash(job.img)
+
+    @staticmethod
+    def _repost_key(job):
+        """Repost index key of a job
+
+        :param job: the submission job, after download
+        :type job: _Job
+        :returns: dhash and title key
+        :rtype: tuple[int, str]
+        """
+        return job.dhash, RepostIndex.title_key(job.custom_title or job.title, job.boot)
+
+    def _render_image(self, job):
+        """Add the title to the downloaded image, unless the same render is cached
+
+        :param job: the submission job
+        :type job: _Job
+        :returns: True if the image was rendered or found, False if the animation is too large
+            or the render process died
+        :rtype: bool
+        """
+        if job.cached:
+            # looked up before decoding, see _load_image
+            job.log(logging.INFO, 'Found render in cache')
+            if job.cached['data'] is not None:
+                job.image = EncodedImage(job.cached['data'], job.cached['upscaled'])
+            return True
+        repost = self._reposts.find(*self._repost_key(job))
+        if repost:
+            job.log(logging.INFO, 'Found render of a repost | %s', repost)
+            metrics.inc('reposts')
+            job.cached = {'link': repost, 'data': None,
+                          'upscaled': RedditImage.target_size(*job.img.size)[0] > job.img.width}
+            job.img = None
+            return True
+        job.log(logging.DEBUG, 'Adding title')
+        if getattr(job.img, 'is_animated', False):
+            # frames are streamed from the source file, always rendered in this thread
+            job.image = AnimatedRedditImage(job.img)
+            job.image.add_title(job.custom_title or job.title, job.boot)
+            try:
+                job.image.encode('GIF')
+            except ValueError as error:
+                job.log(logging.WARNING, 'Animation too large, skipping submission | %s', error)
+                metrics.inc('skipped', reason='animation')
+                job.img = job.image = None
+                return False
+        elif self._renderer:
+            try:
+                with metrics.time('render'):
+                    job.image = self._renderer.render(job.img, job.custom_title or job.title,
+                                                      job.boot)
+            except BrokenProcessPool as error:
+                job.log(logging.ERROR, 'Render process died, skipping submission | %s', error)
+                metrics.inc('skipped', reason='render')
+                job.img = None
+                return False
+        else:
+            job.image = RedditImage(job.img)
+            job.image.add_title(job.custom_title or job.title, job.boot)
+            job.image.encode_auto()
+        job.img = None
+        return True
+
+    def _upload_image(self, job):
+        """Upload the rendered image to imgur and reply with the link
+
+        :param job: the submission job
+        :type job: _Job
+        :returns: True if the reply was posted, else False
+        :rtype: bool
+        """
+        submission = job.submission
+        source_comment = job.source_comment
+        if job.cached and job.cached['link']:
+            imgur_url = job.cached['link']
+            upscaled = job.cached['upscaled']
+        else:
+            job.log(logging.DEBUG, 'Trying to upload new image')
+            imgur_config = {
+                'album': None,
+                'name': submission.id,
+                'title': '"{}" by /u/{}'.format(job.title, job.author),
+                'description': submission.shortlink
+            }
+            upscaled = job.image.upscaled
+            # animations are too large for the render cache, only their link is kept
+            data = None if job.image.animated else job.image.encode_auto()[1]
+            report = job.image.encode_report
+            if report:
+                job.log(logging.INFO, 'Encoded %s as %s%s, %d bytes in %.0f ms, %d bytes less '
+                        'than png', report['kind'], report['format'],
+                        ' q{}'.format(report['quality']) if report['quality'] else '',
+                        report['bytes'], report['seconds'] * 1000,
+                        report['png_bytes'] - report['bytes'])
+                metrics.inc('encoded_bytes', report['bytes'], format=report['format'],
+                            kind=report['kind'])
+                metrics.inc('encoded_bytes_saved', report['png_bytes'] - report['bytes'],
+                            format=report['format'], kind=report['kind'])
+            # don't block the worker (and mentions behind it) until a drain ends or the
+            # credits refill
+            delay = self._scheduler.imgur_delay() or self._scheduler.acquire_imgur()
+            if delay:
+                job.log(logging.INFO, 'Imgur uploads are rate limited for %.0fs, setting retry '
+                        'flag in database', delay)
+                metrics.inc('retries', reason='imgur')
+                self._db.submission_set_retry(submission.id, source_comment, delay)
+                if data is not None:
+                    self._render_cache.put(job.cache_key, data=data, upscaled=upscaled,
+                                           dhash=job.dhash)
+                return False
+            try:
+                imgur_url = job.image.upload(self._imgur, imgur_config)
+            except ImgurClientRateLimitError as rate_error:
+                job.log(logging.ERROR,
+                        'Imgur ratelimit error, setting retry flag in database | %s', rate_error)
+                self._scheduler.imgur_rate_limited()
+                metrics.inc('retries', reason='imgur')
+                self._db.submission_set_retry(submission.id, source_comment,
+                                              self._scheduler.imgur_delay())
+                if data is not None:
+                    self._render_cache.put(job.cache_key, data=data, upscaled=upscaled,
+                                           dhash=job.dhash)
+                return False
+            if not imgur_url:
+                job.log(logging.ERROR, 'Cannot upload new image, skipping submission')
+                metrics.inc('skipped', reason='upload')
+                return False
+            self._render_cache.put(job.cache_key, imgur_url, data, upscaled, job.dhash)
+            if job.dhash is not None:
+                self._reposts.add(*self._repost_key(job), imgur_url)
+        if not self._reply_imgur_url(imgur_url, submission, source_comment,
+                                     upscaled=upscaled, job=job):
+            return False
+        job.log(logging.INFO, 'Successfully processed submission')
+        metrics.inc('processed')
+        return True
 
     def _process_feedback_message(self, message):
-        """Forward message to creator
+        """Queue message for forwarding to creator, see _forward_feedback
 
         :param message: the feedback message
         :type message: praw.models.Message
         """
         message_author = message.author.name
         logging.info('Found new feedback message from %s', message_author)
-        subject = 'TitleToImageBot feedback from {}'.format(message_author)
-        body = 'Subject: {}\n\nBody: {}'.format(message.subject, message.body)
-        self._reddit.redditor(__author__).message(subject, body)
-        logging.info('Forwarded message to author')
+        self._db.feedback_insert(message.id, message_author, message.subject, message.body)
+
+    def _forward_feedback(self):
+        """Forward all queued feedback messages to creator, several per message"""
+        feedback = self._db.feedback_select()
+        # reddit messages are limited to 10000 characters
+        max_length = 9000
+        batches = []
+        length = max_length
+        for item in feedback:
+            text = 'From: /u/{author}\n\nSubject: {subject}\n\nBody: {body}'.format(
+                **item)[:max_length]
+            if length + len(text) > max_length:
+                batches.append([])
+                length = 0
+            batches[-1].append(dict(item, text=text))
+            length += len(text)
+        for batch_items in batches:
+            authors = sorted({item['author'] for item in batch_items})
+            subject = 'TitleToImageBot feedback from {}'.format(', '.join(authors))[:100]
+            body = '\n\n---\n\n'.join(item['text'] for item in batch_items)
+            self._scheduler.acquire_reddit()
+            self._reddit.redditor(__author__).message(subject=subject, message=body)
+            self._db.feedback_delete(item['id'] for item in batch_items)
+            logging.info('Forwarded %d feedback message(s) to author', len(batch_items))
+
+    @staticmethod
+    def _parse_custom_title(body):
+        """Find a custom title in a comment mentioning the bot
+
+        e.g. '/u/titletoimagebot "custom title"'
+
+        :param body: the comment body
+        :type body: str
+        :returns: the custom title, None if there is none or it is longer than 512 characters
+        :rtype: str, NoneType
+        """
+        match = TitleToImageBot.regex_custom_title.match(body)
+        title = None
+        if match:
+            title = match.group(1)
+            if len(title) > 512:
+                title = None
+            else:
+                logging.debug('Found custom title: %s', title)
+        return title
+
+    def _process_mention(self, message, custom_title=None):
+        """Process the submission a comment mentioned the bot in, reply to the comment
+
+        Mentions are marked as read with the rest of their inbox page, see _process_messages.
+
+        :param message: the comment mentioning the bot
+        :type message: praw.models.Comment
+        :param custom_title: if not None, use as title instead of submission title
+        :type custom_title: str, NoneType
+        """
+        self._process_submission(message.submission, message, custom_title)
+
+    def _retry_submission(self, row):
+        """Process a submission that failed before, reply to the original comment if any
+
+        :param row: the submission row from Database.submission_select_retry
+        :type row: dict
+        """
+        if not self._acquire('submission:' + row['id']):
+            logging.debug('Submission id:%s is claimed by another worker, skipping retry',
+                          row['id'])
+            return
+        try:
+            # another worker may have retried it since the row was selected
+            current = self._db.submission_select(row['id'])
+            if not current or not current['retry'] or \
+                    current['retry_count'] != row['retry_count']:
+                logging.debug('Submission id:%s was retried by another worker', row['id'])
+                return
+            self._retry_claimed(row)
+        finally:
+            self._release('submission:' + row['id'])
 
-    def _process_message(self, message):
-        """Process given message (remove, feedback, mark good/bad bot as read)
+    def _retry_claimed(self, row):
+        """Retry a submission this worker has claimed, see _retry_submission
+
+        :param row: the submission row from Database.submission_select_retry
+        :type row: dict
+        """
+        logging.info('Retrying submission id:%s, attempt %d', row['id'], row['retry_count'] + 1)
+        submission = self._reddit.submission(id=row['id'])
+        comment = self._reddit.comment(id=row['retry_source']) if row['retry_source'] else None
+        try:
+            if not comment:
+                self._process_submission(submission, retry=True)
+                return
+            self._process_submission(submission, comment, self._parse_custom_title(comment.body),
+                                     retry=True)
+        except (Forbidden, NotFound) as error:
+            logging.warning('Submission id:%s is gone, clearing retry flag | %s',
+                            row['id'], error)
+            self._db.submission_clear_retry(row['id'])
+        finally:
+            # rate limits reschedule the retry and a reply clears it, other failures (e.g. a
+            # failed download) count as an attempt here, else the retry would be due again
+            # every cycle and never run out of attempts
+            current = self._db.submission_select(row['id'])
+            if current and current['retry'] and current['retry_count'] == row['retry_count']:
+                logging.info('Retry of submission id:%s failed, scheduling the next attempt',
+                             row['id'])
+                self._db.submission_set_retry(row['id'], comment)
+
+    def _queue_deferred_mentions(self):
+        """Queue mentions deferred by _prepare_submission whose delay is over"""
+        now = time.monotonic()
+        due = [mention for mention in self._deferred_mentions if mention[0] <= now]
+        if not due:
+            return
+        self._deferred_mentions = [mention for mention in self._deferred_mentions
+                                   if mention[0] > now]
+        for _, comment, custom_title in due:
+            self._scheduler.submit(Scheduler.PRIORITY_MENTION, self._process_mention, comment,
+                                   custom_title)
+
+    def _queue_retries(self, limit):
+        """Queue submissions whose retry is due
+
+        :param limit: maximum amount of submissions to queue
+        :type limit: int
+        """
+        for row in self._db.submission_select_retry(limit):
+            self._scheduler.submit(Scheduler.PRIORITY_RETRY, self._retry_submission, row)
+
+    def _classify_message(self, message):
+        """Find out what to do with an inbox item
 
         :param message: the inbox message, comment reply or username mention
         :type message: praw.models.Message, praw.models.Comment
+        :returns: 'sent', 'automoderator', 'mention', 'feedback', 'vote' (good/bad bot) or None
+            if the item is ignored
+        :rtype: str, NoneType
         """
-        if not message.author:
-            return
-        # check db if message was already processed
         author = message.author.name
         subject = message.subject.lower()
-        body_original = message.body
         body = message.body.lower()
-        if self._db.message_exists(message.id):
-            logging.debug('Message %s found in database, returning', message.id)
-            return
-        logging.debug('Message: %s | %s', subject, body)
-        logging.debug('Adding message to database')
-        self._db.message_insert(message.id, author, subject, body)
         # check if message was sent, instead of received
-        if author == self._reddit.user.me().name:
-            logging.debug('Message was sent, returning')
-            return
-        # process message
+        if author == self._me().name:
+            return 'sent'
         if (isinstance(message, praw.models.Comment) and
                 (subject == 'username mention' or
                  (subject == 'comment reply' and 'u/titletoimagebot' in body))):
             # You win this time, AutoModerator
-            if message.author.name.lower() == 'automoderator':
-                message.mark_read()
-                return
-            match = re.match(r'.*u/titletoimagebot\s*["“”](.+)["“”].*',
-                             body_original, re.RegexFlag.IGNORECASE)
-            title = None
-            if match:
-                title = match.group(1)
-                if len(title) > 512:
-                    title = None
-                else:
-                    logging.debug('Found custom title: %s', title)
-            self._process_submission(message.submission, message, title)
-            message.mark_read()
-        elif subject.startswith('feedback'):
-            self._process_feedback_message(message)
+            if author.lower() == 'automoderator':
+                return 'automoderator'
+            return 'mention'
+        if subject.startswith('feedback'):
+            return 'feedback'
         # mark short good/bad bot comments as read to keep inbox clean
-        elif 'good bot' in body and len(body) < 12:
-            logging.debug('Good bot message or comment reply found, marking as read')
-            message.mark_read()
-        elif 'bad bot' in body and len(body) < 12:
-            logging.debug('Bad bot message or comment reply found, marking as read')
-            message.mark_read()
+        if self.regex_bot_vote.match(body):
+            return 'vote'
+        return None
 
-    def run(self, limit):
-        """Run the bot
+    def _process_messages(self, messages):
+        """Process a page of inbox items (mentions, feedback, mark good/bad bot as read)
 
-        Process submissions and messages, remove bad comments
+        Items are checked against the database with one query and inserted in one transaction.
+        Mentions, AutoModerator and good/bad bot comments are marked as read with one api call
+        per 25 items.
 
-        :param limit: amount of submissions/messages to process
+        :param messages: the inbox messages, comment replies and username mentions
+        :type messages: iterable[praw.models.Message, praw.models.Comment]
+        """
+        messages = [message for message in messages if message.author]
+        if self._retention:
+            # rows older than the retention period are pruned, older messages count as seen
+            cutoff = time.time() - self._retention
+            messages = [message for message in messages if message.created_utc >= cutoff]
+        if not messages:
+            return
+        with metrics.time('db'):
+            seen = self._db.message_exists_many(message.id for message in messages)
+        new = OrderedDict()
+        for message in messages:
+            if message.id in seen:
+                logging.debug('Message %s found in database, returning', message.id)
+            else:
+                new.setdefault(message.id, message)
+        if not new:
+            return
+        kinds = {message_id: self._classify_message(message)
+                 for message_id, message in new.items()}
+        logging.debug('Adding %d message(s) to database', len(new))
+        with metrics.time('db'), self._db.transaction():
+            inserted = self._db.message_insert_many(
+                (message.id, message.author.name, message.subject.lower(), message.body.lower())
+                for message in new.values())
+            for message_id in inserted:
+                if kinds[message_id] == 'feedback':
+                    self._process_feedback_message(new[message_id])
+        mark_read = []
+        for message_id, message in new.items():
+            kind = kinds[message_id]
+            if message_id not in inserted:
+                logging.debug('Message %s was processed by another worker, returning',
+                              message_id)
+                continue
+            logging.debug('Message: %s | %s | %s', kind, message.subject.lower(),
+                          message.body.lower())
+            metrics.inc('messages', kind=kind or 'other')
+            if kind == 'mention':
+                title = self._parse_custom_title(message.body)
+                self._scheduler.submit(Scheduler.PRIORITY_MENTION, self._process_mention,
+                                       message, title)
+            if kind in ('mention', 'automoderator', 'vote'):
+                mark_read.append(message)
+        if mark_read:
+            logging.debug('Marking %d message(s) as read', len(mark_read))
+            self._scheduler.acquire_reddit(ceil(len(mark_read) / self._mark_read_batch))
+            self._reddit.inbox.mark_read(mark_read)
+
+    def _process_hot(self, limit):
+        """Process the hot submissions of the subreddit(s)
+
+        :param limit: amount of submissions to process
         :type limit: int
         """
         logging.debug('Processing last %s submissions...', limit)
-        for submission in self._subreddit.hot(limit=limit):
-            self._process_submission(submission)
+        self._scheduler.acquire_reddit(ceil(limit / 100))
+        with metrics.time('listing'):
+            submissions = list(self._subreddit.hot(limit=limit))
+        with metrics.time('db'):
+            known = self._db.submission_select_many(submission.id for submission in submissions)
+        if self._pipeline:
+            self._scheduler.submit(Scheduler.PRIORITY_HOT, self._pipeline.run, submissions, known)
+        else:
+            for submission in submissions:
+                self._scheduler.submit(Scheduler.PRIORITY_HOT, self._process_submission,
+                                       submission, known=known)
+
+    def _process_inbox(self, limit):
+        """Process the latest inbox messages
+
+        :param limit: amount of messages to process
+        :type limit: int
+        """
         logging.debug('Processing last %s messages...', limit)
-        for message in self._reddit.inbox.all(limit=limit):
-            self._process_message(message)
+        self._scheduler.acquire_reddit(ceil(limit / 100))
+        with metrics.time('listing'):
+            messages = list(self._reddit.inbox.all(limit=limit))
+        self._process_messages(messages)
+
+    def _me(self):
+        """The bot's own redditor, fetched once
+
+        :rtype: praw.models.Redditor
+        """
+        if self._user is None:
+            self._user = self._reddit.user.me()
+        return self._user
+
+    def _remove_bad_comments(self):
+        """Delete own comments with negative score
+
+        Only comments younger than cleanup_max_age are checked, older scores hardly change.
+        Comments are listed newest first, so the listing stops at the first older one.
+        """
         logging.debug('Removing bad comments...')
-        for comment in self._reddit.user.me().comments.new(limit=100):
-            if comment.score <= -1:
-                logging.info('Removing bad comment id:%s score:%s', comment.id, comment.score)
-                comment.delete()
+        cutoff = time.time() - self._cleanup_max_age
+        with metrics.time('cleanup'):
+            self._scheduler.acquire_reddit()
+            for comment in self._me().comments.new(limit=None):
+                if comment.created_utc < cutoff:
+                    break
+                if comment.score <= -1:
+                    logging.info('Removing bad comment id:%s score:%s', comment.id, comment.score)
+                    comment.delete()
+                    metrics.inc('comments_removed')
+
+    def _run_maintenance(self):
+        """Run maintenance jobs that are due, each one has its own interval
+
+        If several workers share the database, the first one to claim a job runs it.
+        """
+        now = time.monotonic()
+        for job in self._maintenance:
+            interval, next_run, function = job
+            if now >= next_run:
+                # the claim outlives the run, so only one worker runs it per interval
+                if not self._db.lease_acquire('maintenance:' + function.__name__,
+                                              self._worker_id, interval):
+                    job[1] = now + interval
+                    continue
+                try:
+                    function()
+                except Exception:
+                    # a failing job must not stop the bot, it is retried next interval
+                    logging.error('Unhandled exception in maintenance job %s\n%s',
+                                  function.__name__, traceback.format_exc().rstrip())
+                finally:
+                    job[1] = time.monotonic() + interval
+
+    def stop(self):
+        """Stop run_stream and the lease heartbeat, shut down the render processes
+
+        run_stream returns after its current poll. The bot can't be run anymore afterwards.
+        """
+        self._stopped.set()
+        self._heartbeat_thread.join()
+        if self._renderer:
+            self._renderer.shutdown()
+
+    def _end_cycle(self):
+        """Log the cycle summary and export the metrics"""
+        logging.info('Cycle summary | %s', metrics.cycle_summary())
+        if self._metrics_file:
+            metrics.write(self._metrics_file)
+
+    def run(self, limit):
+        """Run the bot
+
+        Process submissions and messages, remove bad comments. Mentions are processed
+        first, then due retries, then hot submissions.
+
+        :param limit: amount of submissions/messages to process
+        :type limit: int
+        """
+        metrics.start_cycle()
+        self._process_inbox(limit)
+        self._queue_deferred_mentions()
+        self._process_hot(limit)
+        self._queue_retries(limit)
+        self._scheduler.run_pending()
+        self._run_maintenance()
+        self._end_cycle()
+
+    def _drain_stream(self, source, stream, process):
+        """Process the new items of a stream as one page, once it pauses
+
+        Items at or below the high-water mark of their kind (ids are base 36 counters, one per
+        kind) were handled before, they are skipped without a database lookup. The marks are
+        stored in the database so restarts resume where they left off. Items processed after
+        the last stored mark are found in the submissions/messages tables again.
+
+        :param source: name of the stream, used as state key
+        :type source: str
+        :param stream: praw stream created with pause_after=0
+        :type stream: generator
+        :param process: called with the list of new items, if there are any
+        :type process: callable
+        """
+        marks = {}
+        changed = {}
+        page = []
+        for item in stream:
+            if item is None:
+                break
+            key = 'stream:{}:{}'.format(source, item.fullname[:2])
+            if key not in marks:
+                marks[key] = int(self._db.state_get(key, '0'), 36)
+            item_id = int(item.id, 36)
+            if item_id <= marks[key]:
+                continue
+            page.append(item)
+            marks[key] = item_id
+            changed[key] = item.id
+        if not page:
+            return
+        process(page)
+        with self._db.transaction():
+            for key, item_id in changed.items():
+                self._db.state_set(key, item_id)
+
+    def run_stream(self, limit, interval, poll_interval=5):
+        """Run the bot on streams of new submissions and inbox items
+
+        New items are processed within poll_interval seconds. The hot submissions are still
+        checked every interval seconds (e.g. for the score threshold in r/fakehistoryporn),
+        so are bad comments. Only returns after :meth:`stop` or by raising an exception.
+
+        :param limit: amount of hot submissions to check every interval
+        :type limit: int
+        :param interval: time (in seconds) between hot submission checks
+        :type interval: int
+        :param poll_interval: time (in seconds) between stream polls
+        :type poll_interval: int
+        """
+        submissions = self._subreddit.stream.submissions(pause_after=0)
+        inbox = self._reddit.inbox.stream(pause_after=0)
+
+        def queue_submissions(page):
+            for submission in page:
+                self._scheduler.submit(Scheduler.PRIORITY_HOT, self._process_submission,
+                                       submission)
+
+        next_sweep = 0
+        while not self._stopped.is_set():
+            sweep = time.monotonic() >= next_sweep
+            if sweep:
+                metrics.start_cycle()
+            self._scheduler.acquire_reddit(2)
+            self._drain_stream('submissions', submissions, queue_submissions)
+            self._drain_stream('inbox', inbox, self._process_messages)
+            self._queue_deferred_mentions()
+            if sweep:
+                self._process_hot(limit)
+                self._queue_retries(limit)
+            self._scheduler.run_pending()
+            self._run_maintenance()
+            if sweep:
+                self._end_cycle()
+                next_sweep = time.monotonic() + interval
+            self._stopped.wait(poll_interval)
+
+
+def _read_manifest(source):
+    """Read batch render tasks
+
+    source is a directory (every image in it, title from the file name) or a .csv/.jsonl
+    manifest with the fields path, title and optionally id, boot, bg_color, text_color.
+    Relative paths are relative to the manifest. The id defaults to the file name, with its
+    extension, so a.png and a.jpg don't share an output file.
+
+    :param source: the directory or manifest path
+    :type source: str
+    :returns: tasks as dicts with all fields set
+    :rtype: generator[dict]
+    """
+    extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() in extensions:
+                yield {'id': name, 'path': os.path.join(source, name),
+                       'title': stem.replace('_', ' '), 'boot': False,
+                       'bg_color': '#fff', 'text_color': '#000'}
+        return
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='', encoding='utf-8') as manifest_file:
+        if source.lower().endswith('.csv'):
+            rows = csv.DictReader(manifest_file)
+        else:
+            rows = (json.loads(line) for line in manifest_file if line.strip())
+        for row in rows:
+            boot = row.get('boot', False)
+            if isinstance(boot, str):
+                boot = boot.strip().lower() in ('1', 'true', 'yes')
+            yield {
+                'id': row.get('id') or os.path.basename(row['path']),
+                'path': os.path.join(base, row['path']),
+                'title': row['title'],
+                'boot': bool(boot),
+                'bg_color': row.get('bg_color') or '#fff',
+                'text_color': row.get('text_color') or '#000',
+            }
+
+
+def _batch_output_path(output_dir, task_id, image_format):
+    """Output file of a batch task"""
+    safe_id = re.sub(r'[^\w.-]', '_', str(task_id))
+    return os.path.join(output_dir, '{}.{}'.format(safe_id, image_format.lower()))
+
+
+def _batch_render(task, output_dir, image_format):
+    """Render one batch task and write the result, runs in a render process
+
+    :returns: result record for results.jsonl
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    result = {'id': task['id'], 'path': task['path']}
+    try:
+        with open(task['path'], 'rb') as image_file:
+            image = RedditImage(RedditImage.open_image(image_file.read()))
+        image.add_title(task['title'], task['boot'], task['bg_color'], task['text_color'])
+        if image_format == 'AUTO':
+            image_format, data = image.encode_auto()
+        else:
+            data = image.encode(image_format)
+        output_path = result['output'] = _batch_output_path(output_dir, task['id'],
+                                                            image_format)
+        temp_path = output_path + '.tmp'
+        with open(temp_path, 'wb') as output_file:
+            output_file.write(data)
+        os.replace(temp_path, output_path)
+        result.update(upscaled=image.upscaled, downscaled=image.downscaled,
+                      format=image_format, bytes=len(data))
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        result['error'] = str(error)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def batch(source, output_dir, workers=None, image_format='PNG'):
+    """Render a directory or manifest of local images, no network needed
+
+    Renders in a process pool, writes every image as soon as it is done and appends a record
+    to results.jsonl in output_dir. Tasks whose output file exists are skipped, so an
+    interrupted batch resumes where it stopped.
+
+    :param source: the directory or manifest, see _read_manifest
+    :type source: str
+    :param output_dir: the output directory, created if missing
+    :type output_dir: str
+    :param workers: amount of render processes, None for one per cpu
+    :type workers: int, NoneType
+    :param image_format: output format, 'PNG', 'JPEG', 'WEBP' or 'AUTO' (see
+        RedditImage.encode_auto)
+    :type image_format: str
+    :returns: amount of rendered and failed tasks
+    :rtype: tuple[int, int]
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rendered = failed = skipped = 0
+    with ProcessPoolExecutor(workers, initializer=_render_worker_init,
+                             initargs=(RedditImage.font_file,
+                                       tuple(RedditImage.fallback_fonts),
+                                       RedditImage.photo_format)) as executor, \
+            open(os.path.join(output_dir, 'results.jsonl'), 'a') as results_file:
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        pending = set()
+        tasks = iter(_read_manifest(source))
+        formats = ('PNG', 'JPEG', 'WEBP') if image_format == 'AUTO' else (image_format,)
+        while True:
+            for task in tasks:
+                if any(os.path.exists(_batch_output_path(output_dir, task['id'], output_format))
+                       for output_format in formats):
+                    skipped += 1
+                    continue
+                pending.add(executor.submit(_batch_render, task, output_dir, image_format))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results_file.write(json.dumps(result) + '\n')
+                if 'error' in result:
+                    failed += 1
+                    logging.error('Cannot render %s | %s', result['path'], result['error'])
+                else:
+                    rendered += 1
+                    logging.debug('Rendered %s in %.2fs', result['output'], result['seconds'])
+            results_file.flush()
+    logging.info('Batch finished, rendered:%d failed:%d skipped:%d', rendered, failed, skipped)
+    return rendered, failed
+
+
+def _batch_main(argv):
+    """Batch subcommand
+
+    Usage: ./titletoimagebot.py batch [-h] [--workers N] [--format {png,jpeg,webp,auto}]
+                                      [--photo-format {jpeg,webp}] [--font FONT]
+                                      [--fallback-font FONT] source output
+    """
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='titletoimagebot.py batch')
+    parser.add_argument('source', help='directory of images or .csv/.jsonl manifest '
+                        '(fields: path, title, id, boot, bg_color, text_color)')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--workers', help='amount of render processes (default: one per cpu)',
+                        type=int)
+    parser.add_argument('--format', help='output format, auto picks one per image',
+                        choices=['png', 'jpeg', 'webp', 'auto'], default='png')
+    parser.add_argument('--photo-format', help='format of photos with --format auto',
+                        choices=['jpeg', 'webp'], default='jpeg')
+    parser.add_argument('--font', help='font file', default=RedditImage.font_file)
+    parser.add_argument('--fallback-font', help='font file for characters the font has no '
+                        'glyph for, can be repeated', action='append', default=[])
+    args = parser.parse_args(argv)
+    RedditImage.font_file = args.font
+    RedditImage.fallback_fonts = tuple(args.fallback_font)
+    RedditImage.photo_format = args.photo_format.upper()
+    _, failed = batch(args.source, args.output, args.workers, args.format.upper())
+    sys.exit(1 if failed else 0)
 
 
 def _setup_logging(level):
@@ -532,27 +3836,77 @@ def _handle_exception(exc_type, exc_value, exc_traceback):
 def main():
     """Main function
 
-    Usage: ./titletoimagebot.py [-h] limit interval
+    Usage: ./titletoimagebot.py [-h] [--stream] [--pipeline FETCH RENDER UPLOAD]
+                                [--render-processes N] [--cleanup-interval SECONDS]
+                                [--feedback-interval SECONDS] [--metrics-file FILE]
+                                [--metrics-port PORT] [--worker-id ID] [--fallback-font FONT]
+                                [--lease-duration SECONDS] [--retention-days DAYS]
+                                [--photo-format {jpeg,webp}] limit interval
+           ./titletoimagebot.py batch [-h] ... source output
 
     e.g. './titletoimagebot 10 60' will process the last 10 submissions/messages every 60 seconds.
+
+    The database keeps every processed submission and message unless --retention-days is set,
+    e.g. '--retention-days 90' deletes rows older than 90 days every 6 hours. Submissions and
+    mentions older than the retention are skipped, so it should exceed the age of anything
+    still listed in the hot submissions or the inbox.
     """
+    if sys.argv[1:2] == ['batch']:
+        _batch_main(sys.argv[2:])
+        return
     _setup_logging(logging.INFO)
     sys.excepthook = _handle_exception
     parser = argparse.ArgumentParser()
     parser.add_argument('limit', help='amount of submissions/messages to process each cycle',
                         type=int)
     parser.add_argument('interval', help='time (in seconds) to wait between cycles', type=int)
+    parser.add_argument('--stream', help='process new submissions and messages as they arrive, '
+                        'check hot submissions every interval', action='store_true')
+    parser.add_argument('--pipeline', help='process submissions concurrently with the given '
+                        'amount of download, render and upload workers',
+                        type=int, nargs=3, metavar=('FETCH', 'RENDER', 'UPLOAD'))
+    parser.add_argument('--render-processes', help='render in this many processes '
+                        '(0 for one per cpu)', type=int)
+    parser.add_argument('--cleanup-interval', help='time (in seconds) between bad comment '
+                        'removals', type=int, default=600)
+    parser.add_argument('--feedback-interval', help='time (in seconds) between feedback '
+                        'forwards', type=int, default=300)
+    parser.add_argument('--metrics-file', help='write prometheus metrics to this file every cycle')
+    parser.add_argument('--metrics-port', help='serve prometheus metrics on this port', type=int)
+    parser.add_argument('--worker-id', help='unique name of this worker, if several workers '
+                        'on this host share the database (default hostname:pid)')
+    parser.add_argument('--lease-duration', help='time (in seconds) until the claims of a '
+                        'crashed worker expire', type=int, default=300)
+    parser.add_argument('--fallback-font', help='font file for characters roboto.ttf has no '
+                        'glyph for, can be repeated', action='append', default=[])
+    parser.add_argument('--retention-days', help='delete submissions and messages older than '
+                        'this, older items are then skipped as if processed '
+                        '(default 0 keeps them forever)', type=float, default=0)
+    parser.add_argument('--photo-format', help='upload format of photos, graphics are '
+                        'uploaded as png', choices=['jpeg', 'webp'], default='jpeg')
     args = parser.parse_args()
+    RedditImage.fallback_fonts = tuple(args.fallback_font)
+    RedditImage.photo_format = args.photo_format.upper()
     logging.debug('Initializing bot')
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
     with open('subreddits.json') as subreddits_file:
         sub = '+'.join(json.load(subreddits_file))
-    bot = TitleToImageBot(sub)
+    bot = TitleToImageBot(sub, pipeline=args.pipeline, metrics_file=args.metrics_file,
+                          render_processes=args.render_processes,
+                          cleanup_interval=args.cleanup_interval,
+                          feedback_interval=args.feedback_interval,
+                          worker_id=args.worker_id, lease_duration=args.lease_duration,
+                          retention=int(args.retention_days * 24 * 60 * 60) or None)
     logging.info('Bot initialized, processing the last %s submissions/messages every %s seconds',
                  args.limit, args.interval)
     while True:
         try:
             logging.debug('Running bot')
-            bot.run(args.limit)
+            if args.stream:
+                bot.run_stream(args.limit, args.interval)
+            else:
+                bot.run(args.limit)
             logging.debug('Bot finished, restarting in %s seconds', args.interval)
         except (requests.exceptions.ReadTimeout,
                 requests.exceptions.ConnectionError,